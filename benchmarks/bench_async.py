@@ -0,0 +1,131 @@
+"""Many concurrent searches end to end: threaded path vs asyncio path.
+
+Runs the local Divar and image servers from ``servers.py`` and a fake Bot
+API, each with a configurable latency, then starts N searches at once through
+each execution mode and reports wall time, time from submit to the final
+menu message, and the peak number of threads. Run from the repository root:
+
+    python benchmarks/bench_async.py [--searches N] [--results N] [--mode cards|album]
+
+Telegram rate limits are lifted for both paths so the numbers measure the
+bot rather than the configured pacing.
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+
+os.environ.setdefault("DIVAR_BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("DIVAR_LISTING_INDEX", "")  # no listing database in the working tree
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telebot  # noqa: E402
+
+import bot  # noqa: E402
+import servers  # noqa: E402
+from fake_telegram import BotAPI  # noqa: E402
+
+logging.disable(logging.WARNING)
+
+
+def bot_threads():
+    """Threads started by the bot, leaving out the local servers' request threads"""
+    return sum(1 for thread in threading.enumerate() if "process_request_thread" not in thread.name)
+
+
+class PeakThreads:
+    def __init__(self):
+        self.peak = bot_threads()
+        self.running = True
+        threading.Thread(target=self._sample, daemon=True).start()
+
+    def _sample(self):
+        while self.running:
+            self.peak = max(self.peak, bot_threads())
+            time.sleep(0.01)
+
+
+def unlimited_rates():
+    return dict(global_rate=1e9, global_burst=1e9, chat_rate=1e9, chat_burst=1e9)
+
+
+def run(label, submit, searches, finished, timeout):
+    threads = PeakThreads()
+    submitted = {}
+    started = time.perf_counter()
+    for chat_id in range(1, searches + 1):
+        submitted[chat_id] = time.perf_counter()
+        submit(chat_id, f"{label}-{chat_id}")
+    deadline = started + timeout
+    while len(finished) < searches and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    wall = time.perf_counter() - started
+    threads.running = False
+
+    latencies = sorted(finished[chat_id] - submitted[chat_id] for chat_id in finished)
+    if not latencies:
+        print(f"{label:>8}: no search finished within {timeout:.0f}s")
+        return
+    print(f"{label:>8}: {len(latencies)}/{searches} searches in {wall:6.2f}s "
+          f"({len(latencies) / wall:7.1f}/s)  p50 {statistics.median(latencies):6.2f}s  "
+          f"p95 {latencies[int(0.95 * (len(latencies) - 1))]:6.2f}s  peak threads {threads.peak}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--searches", type=int, default=200, help="searches started at once")
+    parser.add_argument("--results", type=int, default=10, help="results per search")
+    parser.add_argument("--mode", choices=sorted(bot.DELIVERY_MODES), default="cards")
+    parser.add_argument("--page-latency", type=float, default=0.15, help="seconds per result page")
+    parser.add_argument("--image-latency", type=float, default=0.05, help="seconds per image HEAD")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="seconds per Bot API call")
+    parser.add_argument("--host-concurrency", type=int, default=bot.HTTP_HOST_CONCURRENCY,
+                        help="requests in flight per host, for both paths")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--only", choices=["threads", "asyncio"], help="run a single execution mode, for a clean thread count")
+    args = parser.parse_args()
+
+    bot.DIVAR_BASE_URL = servers.start_divar(servers.start_images(args.image_latency), args.page_latency)
+
+    finished = {}
+
+    def on_call(method, params):
+        if params.get("text") == bot.MAIN_MENU_TEXT:
+            finished[int(params["chat_id"])] = time.perf_counter()
+
+    api = BotAPI(latency=args.api_latency, on_call=on_call)
+    api.start()
+    telebot.apihelper.API_URL = api.url
+
+    print(f"{args.searches} searches x {args.results} results ({args.mode}), page {args.page_latency * 1000:.0f}ms, "
+          f"image {args.image_latency * 1000:.0f}ms, api {args.api_latency * 1000:.0f}ms")
+
+    if args.only in (None, "threads"):
+        bot.outbox = bot.OutboundSender(**unlimited_rates())
+        bot.http_client = bot.HttpClient(host_concurrency=args.host_concurrency,
+                                         pool_maxsize=args.host_concurrency, pool_hosts={})
+        bot.image_checker = bot.ImageChecker(workers=args.host_concurrency)
+        bot.search_scheduler = bot.SearchScheduler(max_queue=args.searches)
+        finished.clear()
+        run("threads", lambda chat_id, query: bot.search_scheduler.submit(
+            chat_id, chat_id, args.results, bot.send_products, query, args.results, chat_id, "tehran",
+            delivery_mode=args.mode), args.searches, finished, args.timeout)
+
+    if args.only in (None, "asyncio"):
+        bot.async_runtime = bot.AsyncSearchRuntime(max_searches=args.searches,
+                                                   host_concurrency=args.host_concurrency)
+        bot.async_runtime.telegram = bot.AsyncTelegramSender(**unlimited_rates())
+        finished.clear()
+        run("asyncio", lambda chat_id, query: bot.async_runtime.submit(
+            chat_id, chat_id, args.results, bot.async_send_products, query, args.results, chat_id, "tehran",
+            delivery_mode=args.mode), args.searches, finished, args.timeout)
+        while bot.async_runtime.stats()["running"]:
+            time.sleep(0.05)
+        bot.async_runtime.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""Cards/sec microbenchmark: the single-pass extractor vs the previous implementation.
+
+Run from the repository root:
+
+    python benchmarks/bench_extract.py [--repeat N]
+
+The ``legacy_*`` functions below are the extractors as they were before the
+single-pass rewrite. They are kept verbatim so the numbers stay comparable
+and so the benchmark can assert that both produce identical output.
+"""
+import argparse
+import logging
+import os
+import re
+import sys
+import time
+
+os.environ.setdefault("DIVAR_BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("DIVAR_LISTING_INDEX", "")  # no listing database in the working tree
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup  # noqa: E402
+
+import bot  # noqa: E402
+import pages  # noqa: E402
+
+logging.disable(logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def legacy_extract_product_from_container(container):
+    """Alternative method to extract product info from any container"""
+    product = {}
+    
+    try:
+        # Find any link inside container
+        link = container.find('a', href=re.compile(r'/v/'))
+        if link:
+            href = link.get('href')
+            product['url'] = f"https://divar.ir{href}" if href.startswith('/') else href
+        
+        # Extract title from multiple possible elements
+        title_candidates = container.find_all(['h1', 'h2', 'h3', 'h4', 'span', 'div'])
+        title = None
+        
+        for candidate in title_candidates:
+            text = candidate.get_text(strip=True)
+            if text and 5 <= len(text) <= 200 and not any(x in text.lower() for x in ['تومان', 'ساعت', 'دقیقه']):
+                title = text
+                break
+        
+        if not title:
+            return None
+        
+        product['title'] = re.sub(r'\s+', ' ', title)
+        
+        # Extract price
+        price_elements = container.find_all(string=re.compile(r'تومان'))
+        price = "قیمت نامشخص"
+        
+        for price_elem in price_elements:
+            if price_elem and isinstance(price_elem, str):
+                price_text = price_elem.strip()
+                if 'تومان' in price_text and len(price_text) < 100:
+                    price = re.sub(r'\s+', ' ', price_text)
+                    break
+        
+        product['price'] = price
+        
+        # Extract image with better validation
+        img_element = container.find('img')
+        if img_element:
+            img_candidates = [
+                img_element.get('src'),
+                img_element.get('data-src'),
+                img_element.get('data-lazy-src'),
+                img_element.get('srcset'),
+                img_element.get('data-srcset')
+            ]
+            
+            for candidate in img_candidates:
+                if candidate and legacy_is_valid_image_url(candidate):
+                    # Clean srcset if needed
+                    if 'srcset' in str(candidate):
+                        # Extract first URL from srcset
+                        urls = re.findall(r'(https?://[^\s,]+)', candidate)
+                        if urls:
+                            candidate = urls[0]
+                    
+                    if candidate.startswith('//'):
+                        candidate = 'https:' + candidate
+                    elif candidate.startswith('/'):
+                        candidate = 'https://divar.ir' + candidate
+                    
+                    cleaned_url = legacy_clean_image_url(candidate)
+                    if cleaned_url:
+                        product['image_url'] = cleaned_url
+                        break
+        
+        # Extract meta information
+        meta_info = []
+        all_texts = container.find_all(string=True)
+        
+        for text in all_texts:
+            text = text.strip()
+            if text and 3 <= len(text) <= 30:
+                if any(indicator in text for indicator in ['در ', 'ساعت', 'دقیقه', 'نو', 'کارکرده']):
+                    if text not in meta_info:
+                        meta_info.append(text)
+                        if len(meta_info) >= 3:
+                            break
+        
+        product['meta'] = " | ".join(meta_info) if meta_info else "اطلاعات کامل در لینک موجود است"
+        
+        return product
+        
+    except Exception as e:
+        logger.error(f"Error in extract_product_from_container: {e}")
+        return None
+
+def legacy_extract_product_from_link(link_element):
+    """Extract product information from a product link element"""
+    product = {}
+    
+    try:
+        # Extract URL
+        href = link_element.get('href')
+        if href:
+            product['url'] = f"https://divar.ir{href}" if href.startswith('/') else href
+        
+        # Find the container that holds all product info
+        container = link_element
+        
+        # Extract title - look for h2 or the main title element
+        title_element = container.find('h2')
+        if not title_element:
+            title_element = container.find(['h1', 'h3', 'h4'])
+        if not title_element:
+            # Look for title in nested divs
+            title_element = container.find('div', string=True)
+        
+        if title_element:
+            title = title_element.get_text(strip=True)
+            # Clean title from extra characters
+            title = re.sub(r'\s+', ' ', title)
+            product['title'] = title
+        else:
+            return None
+        
+        # Extract price - look for elements containing "تومان"
+        price_elements = container.find_all(string=re.compile(r'تومان'))
+        price = "قیمت نامشخص"
+        
+        for price_elem in price_elements:
+            price_text = price_elem.strip()
+            if price_text and 'تومان' in price_text:
+                # Clean and format price
+                price = re.sub(r'\s+', ' ', price_text)
+                break
+        
+        product['price'] = price
+        
+        # Extract image
+        img_element = container.find('img')
+        if img_element:
+            img_src = img_element.get('src') or img_element.get('data-src') or img_element.get('data-lazy-src')
+            if img_src and legacy_is_valid_image_url(img_src):
+                # Make sure URL is complete and clean
+                if img_src.startswith('//'):
+                    img_src = 'https:' + img_src
+                elif img_src.startswith('/'):
+                    img_src = 'https://divar.ir' + img_src
+                
+                # Clean URL from invalid characters
+                img_src = legacy_clean_image_url(img_src)
+                if img_src:
+                    product['image_url'] = img_src
+        
+        # Extract metadata (location, time, etc.)
+        meta_info = []
+        
+        # Look for location and time info
+        text_elements = container.find_all(string=True)
+        for text in text_elements:
+            text = text.strip()
+            if text and len(text) > 2:
+                # Check if it's location info (contains "در")
+                if 'در ' in text and len(text) < 50:
+                    meta_info.append(text)
+                # Check if it's time info (contains time indicators)
+                elif any(word in text for word in ['ساعت', 'دقیقه', 'روز', 'هفته', 'ماه']) and len(text) < 30:
+                    meta_info.append(text)
+                # Check if it's condition info
+                elif any(word in text for word in ['نو', 'کارکرده', 'سالم', 'معاوضه']) and len(text) < 20:
+                    meta_info.append(text)
+        
+        # Remove duplicates and join
+        meta_info = list(dict.fromkeys(meta_info))  # Remove duplicates while preserving order
+        product['meta'] = " | ".join(meta_info[:3]) if meta_info else "اطلاعات کامل در لینک موجود است"
+        
+        return product
+        
+    except Exception as e:
+        logger.error(f"Error in extract_product_from_link: {e}")
+        return None
+
+def legacy_is_valid_image_url(url):
+    """Check if the image URL is valid for Telegram"""
+    if not url:
+        return False
+    
+    # Check for valid image extensions
+    valid_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
+    url_lower = url.lower()
+    
+    # Check if URL contains valid image indicators
+    if any(ext in url_lower for ext in valid_extensions):
+        return True
+    
+    # Check for common image hosting patterns
+    image_patterns = ['cdn', 'img', 'image', 'static', 'media']
+    if any(pattern in url_lower for pattern in image_patterns):
+        return True
+    
+    return False
+
+def legacy_clean_image_url(url):
+    """Clean and validate image URL for Telegram"""
+    if not url:
+        return None
+    
+    try:
+        # Remove invalid characters that Telegram doesn't accept
+        import urllib.parse
+        
+        # Parse URL to check if it's valid
+        parsed = urllib.parse.urlparse(url)
+        if not parsed.netloc:
+            return None
+        
+        # Reconstruct clean URL
+        clean_url = urllib.parse.urlunparse(parsed)
+        
+        # Additional validation
+        if len(clean_url) > 2048:  # Telegram URL limit
+            return None
+        
+        # Check for suspicious patterns
+        suspicious = ['javascript:', 'data:', 'blob:', 'file:']
+        if any(pattern in clean_url.lower() for pattern in suspicious):
+            return None
+        
+        return clean_url
+    
+    except Exception:
+        return None
+
+def legacy_is_valid_product(product):
+    """Check if extracted product data is valid"""
+    if not product.get('title'):
+        return False
+    
+    title = product['title'].lower()
+    
+    # Filter out service ads
+    invalid_keywords = [
+        'تعمیرکار', 'تعمیرات', 'نصب', 'سرویس', 'خدمات', 
+        'تعمیر', 'نگهداری', 'راه اندازی', 'پشتیبانی'
+    ]
+    
+    for keyword in invalid_keywords:
+        if keyword in title:
+            return False
+    
+    # Check if title is too short or too long
+    if len(product['title']) < 5 or len(product['title']) > 200:
+        return False
+    
+    return True
+
+
+def load_cards():
+    links, containers = [], []
+    for seed in range(3):
+        soup = BeautifulSoup(pages.link_page(seed), "html.parser")
+        links.extend(soup.find_all('a', href=bot.LISTING_HREF_RE))
+    soup = BeautifulSoup(pages.container_page(7), "html.parser")
+    containers.extend(soup.find_all(['article', 'div'], attrs={'class': bot.CARD_CLASS_RE}))
+    return links, containers
+
+
+def cards_per_second(func, cards, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for card in cards:
+            func(card)
+        best = min(best, time.perf_counter() - start)
+    return len(cards) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=7, help="timing rounds; the best round is reported")
+    args = parser.parse_args()
+
+    links, containers = load_cards()
+    cases = [
+        ("link", links, legacy_extract_product_from_link, bot.extract_product_from_link),
+        ("container", containers, legacy_extract_product_from_container, bot.extract_product_from_container),
+    ]
+
+    for name, cards, before, after in cases:
+        for card in cards:
+            expected, actual = before(card), after(card)
+            if actual:
+                actual.pop('price_value')  # added after the rewrite; the legacy extractors have no numeric price
+            assert expected == actual, f"{name} extractor output changed: {expected!r} != {actual!r}"
+            if expected:
+                assert legacy_is_valid_product(expected) == bot.is_valid_product(actual)
+
+        before_rate = cards_per_second(before, cards, args.repeat)
+        after_rate = cards_per_second(after, cards, args.repeat)
+        print(f"{name:<10} {len(cards):>4} cards  before {before_rate:>9.0f} cards/s  "
+              f"after {after_rate:>9.0f} cards/s  x{after_rate / before_rate:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""Offline benchmark suite: parsing, extraction, the structured-data path and end-to-end delivery.
+
+Everything runs against the recorded pages in ``benchmarks/corpus`` and the
+local stand-ins for divar.ir, the image CDN and the Telegram Bot API, so no
+network access is needed. Run from the repository root:
+
+    python benchmarks/bench_suite.py [--rounds N] [--save FILE] [--compare FILE]
+
+Each number is the median of ``--rounds`` timed rounds after a warm-up
+round. ``--save`` writes the results as JSON; ``--compare`` prints the
+change against such a file and exits with status 1 when a number got worse
+by more than ``--threshold`` percent. End-to-end runs lift the Telegram rate
+limits and start every search with empty caches.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+
+os.environ.setdefault("DIVAR_BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("DIVAR_LISTING_INDEX", "")  # no listing database in the working tree
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telebot  # noqa: E402
+
+import bot  # noqa: E402
+import servers  # noqa: E402
+from fake_telegram import BotAPI  # noqa: E402
+
+logging.disable(logging.WARNING)
+
+PRODUCT_METHODS = {"sendPhoto", "sendMediaGroup"}
+
+
+def median_rate(func, items, rounds):
+    """Median items/second of ``func(item)`` over all items"""
+    func(items[0])
+    rates = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for item in items:
+            func(item)
+        rates.append(len(items) / (time.perf_counter() - started))
+    return statistics.median(rates)
+
+
+def bench_parse(corpus, rounds):
+    pages = corpus["links"] + corpus["containers"]
+    backends = ["html.parser"] + (["lxml"] if bot._lxml_available() else [])
+    results = {}
+    for backend in backends:
+        for selective in (False, True):
+            name = f"parse.{backend}.{'selective' if selective else 'full'}"
+            rate = median_rate(lambda page: bot.parse_listing_page(page, backend, selective), pages, rounds)
+            results[name] = (rate, "pages/s", "higher")
+    return results
+
+
+def bench_extract(corpus, rounds):
+    results = {}
+    for kind in ("links", "containers"):
+        soups = [bot.parse_listing_page(page) for page in corpus[kind]]
+        products = sum(len(bot.extract_products(soup, 1000)) for soup in soups)
+        rate = median_rate(lambda soup: bot.extract_products(soup, 1000), soups, rounds)
+        results[f"extract.{kind}"] = (rate * products / len(soups), "products/s", "higher")
+    return results
+
+
+def bench_structured(corpus, rounds):
+    """Pages/s read through the embedded-JSON fast path vs parsing and walking the HTML of the same pages"""
+    pages = corpus["structured"]
+
+    def fast(page):
+        return list(bot.iter_structured_products(bot.extract_structured_listings(page), 1000))
+
+    def dom(page):
+        return bot.extract_products(bot.parse_listing_page(page), 1000)
+
+    results = {}
+    for name, func in (("json", fast), ("html", dom)):
+        results[f"structured.{name}"] = (median_rate(func, pages, rounds), "pages/s", "higher")
+    return results
+
+
+class CallRecorder:
+    """Collects Bot API calls per chat so each search can be timed separately"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}                  # chat_id -> [(time, method, params)]
+        self.done = {}                   # chat_id -> threading.Event
+
+    def watch(self, chat_id):
+        with self.lock:
+            self.calls[chat_id] = []
+            self.done[chat_id] = threading.Event()
+        return self.done[chat_id]
+
+    def __call__(self, method, params):
+        try:
+            chat_id = int(params.get("chat_id"))
+        except (TypeError, ValueError):
+            return
+        with self.lock:
+            if chat_id not in self.calls:
+                return
+            self.calls[chat_id].append((time.perf_counter(), method, params))
+            if params.get("text") == bot.MAIN_MENU_TEXT:
+                self.done[chat_id].set()
+
+
+def is_product_call(method, params):
+    if method in PRODUCT_METHODS:
+        return True
+    # Result cards, combined texts, or the result browser's first page
+    return method == "sendMessage" and ("📦 محصول" in params.get("text", "") or "rs_" in str(params.get("reply_markup")))
+
+
+E2E_QUERIES = (("links", "گوشی آیفون"), ("containers", "container-fallback"), ("structured", "structured-data"))
+
+
+def bench_end_to_end(recorder, rounds, count):
+    chat_ids = itertools.count(1)
+    results = {}
+    for mode in sorted(bot.DELIVERY_MODES):
+        for kind, query in E2E_QUERIES:
+            first, complete, calls = [], [], []
+            for round_number in range(rounds + 1):
+                bot.search_cache.clear()
+                bot.image_checker.clear()
+                chat_id = next(chat_ids)
+                done = recorder.watch(chat_id)
+                started = time.perf_counter()
+                bot.send_products(query, count, chat_id, "tehran", delivery_mode=mode)
+                if not done.wait(60):
+                    raise RuntimeError(f"search for {mode}/{kind} did not finish")
+                if not round_number:
+                    continue  # warm-up
+                chat_calls = recorder.calls[chat_id]
+                product_times = [at for at, method, params in chat_calls if is_product_call(method, params)]
+                first.append(((product_times[0] if product_times else chat_calls[-1][0]) - started) * 1000)
+                complete.append((chat_calls[-1][0] - started) * 1000)
+                calls.append(Counter(method for _, method, _ in chat_calls))
+
+            prefix = f"e2e.{mode}.{kind}"
+            results[f"{prefix}.first_listing"] = (statistics.median(first), "ms", "lower")
+            results[f"{prefix}.complete"] = (statistics.median(complete), "ms", "lower")
+            results[f"{prefix}.api_calls"] = (statistics.median(sum(c.values()) for c in calls), "calls", "lower")
+            for method in sorted(set().union(*calls)):
+                results[f"{prefix}.api_calls.{method}"] = (
+                    statistics.median(c[method] for c in calls), "calls", "lower")
+    return results
+
+
+def change(old, new):
+    """Percent change, positive when the number improved"""
+    if not old["value"]:
+        return 0.0
+    delta = (new["value"] - old["value"]) / old["value"] * 100
+    return delta if new["better"] == "higher" else 0.0 - delta
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=5, help="timed rounds per benchmark; the median is reported")
+    parser.add_argument("--results", type=int, default=20, help="results per end-to-end search")
+    parser.add_argument("--page-latency", type=float, default=0.05, help="seconds per Divar page")
+    parser.add_argument("--image-latency", type=float, default=0.01, help="seconds per image request")
+    parser.add_argument("--api-latency", type=float, default=0.005, help="seconds per Bot API call")
+    parser.add_argument("--only", choices=["parse", "extract", "structured", "e2e"], action="append",
+                        help="benchmarks to run")
+    parser.add_argument("--save", metavar="FILE", help="write the results to FILE as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare with a baseline saved earlier")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change reported as a regression")
+    args = parser.parse_args()
+    selected = set(args.only or ["parse", "extract", "structured", "e2e"])
+
+    corpus = servers.load_corpus()
+    if not corpus["links"] or not corpus["containers"] or not corpus["structured"]:
+        sys.exit(f"corpus in {servers.CORPUS_DIR} needs links-*, containers-* and structured-* pages "
+                 "(python benchmarks/record_corpus.py --synthetic)")
+
+    results = {}
+    if "parse" in selected:
+        results.update(bench_parse(corpus, args.rounds))
+    if "extract" in selected:
+        results.update(bench_extract(corpus, args.rounds))
+    if "structured" in selected:
+        results.update(bench_structured(corpus, args.rounds))
+    if "e2e" in selected:
+        recorder = CallRecorder()
+        api = BotAPI(latency=args.api_latency, on_call=recorder)
+        api.start()
+        telebot.apihelper.API_URL = api.url
+        bot.DIVAR_BASE_URL = servers.start_divar(servers.start_images(args.image_latency), args.page_latency,
+                                                 corpus)
+        bot.outbox = bot.OutboundSender(global_rate=1e9, global_burst=1e9, chat_rate=1e9, chat_burst=1e9)
+        results.update(bench_end_to_end(recorder, args.rounds, args.results))
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    regressions = 0
+    width = max(len(name) for name in results)
+    for name, (value, unit, better) in results.items():
+        line = f"{name:<{width}}  {value:>12.1f} {unit:<10}"
+        if name in baseline:
+            delta = change(baseline[name], {"value": value, "better": better})
+            flag = ""
+            if delta < -args.threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            line += f"  was {baseline[name]['value']:>12.1f}  {delta:+6.1f}%{flag}"
+        print(line)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({
+                "meta": {
+                    "saved_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "parser": bot.resolve_parser_backend(),
+                    "rounds": args.rounds,
+                },
+                "results": {name: {"value": value, "unit": unit, "better": better}
+                            for name, (value, unit, better) in results.items()},
+            }, f, indent=2)
+        print(f"saved {len(results)} results to {args.save}")
+
+    if regressions:
+        print(f"{regressions} result(s) worse than the baseline by more than {args.threshold:.0f}%")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
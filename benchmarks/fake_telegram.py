@@ -0,0 +1,198 @@
+"""Local stand-in for Telegram to exercise the bot's webhook mode.
+
+It serves a minimal Bot API that answers every method the bot calls, and
+plays a number of users through the search conversation by POSTing updates
+to the webhook, the same way Telegram would. Start the bot against it:
+
+    DIVAR_BOT_MODE=webhook DIVAR_WEBHOOK_PORT=8443 DIVAR_WEBHOOK_SECRET=s3cret \\
+    DIVAR_TELEGRAM_API_URL='http://127.0.0.1:8081/bot{0}/{1}' python bot.py
+
+then, from the repository root:
+
+    python benchmarks/fake_telegram.py --webhook http://127.0.0.1:8443/telegram \\
+        --secret s3cret --api-port 8081 --users 50 [--search]
+
+Without ``--search`` every conversation stops at the price filter step, so
+no request reaches Divar.
+"""
+import argparse
+import itertools
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Divar Bot", "username": "divar_bot"}
+TRUE_METHODS = {"answerCallbackQuery", "setWebhook", "deleteWebhook", "editMessageReplyMarkup"}
+
+
+class BotAPI:
+    """Records Bot API calls and answers them with minimal valid results.
+
+    ``latency`` delays every answer; ``on_call(method, params)`` sees each
+    call's parameters, whether sent as JSON or as a form.
+    """
+
+    def __init__(self, port=0, latency=0.0, on_call=None):
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.message_ids = itertools.count(1000)
+        self.on_call = on_call
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                path, _, query = self.path.partition("?")
+                method = path.rsplit("/", 1)[-1]
+                if api.on_call is not None:
+                    api.on_call(method, parse_params(self.headers.get("Content-Type", ""), raw, query))
+                if latency:
+                    time.sleep(latency)
+                body = json.dumps({"ok": True, "result": api.result(method)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}/bot{{0}}/{{1}}"
+
+    def result(self, method):
+        with self.lock:
+            self.calls[method] += 1
+            message_id = next(self.message_ids)
+        if method == "getMe":
+            return BOT_USER
+        if method in TRUE_METHODS:
+            return True
+        message = {"message_id": message_id, "date": int(time.time()),
+                   "chat": {"id": 1, "type": "private"}, "from": BOT_USER}
+        return [message] if method == "sendMediaGroup" else message
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+def parse_params(content_type, raw, query=""):
+    """Call parameters from the query string (how telebot sends most calls) and the body"""
+    params = {key: values[0] for key, values in parse_qs(query).items()}
+    if "json" in content_type:
+        params.update(json.loads(raw or b"{}"))
+    elif "urlencoded" in content_type:
+        params.update((key, values[0]) for key, values in parse_qs(raw.decode()).items())
+    return params
+
+
+class FakeUser:
+    """Builds the updates one user produces while going through a search."""
+
+    update_ids = itertools.count(1)
+
+    def __init__(self, user_id):
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        self.chat = {"id": user_id, "type": "private"}
+        self.message_ids = itertools.count(1)
+
+    def message(self, text):
+        message = {"message_id": next(self.message_ids), "date": int(time.time()),
+                   "chat": self.chat, "from": self.user, "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        return {"update_id": next(self.update_ids), "message": message}
+
+    def press(self, data):
+        message = {"message_id": next(self.message_ids), "date": int(time.time()),
+                   "chat": self.chat, "from": BOT_USER, "text": "..."}
+        return {"update_id": next(self.update_ids),
+                "callback_query": {"id": str(next(self.update_ids)), "from": self.user,
+                                   "chat_instance": str(self.user["id"]), "message": message,
+                                   "data": data}}
+
+    def conversation(self, query, search):
+        updates = [self.message("/start"), self.press("start_search"), self.message(query),
+                   self.press("count_5"), self.press("city_tehran")]
+        if search:
+            updates.append(self.press("search_no_price_filter"))
+        return updates
+
+
+def post(url, update, secret):
+    """POST one update and return (status, seconds until the webhook answered)."""
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), headers=headers)
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - started
+
+
+def run_user(user_id, args):
+    results = []
+    for update in FakeUser(user_id).conversation(args.query, args.search):
+        results.append(post(args.webhook, update, args.secret))
+        # Give the handler time to move the conversation to its next step
+        time.sleep(args.think)
+    return results
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--webhook", default="http://127.0.0.1:8443/telegram", help="the bot's webhook URL")
+    parser.add_argument("--secret", default="", help="value of X-Telegram-Bot-Api-Secret-Token")
+    parser.add_argument("--api-port", type=int, default=8081, help="port for the fake Bot API")
+    parser.add_argument("--users", type=int, default=20, help="users talking to the bot at once")
+    parser.add_argument("--query", default="گوشی آیفون")
+    parser.add_argument("--think", type=float, default=0.2, help="seconds between a user's updates")
+    parser.add_argument("--search", action="store_true", help="finish each conversation with a search")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds to wait for replies at the end")
+    args = parser.parse_args()
+
+    api = BotAPI(args.api_port)
+    api.start()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as executor:
+        runs = list(executor.map(lambda uid: run_user(uid, args), range(10_001, 10_001 + args.users)))
+    elapsed = time.perf_counter() - started
+    time.sleep(args.settle)
+
+    results = [result for run in runs for result in run]
+    latencies = [seconds * 1000 for _, seconds in results]
+    statuses = Counter(status for status, _ in results)
+    print(f"updates posted: {len(results)} in {elapsed:.2f}s from {args.users} users")
+    print(f"webhook status: {dict(statuses)}")
+    print(f"ack latency ms: p50={percentile(latencies, 0.5):.1f} p95={percentile(latencies, 0.95):.1f} "
+          f"max={max(latencies):.1f} mean={statistics.mean(latencies):.1f}")
+    print(f"bot api calls:  {dict(api.calls)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Synthetic Divar search pages shaped like the live markup.
+
+Used by the benchmarks so they run offline with deterministic input.
+"""
+import json
+import random
+
+FA_DIGITS = str.maketrans("0123456789", "۰۱۲۳۴۵۶۷۸۹")
+
+TITLES = [
+    "آیفون ۱۳ پرو ۲۵۶ گیگ", "گوشی سامسونگ گلکسی S21", "لپ تاپ ایسوس مدل X515",
+    "ماشین لباسشویی ال جی ۸ کیلویی", "یخچال ساید بای ساید", "تعمیرات تخصصی موبایل",
+    "دوچرخه کوهستان ۲۶", "مبل راحتی ۷ نفره", "کنسول پلی استیشن ۵", "ساعت هوشمند اپل واچ",
+]
+CONDITIONS = ["نو", "کارکرده", "در حد نو"]
+IMAGE_HOST = "https://s100.divarcdn.com"
+WHEN = ["لحظاتی پیش در ونک", "۲ ساعت پیش در پونک", "۳ روز پیش در تجریش", "نیم ساعت پیش در سعادت‌آباد"]
+
+
+def fa_number(n):
+    return f"{n:,}".replace(",", "٬").translate(FA_DIGITS)
+
+
+def listing(rng, seed, i, image_host=IMAGE_HOST):
+    """Fields of one random listing"""
+    title = rng.choice(TITLES) + (" " + fa_number(rng.randint(1, 99)) if rng.random() < .5 else "")
+    price_value = rng.randint(1, 900) * 100000 if rng.random() < .85 else None
+    image = f"{image_host}/static/thumbnails/{seed}{i}.jpg" if rng.random() < .8 else None
+    return {
+        "title": title,
+        "token": f"wX{seed}{i:03d}Ab",
+        "price_value": price_value,
+        "price": f"{fa_number(price_value)} تومان" if price_value else "توافقی",
+        "image": image,
+        "condition": rng.choice(CONDITIONS),
+        "when": rng.choice(WHEN),
+    }
+
+
+def link_card(rng, seed, i, image_host=IMAGE_HOST, item=None):
+    item = item or listing(rng, seed, i, image_host)
+    title, src, when = item["title"], item["image"], item["when"]
+    image = ""
+    if src:
+        image = (f'<div class="kt-post-card-thumbnail"><picture><img class="kt-image-block__image" '
+                 f'data-src="{src}" src="{src}" alt="{title}"/></picture></div>')
+    return (
+        f'<div class="post-list__widget-col-c1444"><div class="kt-post-card-wrapper">'
+        f'<a class="kt-post-card" href="/v/{title.replace(" ", "-")}/{item["token"]}">'
+        f'<article class="kt-post-card kt-post-card--outlined"><div class="kt-post-card__body">'
+        f'<h2 class="kt-post-card__title">{title}</h2>'
+        f'<div class="kt-post-card__description">{item["condition"]}</div>'
+        f'<div class="kt-post-card__description">{item["price"]}</div>'
+        f'<div class="kt-post-card__bottom"><span class="kt-post-card__bottom-description" title="{when}">{when}</span></div>'
+        f'</div>{image}</article></a></div></div>'
+    )
+
+
+def search_page(body, scripts=""):
+    categories = "".join(f'<li><a href="/s/tehran/c{k}">دسته {k}</a></li>' for k in range(40))
+    return (
+        '<!DOCTYPE html><html lang="fa" dir="rtl"><head><meta charset="utf-8"><title>دیوار</title>'
+        f'<script>window.dataLayer=[];</script>{scripts}<link rel="stylesheet" href="/static/a.css"></head>'
+        '<body><div id="app"><header class="kt-nav"><a href="/">دیوار</a><nav><a href="/s/tehran">تهران</a>'
+        '<div class="kt-nav-item">ثبت آگهی</div></nav></header><main><aside class="filters">'
+        f'<div class="kt-accordion-item">دسته‌ها</div><ul>{categories}</ul></aside>'
+        f'<div class="browse-post-list">{body}</div></main>'
+        f'<footer>{"<p>متن پاورقی</p>" * 30}</footer></div></body></html>'
+    )
+
+
+def link_page(seed, cards=48, image_host=IMAGE_HOST):
+    """Search page whose listings are ``<a href="/v/...">`` cards (extraction method 1)"""
+    rng = random.Random(seed)
+    return search_page("".join(link_card(rng, seed, i, image_host) for i in range(cards)))
+
+
+def structured_page(seed, cards=48, image_host=IMAGE_HOST):
+    """Link-card page that also embeds its listings as hydration state and JSON-LD, like the live site"""
+    rng = random.Random(seed)
+    items = [listing(rng, seed, i, image_host) for i in range(cards)]
+    state = {"browse": {"items": [
+        {"widget_type": "POST_ROW", "data": {
+            "title": item["title"],
+            "middle_description_text": item["price"],
+            "bottom_description_text": item["when"],
+            "image_url": item["image"] or "",
+            "action": {"type": "VIEW_POST", "payload": {"token": item["token"]}},
+        }} for item in items]}}
+    json_ld = {"@context": "https://schema.org", "@type": "ItemList", "itemListElement": [
+        {"@type": "ListItem", "position": i + 1, "item": {
+            "@type": "Product",
+            "name": item["title"],
+            "url": f'https://divar.ir/v/{item["title"].replace(" ", "-")}/{item["token"]}',
+            **({"image": item["image"]} if item["image"] else {}),
+            **({"offers": {"@type": "Offer", "price": item["price_value"] * 10, "priceCurrency": "IRR"}}
+               if item["price_value"] else {}),
+        }} for i, item in enumerate(items)]}
+    scripts = (f'<script type="application/ld+json">{json.dumps(json_ld, ensure_ascii=False)}</script>'
+               f'<script>window.__PRELOADED_STATE__ = {json.dumps(state, ensure_ascii=False)};</script>')
+    body = "".join(link_card(rng, seed, i, image_host, item) for i, item in enumerate(items))
+    return search_page(body, scripts)
+
+
+def container_page(seed, cards=30, image_host=IMAGE_HOST):
+    """Search page without listing links, handled by the container fallback (method 2)"""
+    rng = random.Random(seed)
+    body = []
+    for i in range(cards):
+        title = rng.choice(TITLES)
+        price = f"{fa_number(rng.randint(1, 900) * 100000)} تومان"
+        body.append(
+            f'<article class="post-card"><a href="/s/tehran/cat{i}">دسته</a><div class="post-card__info">'
+            f'<h3>{title}</h3><span>{price}</span><span>کارکرده</span><span>۱ ساعت پیش در ونک</span></div>'
+            f'<img srcset="{image_host}/static/photo/{seed}{i}.webp 1x, '
+            f'{image_host}/static/photo/{seed}{i}@2x.webp 2x"/></article>'
+        )
+    return f'<html><body><main>{"".join(body)}</main></body></html>'
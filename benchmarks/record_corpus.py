@@ -0,0 +1,79 @@
+"""Record Divar search pages into ``benchmarks/corpus`` for the offline benchmarks.
+
+    python benchmarks/record_corpus.py --live "گوشی آیفون" "لپ تاپ" [--city tehran] [--pages 2]
+    python benchmarks/record_corpus.py --synthetic
+
+``--live`` saves real result pages exactly as divar.ir served them, named
+by the extraction path the bot takes on them: ``structured-*`` for pages
+with embedded listing JSON, ``links-*`` for link cards and ``containers-*``
+for the container fallback. ``--synthetic`` regenerates the checked-in
+pages from ``pages.py``, which mimic the live markup.
+"""
+import argparse
+import os
+import re
+import sys
+
+os.environ.setdefault("DIVAR_BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("DIVAR_LISTING_INDEX", "")  # no listing database in the working tree
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+import pages  # noqa: E402
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+
+def slug(text):
+    return re.sub(r"[^\w]+", "-", text).strip("-").lower() or "query"
+
+
+def save(name, content):
+    path = os.path.join(CORPUS_DIR, name)
+    with open(path, "wb") as f:
+        f.write(content)
+    print(f"{path}: {len(content)} bytes")
+
+
+def record_live(queries, city, page_count):
+    for query in queries:
+        for page in range(1, page_count + 1):
+            response = bot.http_client.get(bot.build_search_url(query, city, page=page),
+                                           headers=bot.DIVAR_HEADERS, timeout=15)
+            response.raise_for_status()
+            if bot.extract_structured_listings(response.content) is not None:
+                kind = "structured"
+            elif bot.parse_listing_page(response.content).find('a', href=bot.LISTING_HREF_RE):
+                kind = "links"
+            else:
+                kind = "containers"
+            save(f"{kind}-{city}-{slug(query)}-p{page}.html", response.content)
+
+
+def record_synthetic():
+    for seed in range(4):
+        save(f"links-synthetic-{seed}.html", pages.link_page(seed).encode())
+    for seed in range(2):
+        save(f"containers-synthetic-{seed}.html", pages.container_page(seed).encode())
+    for seed in range(2):
+        save(f"structured-synthetic-{seed}.html", pages.structured_page(seed).encode())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--live", nargs="+", metavar="QUERY", help="search queries to record from divar.ir")
+    source.add_argument("--synthetic", action="store_true", help="regenerate the synthetic pages")
+    parser.add_argument("--city", default="tehran")
+    parser.add_argument("--pages", type=int, default=1, help="result pages per query")
+    args = parser.parse_args()
+
+    os.makedirs(CORPUS_DIR, exist_ok=True)
+    if args.synthetic:
+        record_synthetic()
+    else:
+        record_live(args.live, args.city, args.pages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Local stand-ins for divar.ir and its image CDN, used by the benchmarks.
+
+The Divar server answers ``/s/<city>?q=...&page=N`` either with a page from
+the recorded corpus or with a synthetic page from ``pages.py``. Image URLs
+in the served pages are rewritten to the local image host, which answers
+every HEAD or GET with a small JPEG. Both take a fixed latency per request.
+"""
+import glob
+import os
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pages
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+CDN_HOST = b"https://s100.divarcdn.com"
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def handle_error(self, request, client_address):
+        pass  # clients dropping keep-alive connections at exit
+
+
+def serve(handler):
+    """Start ``handler`` on a free local port; returns its base URL"""
+    server = QuietServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def load_corpus(corpus_dir=CORPUS_DIR):
+    """Recorded pages by kind: ``{"links": [...], "containers": [...], "structured": [...]}``, sorted by file name"""
+    corpus = {"links": [], "containers": [], "structured": []}
+    for path in sorted(glob.glob(os.path.join(corpus_dir, "*.html"))):
+        kind = os.path.basename(path).split("-", 1)[0]
+        with open(path, "rb") as f:
+            corpus.setdefault(kind, []).append(f.read())
+    return corpus
+
+
+def start_images(latency=0.0):
+    class Images(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            time.sleep(latency)
+            body = b"\xff\xd8\xff\xe0" + b"\x00" * 60
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if self.command == "GET":
+                self.wfile.write(body)
+
+        do_HEAD = do_GET
+
+        def log_message(self, format, *args):
+            pass
+
+    return serve(Images)
+
+
+def start_divar(image_host, latency=0.0, corpus=None):
+    """Serve search pages; queries starting with "container" or "structured" get those kinds of page.
+
+    With a ``corpus`` the page is picked from it by hashing the query and
+    page number; without one a synthetic page is generated from the same
+    hash, so different queries see different listings and images.
+    """
+    local_host = image_host.encode()
+
+    class Divar(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            params = parse_qs(urlsplit(self.path).query)
+            query = params.get("q", [""])[0]
+            seed = zlib.crc32(f"{query}/{params.get('page', ['1'])[0]}".encode())
+            if query.startswith("container"):
+                kind = "containers"
+            elif query.startswith("structured"):
+                kind = "structured"
+            else:
+                kind = "links"
+            if corpus is not None and corpus.get(kind):
+                choices = corpus[kind]
+                body = choices[seed % len(choices)]
+            elif kind == "containers":
+                body = pages.container_page(seed % 100000).encode()
+            elif kind == "structured":
+                body = pages.structured_page(seed % 100000).encode()
+            else:
+                body = pages.link_page(seed % 100000).encode()
+            body = body.replace(CDN_HOST, local_host)
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return serve(Divar)
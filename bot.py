@@ -2,18 +2,235 @@ import telebot
 import threading
 import logging
 import time
+import os
+import sys
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import quote_plus
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, NavigableString, SoupStrainer
+from urllib.parse import quote_plus, urlparse, urlsplit, urlunparse
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
 import re
+import heapq
+import itertools
+import random
+import queue
+import sqlite3
+import hmac
+import secrets
+import hashlib
+import json
+import asyncio
+import bisect
+import cProfile
+import io
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import aiohttp
+except ImportError:  # only needed for EXECUTION_MODE = "asyncio"
+    aiohttp = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Bot configuration
-BOT_TOKEN = "TELEGRAM_BOT_API_TOKEN"
+BOT_TOKEN = os.environ.get("DIVAR_BOT_TOKEN", "TELEGRAM_BOT_API_TOKEN")
 bot = telebot.TeleBot(BOT_TOKEN)
-user_states = {}
+if os.environ.get("DIVAR_TELEGRAM_API_URL"):  # e.g. a local fake Bot API, "http://127.0.0.1:8081/bot{0}/{1}"
+    telebot.apihelper.API_URL = os.environ["DIVAR_TELEGRAM_API_URL"]
+
+# Result delivery modes, selectable per user
+DELIVERY_MODES = {
+    "cards": "🗂 کارت به کارت",
+    "album": "🖼 آلبومی (سریع‌تر)",
+    "browser": "📑 یک پیام ورق‌زدنی (کم‌حجم)",
+}
+DEFAULT_DELIVERY_MODE = "cards"
+ALBUM_SIZE = 10               # Telegram allows 2-10 items per media group
+BROWSER_PAGE_SIZE = 5         # listings per page of the result browser
+RESULT_SET_TTL = 60 * 60      # seconds a browsable result set is kept after it was last viewed
+RESULT_SET_MAX = 2000         # result sets kept at most; the least recently viewed go first
+
+# Result order, selectable per user; any order but Divar's waits for all results before sending
+SORT_ORDERS = {
+    "relevance": "🔀 ترتیب دیوار",
+    "price_asc": "💰 ارزان‌ترین",
+    "price_desc": "💎 گران‌ترین",
+    "newest": "🕒 جدیدترین",
+}
+DEFAULT_SORT_ORDER = "relevance"
+
+# Where results come from, selectable per user; "index" answers from recently scraped listings when it can
+SEARCH_SOURCES = {
+    "live": "🌐 همیشه از دیوار",
+    "index": "⚡ از آگهی‌های تازه ذخیره‌شده",
+}
+DEFAULT_SEARCH_SOURCE = "live"
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Update ingestion configuration
+BOT_MODE = os.environ.get("DIVAR_BOT_MODE", "polling")  # "polling" or "webhook"
+WEBHOOK_LISTEN_HOST = os.environ.get("DIVAR_WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_LISTEN_PORT = int(os.environ.get("DIVAR_WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_URL = os.environ.get("DIVAR_WEBHOOK_URL", "")  # public https URL registered with Telegram, empty to leave it as is
+WEBHOOK_SECRET = os.environ.get("DIVAR_WEBHOOK_SECRET", "")  # compared with X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SSL_CERT = None       # certificate and key paths when not behind a TLS proxy
+WEBHOOK_SSL_KEY = None
+WEBHOOK_MAX_BODY = 1024 * 1024
+UPDATE_WORKERS = 8            # updates handled at the same time
+UPDATE_QUEUE_SIZE = 1000      # updates allowed to wait; beyond this Telegram is asked to retry
+
+# Metrics configuration
+METRICS_PORT = int(os.environ.get("DIVAR_METRICS_PORT", "0"))  # Prometheus endpoint at /metrics, 0 to disable
+METRICS_HOST = os.environ.get("DIVAR_METRICS_HOST", "127.0.0.1")
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # histogram bounds in seconds
+METRICS_QUANTILE_WINDOW = 1000  # recent spans per stage used for p50/p95/p99
+
+# Profiling configuration
+PROFILE_SEARCHES = int(os.environ.get("DIVAR_PROFILE_SEARCHES", "0"))  # searches profiled after startup
+PROFILE_DIR = os.environ.get("DIVAR_PROFILE_DIR", "profiles")  # per-search .prof and .txt reports
+PROFILE_MAX_SEARCHES = 20     # most searches one /profile command may arm
+PROFILE_TOP_FUNCTIONS = 40
+PROFILE_TOP_ALLOCATIONS = 25
+PROFILE_TRACE_FRAMES = 10     # stack depth kept per allocation
+ADMIN_USER_IDS = {int(user_id) for user_id in os.environ.get("DIVAR_ADMIN_IDS", "").split(",") if user_id.strip()}
+
+# Conversation state configuration
+STATE_BACKEND = "memory"      # "memory", or "sqlite" to keep conversations across restarts
+STATE_DB_PATH = "divar_bot_state.sqlite3"
+STATE_IDLE_TTL = 30 * 60      # seconds before an abandoned conversation is dropped
+USER_SETTINGS_TTL = 90 * 24 * 60 * 60  # seconds a user's result settings are kept after they were last used
+LAST_SEARCH_TTL = 24 * 60 * 60         # seconds a user's latest search can still be saved as a watch
+USER_RECORDS_MAX = 100000     # users kept at most per store; the least recently active go first
+
+# Search result cache configuration
+CACHE_TTL_SECONDS = 300
+CACHE_MAX_ENTRIES = 256
+CACHE_MAX_BYTES = 8 * 1024 * 1024
+CACHE_STALE_SECONDS = 30 * 60  # expired results kept this much longer, to be shown while Divar is failing
+
+# In-progress search coalescing
+SINGLE_FLIGHT_WAIT = 20       # seconds a search waits on an identical one before fetching itself
+
+# Local listing index configuration
+LISTING_INDEX_PATH = os.environ.get("DIVAR_LISTING_INDEX", "divar_bot_listings.sqlite3")  # empty to disable
+LISTING_INDEX_BATCH = 200     # listings written per transaction at most
+LISTING_INDEX_FLUSH_INTERVAL = 2  # seconds a partial batch waits before it is written
+LISTING_INDEX_FRESHNESS = 15 * 60  # the "index" source only answers with listings seen this recently
+LISTING_INDEX_MAX_AGE = 3 * 24 * 3600  # listings not seen again for this long are deleted
+LISTING_INDEX_MAX_ROWS = 100000  # oldest listings beyond this are deleted
+LISTING_INDEX_PRUNE_INTERVAL = 10 * 60
+
+# HTTP connection pool configuration
+HTTP_POOL_MAXSIZE = 10        # keep-alive connections per host by default
+HTTP_HOST_CONCURRENCY = 8     # simultaneous requests allowed per host
+HTTP_POOL_HOSTS = {           # per-host pool size overrides
+    "https://divar.ir": 16,
+    "https://s100.divarcdn.com": 32,
+}
+
+# Divar fetch resilience
+FETCH_CONNECT_TIMEOUT = 4     # seconds to connect to Divar
+FETCH_TIMEOUT = 10            # seconds to wait for a page once connected
+FETCH_MAX_ATTEMPTS = 3        # tries per page, the first included
+FETCH_DEADLINE = 20           # seconds after which a page is not retried any more
+FETCH_BACKOFF_BASE = 0.5      # pause before the first retry; doubles with each retry, with jitter
+FETCH_BACKOFF_MAX = 8         # longest pause between tries; a longer Retry-After is not waited out
+RETRY_BUDGET_RATIO = 0.2      # retries earned by each first attempt, shared by all searches
+RETRY_BUDGET_MIN_RATE = 0.5   # retries per second allowed on top, so a quiet bot can still retry
+RETRY_BUDGET_MAX = 20         # retries that can be saved up
+BREAKER_FAILURE_THRESHOLD = 5  # failed tries in a row that open the circuit breaker
+BREAKER_OPEN_SECONDS = 30     # seconds searches fail fast before one trial request is let through
+
+# Image validation configuration
+IMAGE_CHECK_WORKERS = 8       # concurrent HEAD requests per process
+IMAGE_CHECK_TIMEOUT = 5
+IMAGE_CHECK_LOOKAHEAD = 8     # products checked ahead of the one being sent
+IMAGE_VERDICT_CACHE_SIZE = 5000
+IMAGE_VERDICT_TTL = {         # seconds each verdict is trusted
+    "ok": 6 * 3600,
+    "bad_type": 6 * 3600,
+    "bad_status": 30 * 60,
+    "timeout": 5 * 60,
+    "error": 5 * 60,
+}
+
+# Execution model
+EXECUTION_MODE = "threads"    # "threads", or "asyncio" to run searches as coroutines on one event loop (needs aiohttp)
+ASYNC_PARSE_WORKERS = 4       # threads parsing pages for the event loop
+ASYNC_MAX_SEARCHES = 5000     # searches running at once in asyncio mode
+
+# Saved search (watch) configuration
+WATCH_DB_PATH = "divar_bot_watches.json"
+WATCH_INTERVAL = 10 * 60      # seconds between runs of one saved search
+WATCH_JITTER = 0.2            # runs are spread by up to this fraction of the interval
+WATCH_SHARE_WINDOW = 120      # seconds; identical searches due this close together share one fetch
+WATCH_WORKERS = 2
+WATCH_MAX_PER_USER = 5
+WATCH_FETCH_ITEMS = 30        # listings read per run
+WATCH_MAX_ALERTS = 10         # new listings sent per run at most
+WATCH_SEEN_LIMIT = 500        # listing tokens remembered per saved search
+
+# Search scheduler configuration
+SEARCH_WORKERS = 4            # searches delivered at the same time
+SEARCH_QUEUE_SIZE = 100       # searches allowed to wait for a worker
+SEARCH_REPLACE_POLICY = "replace"  # "replace": a new search cancels the user's previous one, "queue": waits behind it
+
+# Telegram outbound rate limits (https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this)
+TELEGRAM_GLOBAL_RATE = 30     # messages per second across all chats
+TELEGRAM_GLOBAL_BURST = 30
+TELEGRAM_CHAT_RATE = 1.0      # messages per second in one chat
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_SEND_WORKERS = 8     # API calls in flight at once
+TELEGRAM_MAX_RETRIES = 5      # retries of one message after 429 responses
+
+# Multi-page fetching configuration
+DIVAR_MAX_PAGES = 5           # result pages read at most per search
+DIVAR_PAGE_FANOUT = 3         # result pages fetched at the same time per search
+
+# Multi-city search configuration
+MULTI_CITY_MAX = 8            # cities one search may cover
+MULTI_CITY_CONCURRENCY = 4    # cities of one search fetched at the same time
+MULTI_CITY_WORKERS = 8        # city fetches running at once across all searches (threads mode)
+MULTI_CITY_MERGE = "round_robin"  # "round_robin" alternates between cities, "newest" orders by listing age
+
+# HTML parsing configuration
+PARSER_BACKEND = "fast"       # "html.parser", "lxml" or "fast" (fastest installed builder)
+PARSER_SELECTIVE = True       # build only listing links and card containers
+STRUCTURED_DATA = True        # read listings from the JSON embedded in the page before walking the HTML
+
+# Near-duplicate suppression
+NEAR_DUPLICATE_FILTER = True  # drop listings that look like reposts of one already in the results
+NEAR_DUPLICATE_MAX_DISTANCE = 8  # fingerprint bits (of 64) two listings may differ in and still count as one ad
+NEAR_DUPLICATE_WEIGHTS = {"trigram": 2, "image": 1}  # fingerprint feature weights; a shared photo alone never decides
+NEAR_DUPLICATE_PRICE_RATIO = 1.2  # listings whose prices differ by more than this ratio are different ads
+NEAR_DUPLICATE_FILLER_WORDS = frozenset({  # words reposts add or drop without changing the item
+    "تمیز", "سالم", "فوری", "عالی", "در", "حد", "نو", "اکبند", "گیگ", "گیگابایت", "کیلو", "کیلویی",
+})
+
+LISTING_HREF_RE = re.compile(r'/v/[^/]+')
+CARD_CLASS_RE = re.compile(r'post|item|card')
+
+DIVAR_BASE_URL = os.environ.get("DIVAR_BASE_URL", "https://divar.ir")  # search pages are fetched from here
+
+DIVAR_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
+    'Accept-Language': 'fa,en-US;q=0.9,en;q=0.8',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'none',
+    'Cache-Control': 'max-age=0'
+}
 
 # Iranian cities data for Divar
 CITIES_DATA = {
@@ -61,167 +278,2771 @@ CITIES_DATA = {
     "yasuj": "یاسوج"
 }
 
+# City groups offered in the multi-city picker: region -> (label, city codes)
+CITY_REGIONS = {
+    "capital": ("🏙️ تهران و حومه", ("tehran", "karaj", "eslamshahr", "qods", "varamin", "malard", "rey")),
+    "north": ("🌲 شمال", ("rasht", "sari", "amol", "gorgan")),
+    "south": ("🌴 جنوب", ("ahvaz", "abadan", "khorramshahr", "bushehr", "bandar-abbas")),
+    "west": ("⛰️ غرب", ("kermanshah", "hamadan", "sanandaj", "khorramabad", "ilam", "borujerd")),
+}
+
+class LatencyHistogram:
+    """Bucket counts, sum and a window of recent samples for one stage"""
+
+    __slots__ = ('counts', 'total', 'count', 'recent')
+
+    def __init__(self, buckets, window):
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=window)
+
+class Metrics:
+    """Process-wide counters and per-stage latency histograms, served by the metrics endpoint.
+
+    Stages are ``fetch`` (Divar GET), ``parse`` (BeautifulSoup), ``extract``,
+    ``image_check`` (HEAD request), ``image_wait`` (time a search waited for
+    a verdict), ``telegram_send`` (one product message; in asyncio mode
+    this includes waiting for the rate limiter) and ``search`` (a whole
+    search until its last message is queued). p50/p95/p99 are taken
+    over the last METRICS_QUANTILE_WINDOW spans of each stage.
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, buckets=METRICS_BUCKETS, window=METRICS_QUANTILE_WINDOW):
+        self.buckets = tuple(buckets)
+        self.window = window
+        self._histograms = {}            # stage -> LatencyHistogram
+        self._counters = {}              # (name, ((label, value), ...)) -> number
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = LatencyHistogram(self.buckets, self.window)
+            histogram.counts[index] += 1
+            histogram.total += seconds
+            histogram.count += 1
+            histogram.recent.append(seconds)
+
+    @contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def inc(self, name, value=1, **labels):
+        if not value:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def histograms(self):
+        """stage -> (cumulative bucket counts, sum, count, {quantile: seconds})"""
+        with self._lock:
+            snapshot = {stage: (list(h.counts), h.total, h.count, sorted(h.recent))
+                        for stage, h in self._histograms.items()}
+        result = {}
+        for stage, (counts, total, count, recent) in snapshot.items():
+            cumulative = list(itertools.accumulate(counts))
+            quantiles = {q: recent[min(len(recent) - 1, int(q * len(recent)))] for q in self.QUANTILES} if recent else {}
+            result[stage] = (cumulative, total, count, quantiles)
+        return result
+
+    def stats(self):
+        """p50/p95/p99 in milliseconds per stage, for logging"""
+        return {stage: {f"p{round(q * 100)}_ms": seconds * 1000 for q, seconds in quantiles.items()}
+                for stage, (_, _, _, quantiles) in self.histograms().items()}
+
+metrics = Metrics()
+
+class SearchTrace:
+    """Stage timings of one search: added to ``metrics`` and logged under the search's ID"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, query, city):
+        self.search_id = next(self._ids)
+        self.query = query
+        self.city = city
+        self.started = time.perf_counter()
+        self.stages = {}                 # stage -> [spans, seconds]
+        self.profile = None              # SearchProfile while the search is profiled
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        metrics.observe(stage, seconds)
+        with self._lock:
+            entry = self.stages.setdefault(stage, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+        logger.debug(f"Search #{self.search_id} {stage}: {seconds * 1000:.1f}ms")
+
+    @contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def timed(self, stage, func):
+        """``func`` wrapped so each call is recorded as a ``stage`` span"""
+        def timed_call(*args, **kwargs):
+            with self.span(stage):
+                return func(*args, **kwargs)
+        timed_call.__name__ = getattr(func, '__name__', 'call')
+        return timed_call
+
+    def finish(self, outcome, detail=""):
+        """Record the whole search under ``outcome`` and log its per-stage totals"""
+        seconds = time.perf_counter() - self.started
+        metrics.observe("search", seconds)
+        metrics.inc("searches_total", outcome=outcome)
+        with self._lock:
+            stages = ", ".join(f"{stage} {total * 1000:.0f}ms/{spans}"
+                               for stage, (spans, total) in self.stages.items())
+        logger.info(f"Search #{self.search_id} '{self.query}' in {self.city}: {outcome}"
+                    + (f", {detail}" if detail else "") + f" after {seconds:.2f}s"
+                    + (f" ({stages})" if stages else ""))
+
+class SearchProfile:
+    """CPU profile and allocation snapshots of one search.
+
+    cProfile only sees the thread it is enabled on, so work the search hands
+    to other threads (page download and parsing) runs through ``wrap`` with
+    a profiler of its own; all of them are merged in the report.
+    tracemalloc is process-wide, so allocations made by searches running
+    at the same time show up too.
+    """
+
+    def __init__(self, trace):
+        self.trace = trace
+        self._profilers = []
+        self._own = None
+        self._lock = threading.Lock()
+        self._started_tracing = False
+        self._start_snapshot = None
+        self._largest = None             # (traced bytes, snapshot) at the fullest checkpoint
+
+    def start(self, this_thread=True):
+        """Start allocation tracking, and CPU profiling of the calling thread if ``this_thread``"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_TRACE_FRAMES)
+            self._started_tracing = True
+        tracemalloc.reset_peak()
+        self._start_snapshot = tracemalloc.take_snapshot()
+        if this_thread:
+            self._own = self._enable()
+
+    def _enable(self):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:  # Python 3.12+ runs one cProfile at a time
+            logger.warning(f"Search #{self.trace.search_id}: profiler unavailable on this thread: {e}")
+            return None
+        return profiler
+
+    def _collect(self, profiler):
+        if profiler is not None:
+            profiler.disable()
+            with self._lock:
+                self._profilers.append(profiler)
+
+    def wrap(self, func):
+        """``func`` wrapped to run under a profiler on whichever thread calls it"""
+        def profiled(*args, **kwargs):
+            profiler = self._enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._collect(profiler)
+        return profiled
+
+    def checkpoint(self):
+        """Snapshot allocations while a page's tree and products are alive, keeping the fullest one"""
+        traced, _ = tracemalloc.get_traced_memory()
+        with self._lock:
+            if self._largest is not None and self._largest[0] >= traced:
+                return
+        snapshot = tracemalloc.take_snapshot()
+        with self._lock:
+            if self._largest is None or self._largest[0] < traced:
+                self._largest = (traced, snapshot)
+
+    def finish(self, directory):
+        """Stop profiling and write ``.prof`` (pstats) and ``.txt`` reports; returns their paths"""
+        self._collect(self._own)
+        _, peak = tracemalloc.get_traced_memory()
+        end_snapshot = self._largest[1] if self._largest is not None else tracemalloc.take_snapshot()
+        if self._started_tracing:
+            tracemalloc.stop()
+
+        os.makedirs(directory, exist_ok=True)
+        trace = self.trace
+        base = os.path.join(directory, f"search-{trace.search_id}-{time.strftime('%Y%m%d-%H%M%S')}")
+        report = io.StringIO()
+        report.write(f"Search #{trace.search_id} '{trace.query}' in {trace.city}, "
+                     f"{time.perf_counter() - trace.started:.2f}s, {len(self._profilers)} thread(s) profiled\n\n")
+
+        if self._profilers:
+            stats = pstats.Stats(*self._profilers, stream=report)
+            stats.dump_stats(base + ".prof")
+            report.write(f"== CPU, top {PROFILE_TOP_FUNCTIONS} functions by cumulative time ==\n")
+            stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+
+        # Only allocations made on a call path through this module
+        own_code = [tracemalloc.Filter(True, __file__, all_frames=True)]
+        allocations = end_snapshot.filter_traces(own_code).compare_to(
+            self._start_snapshot.filter_traces(own_code), "traceback")
+        report.write(f"== Allocations, top {PROFILE_TOP_ALLOCATIONS} call paths (peak traced memory "
+                     f"{peak / 1024:.0f} KiB) ==\n")
+        for stat in allocations[:PROFILE_TOP_ALLOCATIONS]:
+            report.write(f"\n{stat.size_diff / 1024:+.1f} KiB in {stat.count_diff:+d} blocks\n")
+            report.write("\n".join(stat.traceback.format(most_recent_first=True)) + "\n")
+
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(report.getvalue())
+        return [path for path in (base + ".prof", base + ".txt") if os.path.exists(path)]
+
+class SearchProfiler:
+    """Runs the next N searches under ``SearchProfile``, one at a time.
+
+    Armed at startup by PROFILE_SEARCHES or at run time by the admin
+    /profile command. While nothing is armed, ``claim`` reads one attribute
+    and returns.
+    """
+
+    def __init__(self, remaining=PROFILE_SEARCHES, directory=PROFILE_DIR):
+        self.remaining = remaining
+        self.directory = directory
+        self.active = None
+        self.profiled = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def arm(self, count):
+        with self._lock:
+            self.remaining = max(count, 0)
+
+    def claim(self, trace, this_thread=True):
+        """A started ``SearchProfile`` for ``trace`` if profiling is armed, else None"""
+        if not self.remaining:
+            return None
+        with self._lock:
+            if not self.remaining or self.active is not None:
+                return None
+            self.remaining -= 1
+            self.active = profile = SearchProfile(trace)
+        try:
+            profile.start(this_thread)
+        except Exception as e:
+            logger.error(f"Error starting profiler for search #{trace.search_id}: {e}")
+            with self._lock:
+                self.active = None
+                self.failed += 1
+            return None
+        return profile
+
+    def finish(self, profile):
+        try:
+            paths = profile.finish(self.directory)
+            logger.info(f"Search #{profile.trace.search_id} profile written to {', '.join(paths)}")
+            with self._lock:
+                self.profiled += 1
+        except Exception as e:
+            logger.error(f"Error writing profile for search #{profile.trace.search_id}: {e}")
+            with self._lock:
+                self.failed += 1
+        finally:
+            with self._lock:
+                self.active = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "armed": self.remaining,
+                "active": int(self.active is not None),
+                "profiled": self.profiled,
+                "failed": self.failed,
+            }
+
+search_profiler = SearchProfiler()
+
+class SessionState:
+    """Compact per-user conversation record with a fixed set of fields"""
+
+    __slots__ = ('step', 'product_name', 'count', 'city', 'min_price', 'max_price', 'touched')
+
+    FIELDS = ('step', 'product_name', 'count', 'city', 'min_price', 'max_price')
+
+    def __init__(self, step=None, product_name=None, count=None, city=None, min_price=None, max_price=None, touched=None):
+        self.step = step
+        self.product_name = product_name
+        self.count = count
+        self.city = city
+        self.min_price = min_price
+        self.max_price = max_price
+        self.touched = time.time() if touched is None else touched
+
+    def copy(self):
+        return SessionState(*(getattr(self, field) for field in self.FIELDS), touched=self.touched)
+
+class ConversationStore:
+    """Thread-safe store of in-progress conversations with idle expiry.
+
+    Sessions idle for longer than ``idle_ttl`` are dropped. With the
+    ``sqlite`` backend every change is also written to ``db_path`` and live
+    sessions are reloaded on start, so a restart does not lose them.
+    """
+
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, backend=STATE_BACKEND, db_path=STATE_DB_PATH, idle_ttl=STATE_IDLE_TTL):
+        if backend not in ("memory", "sqlite"):
+            raise ValueError(f"Unknown state backend: {backend}")
+        self.backend = backend
+        self.idle_ttl = idle_ttl
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._swept_at = time.time()
+        self._db = None
+        self.expired = 0
+
+        if backend == "sqlite":
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, step TEXT, product_name TEXT, "
+                "count INTEGER, city TEXT, min_price INTEGER, max_price INTEGER, touched REAL NOT NULL)"
+            )
+            self._db.execute("DELETE FROM sessions WHERE touched < ?", (time.time() - idle_ttl,))
+            self._db.commit()
+            rows = self._db.execute(
+                "SELECT user_id, step, product_name, count, city, min_price, max_price, touched FROM sessions"
+            )
+            for row in rows:
+                self._sessions[row[0]] = SessionState(*row[1:])
+
+    def _persist(self, user_id, state):
+        if self._db is None:
+            return
+        if state is None:
+            self._db.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+        else:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, state.step, state.product_name, state.count, state.city,
+                 state.min_price, state.max_price, state.touched)
+            )
+        self._db.commit()
+
+    def _live(self, user_id, now):
+        state = self._sessions.get(user_id)
+        if state is not None and now - state.touched > self.idle_ttl:
+            del self._sessions[user_id]
+            self._persist(user_id, None)
+            self.expired += 1
+            return None
+        return state
+
+    def _maybe_sweep(self, now):
+        if now - self._swept_at < self.SWEEP_INTERVAL:
+            return
+        self._swept_at = now
+        stale = [user_id for user_id, state in self._sessions.items() if now - state.touched > self.idle_ttl]
+        for user_id in stale:
+            del self._sessions[user_id]
+        if stale:
+            self.expired += len(stale)
+            if self._db is not None:
+                self._db.execute("DELETE FROM sessions WHERE touched < ?", (now - self.idle_ttl,))
+                self._db.commit()
+
+    def get(self, user_id):
+        """Copy of the user's session, or None if there is none"""
+        with self._lock:
+            state = self._live(user_id, time.time())
+            return state.copy() if state is not None else None
+
+    def step(self, user_id):
+        with self._lock:
+            state = self._live(user_id, time.time())
+            return state.step if state is not None else None
+
+    def start(self, user_id, step):
+        """Begin a fresh conversation at ``step``"""
+        with self._lock:
+            self._sessions.pop(user_id, None)
+        self.update(user_id, step=step)
+
+    def update(self, user_id, **fields):
+        """Set session fields, creating the session if needed"""
+        now = time.time()
+        with self._lock:
+            self._maybe_sweep(now)
+            state = self._live(user_id, now)
+            if state is None:
+                state = self._sessions[user_id] = SessionState(touched=now)
+            for field, value in fields.items():
+                if field not in SessionState.FIELDS:
+                    raise AttributeError(f"Unknown session field: {field}")
+                setattr(state, field, value)
+            state.touched = now
+            self._persist(user_id, state)
+
+    def discard(self, user_id):
+        with self._lock:
+            if self._sessions.pop(user_id, None) is not None:
+                self._persist(user_id, None)
+
+    def stats(self):
+        """Live session count and approximate memory used by the records"""
+        with self._lock:
+            self._maybe_sweep(time.time())
+            record_size = sum(sys.getsizeof(state) for state in self._sessions.values())
+            return {
+                "backend": self.backend,
+                "live_sessions": len(self._sessions),
+                "memory_bytes": sys.getsizeof(self._sessions) + record_size,
+                "expired": self.expired,
+            }
+
+state_store = ConversationStore()
+
+class UserRecordStore:
+    """Thread-safe per-user records with idle expiry.
+
+    A record is dropped ``ttl`` seconds after it was last read or written,
+    and beyond ``max_users`` the least recently used records go first.
+    """
+
+    def __init__(self, ttl, max_users=USER_RECORDS_MAX):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._records = OrderedDict()    # user_id -> [value, expires_at], least recently used first
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+
+    def _sweep(self, now):
+        while self._records:
+            user_id, record = next(iter(self._records.items()))
+            if record[1] > now:
+                break
+            del self._records[user_id]
+            self.expired += 1
+
+    def get(self, user_id, default=None):
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            record = self._records.get(user_id)
+            if record is None:
+                return default
+            record[1] = now + self.ttl
+            self._records.move_to_end(user_id)
+            return record[0]
+
+    def _put(self, user_id, value):
+        now = time.monotonic()
+        self._sweep(now)
+        self._records[user_id] = [value, now + self.ttl]
+        self._records.move_to_end(user_id)
+        while len(self._records) > self.max_users:
+            self._records.popitem(last=False)
+            self.evicted += 1
+
+    def put(self, user_id, value):
+        with self._lock:
+            self._put(user_id, value)
+
+    def update(self, user_id, **fields):
+        """Set fields of a dict record, creating it if needed; readers keep the dict they already got"""
+        with self._lock:
+            self._sweep(time.monotonic())
+            record = self._records.get(user_id)
+            self._put(user_id, {**(record[0] if record is not None else {}), **fields})
+
+    def stats(self):
+        with self._lock:
+            self._sweep(time.monotonic())
+            return {"users": len(self._records), "expired": self.expired, "evicted": self.evicted}
+
+user_settings = UserRecordStore(USER_SETTINGS_TTL)  # user_id -> {"delivery_mode": ..., "sort_order": ..., ...}
+last_searches = UserRecordStore(LAST_SEARCH_TTL)    # user_id -> (product_name, city, min_price, max_price)
+
+class ResultSet:
+    """One search's results as shown by the result browser"""
+
+    __slots__ = ('chat_id', 'query', 'city', 'products', 'expires_at')
+
+    def __init__(self, chat_id, query, city, products, expires_at):
+        self.chat_id = chat_id
+        self.query = query
+        self.city = city
+        self.products = products
+        self.expires_at = expires_at
+
+    def pages(self):
+        return max(1, -(-len(self.products) // BROWSER_PAGE_SIZE))
+
+class ResultSetStore:
+    """Thread-safe store of browsable result sets under short random IDs.
+
+    A result set expires ``ttl`` seconds after it was last viewed, and only
+    the chat it was sent to can view it. Beyond ``max_sets`` the least
+    recently viewed sets are dropped.
+    """
+
+    def __init__(self, ttl=RESULT_SET_TTL, max_sets=RESULT_SET_MAX):
+        self.ttl = ttl
+        self.max_sets = max_sets
+        self._sets = OrderedDict()       # result_id -> ResultSet, least recently viewed first
+        self._lock = threading.Lock()
+        self.created = 0
+        self.views = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def _sweep(self, now):
+        while self._sets:
+            result_id, result_set = next(iter(self._sets.items()))
+            if result_set.expires_at > now:
+                break
+            del self._sets[result_id]
+            self.expired += 1
+
+    def put(self, chat_id, query, city, products):
+        """Keep ``products`` for ``chat_id``; returns the new result set's ID"""
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            result_id = secrets.token_hex(4)
+            while result_id in self._sets:
+                result_id = secrets.token_hex(4)
+            self._sets[result_id] = ResultSet(chat_id, query, city, [dict(product) for product in products],
+                                              now + self.ttl)
+            self.created += 1
+            while len(self._sets) > self.max_sets:
+                self._sets.popitem(last=False)
+                self.evicted += 1
+            return result_id
+
+    def get(self, result_id, chat_id):
+        """The result set if it is still kept and belongs to ``chat_id``, else None"""
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            result_set = self._sets.get(result_id)
+            if result_set is None or result_set.chat_id != chat_id:
+                self.misses += 1
+                return None
+            result_set.expires_at = now + self.ttl
+            self._sets.move_to_end(result_id)
+            self.views += 1
+            return result_set
+
+    def stats(self):
+        with self._lock:
+            self._sweep(time.monotonic())
+            return {
+                "kept": len(self._sets),
+                "created": self.created,
+                "views": self.views,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+result_sets = ResultSetStore()
+
+class SearchCache:
+    """Thread-safe TTL/LRU cache for scraped search results.
+
+    Entries are keyed on the normalized (query, city, min_price, max_price)
+    tuple and evicted by age, entry count and approximate memory size. A
+    result cached for a larger ``max_items`` also answers smaller requests.
+    Expired entries are kept ``stale_ttl`` seconds longer for ``get_stale``.
+    """
+
+    def __init__(self, ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES,
+                 stale_ttl=CACHE_STALE_SECONDS):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, max_items, products, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale_hits = 0
+
+    @staticmethod
+    def make_key(query, city, min_price=None, max_price=None):
+        """Normalize search parameters so equivalent searches share an entry"""
+        normalized_query = " ".join(str(query or "").split()).lower()
+        normalized_city = (city or "tehran").strip().lower()
+        return (
+            normalized_query,
+            normalized_city,
+            int(min_price) if min_price is not None else None,
+            int(max_price) if max_price is not None else None,
+        )
+
+    @staticmethod
+    def _estimate_size(products):
+        """Rough memory footprint of a product list in bytes"""
+        size = sys.getsizeof(products)
+        for product in products:
+            size += sys.getsizeof(product)
+            for key, value in product.items():
+                size += sys.getsizeof(key) + sys.getsizeof(value)
+        return size
+
+    def get(self, key, max_items):
+        """Return up to ``max_items`` cached products, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, cached_max_items, products, size = entry
+            now = time.monotonic()
+            if expires_at <= now:
+                if expires_at + self.stale_ttl <= now:
+                    self._remove(key)
+                    self.expirations += 1
+                self.misses += 1
+                return None
+
+            if cached_max_items < max_items:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return [dict(product) for product in products[:max_items]]
+
+    def put(self, key, max_items, products):
+        """Store a result list, keeping the larger of two overlapping results"""
+        products = [dict(product) for product in products]
+        size = self._estimate_size(products)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            existing = self._entries.get(key)
+            if existing and existing[0] > time.monotonic() and existing[1] > max_items:
+                self._entries.move_to_end(key)
+                return
+
+            if existing:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic() + self.ttl, max_items, products, size)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def get_stale(self, key, max_items):
+        """Up to ``max_items`` products of an entry, even one expired less than ``stale_ttl`` ago; None if none"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] + self.stale_ttl <= time.monotonic():
+                return None
+            self.stale_hits += 1
+            return [dict(product) for product in entry[2][:max_items]]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry[3]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Snapshot of cache counters for logging and metrics"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "stale_hits": self.stale_hits,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+search_cache = SearchCache()
+
+class SingleFlight:
+    """Coalesces identical searches that are in progress at the same time.
+
+    The first caller for a search key becomes the leader and fetches. Callers
+    arriving before it finishes, and wanting no more results than it does,
+    wait on the leader's Future instead of fetching the same pages. The
+    Future resolves to the leader's products or to its exception, or to None
+    if the leader stopped early; waiters then join once more, so one of them
+    takes over the fetch. A waiter gives up after ``wait`` seconds and
+    fetches on its own.
+    """
+
+    def __init__(self, wait=SINGLE_FLIGHT_WAIT):
+        self.wait = wait
+        self._flights = {}               # key -> (max_items, Future)
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.saved_fetches = 0
+        self.shared_errors = 0
+        self.timeouts = 0
+        self.abandoned = 0
+
+    def join(self, key, max_items):
+        """Returns (future, is_leader); future is None when the caller must fetch alone"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                future = Future()
+                self._flights[key] = (max_items, future)
+                self.leaders += 1
+                return future, True
+            if flight[0] >= max_items:
+                return flight[1], False
+            # A smaller identical search is running; its results would not be enough
+            return None, False
+
+    def finish(self, key, future, products=None, error=None):
+        """Called by the leader: publish its products, or its error, to the waiters"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight[1] is future:
+                del self._flights[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(products)
+
+    def _outcome(self, future):
+        error = future.exception(timeout=0)
+        with self._lock:
+            if error is not None:
+                self.shared_errors += 1
+                raise error
+            products = future.result(timeout=0)
+            if products is None:
+                self.abandoned += 1
+            else:
+                self.saved_fetches += 1
+            return products
+
+    def _timed_out(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def result(self, future):
+        """Wait for the leader; returns its products, or None to fetch alone"""
+        try:
+            future.exception(timeout=self.wait)
+        except FutureTimeoutError:  # only an alias of the builtin TimeoutError from Python 3.11
+            self._timed_out()
+            return None
+        return self._outcome(future)
+
+    async def result_async(self, future):
+        """Like ``result`` but awaits the leader from the event loop"""
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.wait)
+        except asyncio.TimeoutError:
+            self._timed_out()
+            return None
+        except Exception:
+            pass  # delivered by _outcome below
+        return self._outcome(future)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_progress": len(self._flights),
+                "leaders": self.leaders,
+                "saved_fetches": self.saved_fetches,
+                "shared_errors": self.shared_errors,
+                "timeouts": self.timeouts,
+                "abandoned": self.abandoned,
+            }
+
+search_flights = SingleFlight()
+
+# Letter variants a title may be typed with fold to one form; diacritics and tatweel are dropped
+SEARCH_TEXT_TRANSLATION = str.maketrans({
+    "ي": "ی", "ى": "ی", "ئ": "ی", "ك": "ک", "ة": "ه", "ۀ": "ه", "آ": "ا", "أ": "ا", "إ": "ا", "ٱ": "ا", "ؤ": "و",
+    **{digit: str(value) for value, digit in enumerate("۰۱۲۳۴۵۶۷۸۹")},
+    **{digit: str(value) for value, digit in enumerate("٠١٢٣٤٥٦٧٨٩")},
+    **{chr(mark): None for mark in range(0x064B, 0x0653)}, "\u0670": None, "ـ": None,
+    "\u200c": " ",
+})
+
+def normalize_search_text(text):
+    """Lower-cased text with Persian/Arabic letter variants, digits and half-spaces folded, for matching titles"""
+    return " ".join(str(text or "").translate(SEARCH_TEXT_TRANSLATION).lower().split())
+
+class ListingIndex:
+    """Local SQLite store of scraped listings with a full-text index on titles.
+
+    ``add`` only queues a listing; a background thread writes the queue in
+    transactions of up to ``batch`` rows at least every ``flush_interval``
+    seconds, keeping each listing's first-seen time and refreshing its
+    details and last-seen time. Titles are indexed with FTS5, or matched
+    with LIKE where SQLite is built without it. ``search`` answers only from
+    listings seen within ``freshness`` seconds, and only when they fill the
+    request. Listings unseen for ``max_age`` seconds are deleted, and so are
+    the least recently seen beyond ``max_rows``. An empty ``path`` disables
+    the index.
+    """
+
+    COLUMNS = ("token", "city", "title", "search_title", "price", "price_value", "meta", "url", "image_url",
+               "first_seen", "last_seen")
+    # A nationwide ("iran") search does not overwrite the specific city a listing was found in before
+    UPSERT = (f"INSERT INTO listings ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))}) "
+              "ON CONFLICT (token) DO UPDATE SET "
+              "city = CASE WHEN excluded.city = 'iran' THEN listings.city ELSE excluded.city END, "
+              + ", ".join(f"{column} = excluded.{column}" for column in COLUMNS
+                          if column not in ("token", "city", "first_seen")))
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS listing_titles USING fts5(search_title, content='listings', content_rowid='id');
+        CREATE TRIGGER IF NOT EXISTS listing_titles_insert AFTER INSERT ON listings BEGIN
+            INSERT INTO listing_titles (rowid, search_title) VALUES (new.id, new.search_title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS listing_titles_delete AFTER DELETE ON listings BEGIN
+            INSERT INTO listing_titles (listing_titles, rowid, search_title) VALUES ('delete', old.id, old.search_title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS listing_titles_update AFTER UPDATE OF search_title ON listings
+        WHEN old.search_title <> new.search_title BEGIN
+            INSERT INTO listing_titles (listing_titles, rowid, search_title) VALUES ('delete', old.id, old.search_title);
+            INSERT INTO listing_titles (rowid, search_title) VALUES (new.id, new.search_title);
+        END;
+    """
+
+    def __init__(self, path=LISTING_INDEX_PATH, batch=LISTING_INDEX_BATCH, flush_interval=LISTING_INDEX_FLUSH_INTERVAL,
+                 freshness=LISTING_INDEX_FRESHNESS, max_age=LISTING_INDEX_MAX_AGE, max_rows=LISTING_INDEX_MAX_ROWS,
+                 prune_interval=LISTING_INDEX_PRUNE_INTERVAL):
+        self.path = path
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.freshness = freshness
+        self.max_age = max_age
+        self.max_rows = max_rows
+        self.prune_interval = prune_interval
+        self.fts = False
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._pending = []               # rows waiting for the writer
+        self._thread = None
+        self._pruned_at = time.time()
+        self.queued = 0
+        self.written = 0
+        self.write_errors = 0
+        self.dropped = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def _connect(self):
+        """The open database, created on first use; call with ``_db_lock`` held"""
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS listings (id INTEGER PRIMARY KEY, token TEXT NOT NULL UNIQUE, "
+                "city TEXT NOT NULL, title TEXT NOT NULL, search_title TEXT NOT NULL, price TEXT, price_value INTEGER, "
+                "meta TEXT, url TEXT, image_url TEXT, first_seen REAL NOT NULL, last_seen REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS listings_city_seen ON listings (city, last_seen)")
+            db.execute("CREATE INDEX IF NOT EXISTS listings_seen ON listings (last_seen)")
+            try:
+                db.executescript(self.FTS_SCHEMA)
+                self.fts = True
+            except sqlite3.OperationalError as e:
+                logger.warning(f"SQLite has no FTS5 ({e}); listing titles are matched with LIKE")
+            db.commit()
+            self._db = db
+        return self._db
+
+    def add(self, product, city, seen_at=None):
+        """Queue one scraped product for writing; products without a listing token are skipped"""
+        token = listing_token(product.get('url')) if self.path else None
+        if token is None:
+            return
+        seen_at = seen_at or time.time()
+        row = (token, city, product['title'], normalize_search_text(product['title']), product.get('price'),
+               product.get('price_value'), product.get('meta'), product['url'], product.get('image_url'),
+               seen_at, seen_at)
+        with self._cond:
+            self._pending.append(row)
+            self.queued += 1
+            overflow = len(self._pending) - self.batch * 50
+            if overflow > 0:
+                # The writer is far behind (a locked or full disk); keep the newest listings
+                del self._pending[:overflow]
+                self.dropped += overflow
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="listing-index", daemon=True)
+                self._thread.start()
+            elif len(self._pending) >= self.batch:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._pending) < self.batch:
+                    self._cond.wait(self.flush_interval)
+                rows = self._pending[:self.batch]
+                del self._pending[:self.batch]
+            if rows:
+                self._write(rows)
+            if time.time() - self._pruned_at >= self.prune_interval:
+                self.prune()
+
+    def _write(self, rows):
+        started = time.perf_counter()
+        try:
+            with self._db_lock:
+                db = self._connect()
+                with db:
+                    db.executemany(self.UPSERT, rows)
+        except sqlite3.Error as e:
+            self.write_errors += len(rows)
+            logger.error(f"Could not write {len(rows)} listings to {self.path}: {e}")
+            return
+        self.written += len(rows)
+        metrics.observe("index_write", time.perf_counter() - started)
+
+    def prune(self):
+        """Delete listings unseen for ``max_age`` seconds, then the least recently seen beyond ``max_rows``"""
+        self._pruned_at = time.time()
+        try:
+            with self._db_lock:
+                db = self._connect()
+                with db:
+                    expired = db.execute("DELETE FROM listings WHERE last_seen < ?",
+                                         (self._pruned_at - self.max_age,)).rowcount
+                    excess = db.execute("SELECT COUNT(*) FROM listings").fetchone()[0] - self.max_rows
+                    evicted = 0
+                    if excess > 0:
+                        evicted = db.execute(
+                            "DELETE FROM listings WHERE id IN (SELECT id FROM listings ORDER BY last_seen LIMIT ?)",
+                            (excess,)).rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Could not prune the listing index {self.path}: {e}")
+            return
+        self.expired += expired
+        self.evicted += evicted
+        if expired or evicted:
+            logger.info(f"Listing index: {expired} stale listings expired, {evicted} evicted over the size cap")
+
+    def search(self, query, city, max_items, min_price=None, max_price=None):
+        """Up to ``max_items`` fresh listings whose titles contain every word of ``query``, or None if too few.
+
+        A search in "iran" covers the listings of every city. Listings come
+        most recently seen first, in the order they were scraped; those with
+        a known price outside the range are left out.
+        """
+        terms = normalize_search_text(query).split()
+        if not self.path or not terms:
+            return None
+        started = time.perf_counter()
+        clauses = ["listings.last_seen >= ?"]
+        params = [time.time() - self.freshness]
+        if city != "iran":
+            clauses.append("listings.city = ?")
+            params.append(city)
+        if min_price is not None:
+            clauses.append("(listings.price_value IS NULL OR listings.price_value >= ?)")
+            params.append(min_price)
+        if max_price is not None:
+            clauses.append("(listings.price_value IS NULL OR listings.price_value <= ?)")
+            params.append(max_price)
+        try:
+            with self._db_lock:
+                db = self._connect()
+                if self.fts:
+                    source = "listing_titles JOIN listings ON listings.id = listing_titles.rowid"
+                    clauses.insert(0, "listing_titles MATCH ?")
+                    # Every word, each as a quoted prefix so suffixed forms match too
+                    params.insert(0, " ".join('"' + term.replace('"', '""') + '"*' for term in terms))
+                else:
+                    source = "listings"
+                    for term in terms:
+                        clauses.append("listings.search_title LIKE ? ESCAPE '\\'")
+                        params.append("%" + re.sub(r'([\\%_])', r'\\\1', term) + "%")
+                rows = db.execute(
+                    "SELECT listings.title, listings.price, listings.price_value, listings.meta, listings.url, "
+                    f"listings.image_url FROM {source} WHERE {' AND '.join(clauses)} "
+                    "ORDER BY listings.last_seen DESC, listings.id LIMIT ?",
+                    params + [max_items]
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Could not search the listing index {self.path}: {e}")
+            return None
+        finally:
+            metrics.observe("index_search", time.perf_counter() - started)
+
+        if len(rows) < max_items:
+            self.misses += 1
+            return None
+        self.hits += 1
+        products = []
+        for title, price, price_value, meta, url, image_url in rows:
+            product = {'title': title, 'price': price, 'price_value': price_value, 'meta': meta, 'url': url}
+            if image_url:
+                product['image_url'] = image_url
+            products.append(product)
+        return products
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending)
+        listings = 0
+        if self._db is not None:
+            try:
+                with self._db_lock:
+                    listings = self._db.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
+            except sqlite3.Error:
+                pass
+        lookups = self.hits + self.misses
+        return {
+            "listings": listings,
+            "pending": pending,
+            "queued": self.queued,
+            "written": self.written,
+            "write_errors": self.write_errors,
+            "dropped": self.dropped,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "full_text": int(self.fts),
+        }
+
+listing_index = ListingIndex()
+
+class HttpClient:
+    """Shared keep-alive HTTP client with a tuned connection pool per host.
+
+    Every request goes through one ``requests.Session`` so TCP and TLS
+    connections to divar.ir and the image CDN are reused between searches.
+    A per-host semaphore caps how many requests hit one host at a time.
+    """
+
+    def __init__(self, pool_maxsize=HTTP_POOL_MAXSIZE, host_concurrency=HTTP_HOST_CONCURRENCY, pool_hosts=None):
+        self.host_concurrency = host_concurrency
+        self.session = requests.Session()
+        self._adapters = []
+        self._host_limits = {}
+        self._lock = threading.Lock()
+
+        default_adapter = self._make_adapter(pool_maxsize)
+        self.session.mount("https://", default_adapter)
+        self.session.mount("http://", default_adapter)
+
+        for prefix, maxsize in (HTTP_POOL_HOSTS if pool_hosts is None else pool_hosts).items():
+            self.session.mount(prefix, self._make_adapter(maxsize))
+
+    def _make_adapter(self, maxsize):
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=maxsize, max_retries=0)
+        self._adapters.append(adapter)
+        return adapter
+
+    def _host_limit(self, url):
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            limit = self._host_limits.get(host)
+            if limit is None:
+                limit = threading.BoundedSemaphore(self.host_concurrency)
+                self._host_limits[host] = limit
+            return limit
+
+    def request(self, method, url, **kwargs):
+        with self._host_limit(url):
+            return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def stats(self):
+        """Per-host connection counters: new connections vs reused ones"""
+        hosts = {}
+        for adapter in self._adapters:
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host = f"{pool.scheme}://{pool.host}"
+                entry = hosts.setdefault(host, {"requests": 0, "new_connections": 0, "reused_connections": 0})
+                entry["requests"] += pool.num_requests
+                entry["new_connections"] += pool.num_connections
+                entry["reused_connections"] += max(pool.num_requests - pool.num_connections, 0)
+        return hosts
+
+http_client = HttpClient()
+
+class ImageChecker:
+    """Checks image URLs on a bounded worker pool and caches the verdicts.
+
+    A verdict is one of ``ok``, ``bad_type`` (not an image), ``bad_status``
+    (non-200), ``timeout`` or ``error``. Each is cached for its own TTL so
+    repeat searches skip the HEAD request, and concurrent checks of the same
+    URL share one request.
+    """
+
+    def __init__(self, workers=IMAGE_CHECK_WORKERS, max_entries=IMAGE_VERDICT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-check")
+        self._verdicts = OrderedDict()  # url -> (expires_at, verdict)
+        self._pending = {}              # url -> Future
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.checks = 0
+        self.verdict_counts = {verdict: 0 for verdict in IMAGE_VERDICT_TTL}
+
+    def submit(self, url):
+        """Start checking ``url`` and return a Future resolving to its verdict"""
+        with self._lock:
+            entry = self._verdicts.get(url)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._verdicts.move_to_end(url)
+                    self.cache_hits += 1
+                    future = Future()
+                    future.set_result(entry[1])
+                    return future
+                del self._verdicts[url]
+
+            future = self._pending.get(url)
+            if future is None:
+                future = self._executor.submit(self._check, url)
+                self._pending[url] = future
+            return future
+
+    def check(self, url):
+        return self.submit(url).result()
+
+    def clear(self):
+        with self._lock:
+            self._verdicts.clear()
+
+    def cached(self, url):
+        """The cached verdict for ``url``, or None"""
+        with self._lock:
+            entry = self._verdicts.get(url)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._verdicts[url]
+                return None
+            self._verdicts.move_to_end(url)
+            self.cache_hits += 1
+            return entry[1]
+
+    def record(self, url, verdict):
+        """Store a verdict obtained elsewhere, e.g. by the asyncio path"""
+        with self._lock:
+            self.checks += 1
+            self.verdict_counts[verdict] += 1
+            self._verdicts[url] = (time.monotonic() + IMAGE_VERDICT_TTL[verdict], verdict)
+            while len(self._verdicts) > self.max_entries:
+                self._verdicts.popitem(last=False)
+
+    @staticmethod
+    def verdict_for(status_code, content_type):
+        if status_code != 200:
+            return "bad_status"
+        return "ok" if 'image' in content_type.lower() else "bad_type"
+
+    def _check(self, url):
+        try:
+            with metrics.span("image_check"):
+                response = http_client.head(url, timeout=IMAGE_CHECK_TIMEOUT)
+            verdict = self.verdict_for(response.status_code, response.headers.get('content-type', ''))
+        except requests.Timeout:
+            verdict = "timeout"
+        except Exception as e:
+            logger.error(f"Error checking image {url}: {e}")
+            verdict = "error"
+
+        self.record(url, verdict)
+        with self._lock:
+            self._pending.pop(url, None)
+        return verdict
+
+    def stats(self):
+        with self._lock:
+            return {
+                "cached_verdicts": len(self._verdicts),
+                "in_flight": len(self._pending),
+                "cache_hits": self.cache_hits,
+                "checks": self.checks,
+                **{f"verdict_{verdict}": count for verdict, count in self.verdict_counts.items()},
+            }
+
+image_checker = ImageChecker()
+
+class SearchJob:
+    """One queued search; ``cancelled`` is set when it is superseded"""
+
+    __slots__ = ('job_id', 'user_id', 'chat_id', 'priority', 'func', 'args', 'kwargs',
+                 'enqueued_at', 'started_at', 'cancelled')
+
+    def __init__(self, job_id, user_id, chat_id, priority, func, args, kwargs):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.cancelled = threading.Event()
+
+class SearchScheduler:
+    """Runs searches on a fixed worker pool fed by a bounded priority queue.
+
+    Each user has at most one active search. Under the ``replace`` policy a
+    new search cancels the user's queued or running one and is queued at
+    once, without waiting for the cancelled search to wind down; under
+    ``queue`` it waits until the previous one finishes. Smaller result
+    counts are served first. Job functions receive the job's ``cancelled``
+    event as a keyword argument and should stop when it is set.
+    """
+
+    def __init__(self, workers=SEARCH_WORKERS, max_queue=SEARCH_QUEUE_SIZE, replace_policy=SEARCH_REPLACE_POLICY):
+        if replace_policy not in ("replace", "queue"):
+            raise ValueError(f"Unknown replace policy: {replace_policy}")
+        self.workers = workers
+        self.max_queue = max_queue
+        self.replace_policy = replace_policy
+        self._heap = []                  # (priority, seq, job)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._queued_by_user = {}        # user_id -> job in the heap
+        self._waiting_by_user = {}       # user_id -> deque of jobs behind the active one
+        self._running_by_user = {}       # user_id -> running job
+        self._depth = 0
+        self._busy = 0
+        self._busy_time = 0.0
+        self._started_at = time.monotonic()
+        self._wait_times = deque(maxlen=500)
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.replaced = 0
+        self.rejected = 0
+
+    def _ensure_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f"search-worker-{len(self._threads) + 1}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def submit(self, user_id, chat_id, priority, func, *args, **kwargs):
+        """Queue a search; returns how many searches are ahead of it for a worker, or 0 if it starts right away.
+
+        Raises ``queue.Full`` when the queue is at capacity.
+        """
+        with self._cond:
+            self._ensure_workers()
+
+            if self.replace_policy == "replace":
+                self._cancel_user_jobs(user_id)
+
+            if self._depth >= self.max_queue:
+                self.rejected += 1
+                raise queue.Full("search queue is full")
+
+            job = SearchJob(next(self._seq), user_id, chat_id, priority, func, args, kwargs)
+            self.submitted += 1
+            self._depth += 1
+
+            if self.replace_policy == "queue" and (user_id in self._running_by_user or user_id in self._queued_by_user):
+                waiting = self._waiting_by_user.setdefault(user_id, deque())
+                waiting.append(job)
+                self._cond.notify()
+                # Behind the user's own searches, and then behind whatever is queued by then
+                return self._live_heap_size() + len(waiting)
+
+            self._push(job)
+            position = self._position(job) - (self.workers - self._busy)
+            self._cond.notify()
+            return max(position, 0)
+
+    def _cancel_user_jobs(self, user_id):
+        queued = self._queued_by_user.pop(user_id, None)
+        if queued is not None:
+            queued.cancelled.set()
+            self._depth -= 1
+            self.replaced += 1
+        for job in self._waiting_by_user.pop(user_id, ()):
+            job.cancelled.set()
+            self._depth -= 1
+            self.replaced += 1
+        running = self._running_by_user.pop(user_id, None)
+        if running is not None and not running.cancelled.is_set():
+            # It stops at its next check; meanwhile it keeps its worker but no longer counts as the user's search
+            running.cancelled.set()
+            self.replaced += 1
+
+    def _push(self, job):
+        heapq.heappush(self._heap, (job.priority, job.job_id, job))
+        self._queued_by_user[job.user_id] = job
+
+    def _live_heap_size(self):
+        return sum(1 for _, _, job in self._heap if not job.cancelled.is_set())
+
+    def _position(self, job):
+        key = (job.priority, job.job_id)
+        return 1 + sum(1 for priority, job_id, other in self._heap
+                       if (priority, job_id) < key and not other.cancelled.is_set())
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    while not self._heap:
+                        self._cond.wait()
+                    _, _, job = heapq.heappop(self._heap)
+                    if not job.cancelled.is_set():
+                        break
+
+                self._depth -= 1
+                if self._queued_by_user.get(job.user_id) is job:
+                    del self._queued_by_user[job.user_id]
+                self._running_by_user[job.user_id] = job
+                self._busy += 1
+                job.started_at = time.monotonic()
+                waited = job.started_at - job.enqueued_at
+                self._wait_times.append(waited)
+
+            logger.info(f"Search job {job.job_id} for user {job.user_id} started after waiting {waited:.2f}s")
+            try:
+                job.func(*job.args, cancelled=job.cancelled, **job.kwargs)
+            except Exception as e:
+                with self._cond:
+                    self.failed += 1
+                logger.error(f"Search job {job.job_id} failed: {e}")
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    self._busy_time += time.monotonic() - job.started_at
+                    self.completed += 1
+                    if self._running_by_user.get(job.user_id) is job:
+                        del self._running_by_user[job.user_id]
+                    waiting = self._waiting_by_user.get(job.user_id)
+                    if waiting:
+                        self._push(waiting.popleft())
+                        if not waiting:
+                            del self._waiting_by_user[job.user_id]
+                        self._cond.notify()
+
+    def stats(self):
+        """Queue depth, wait times and worker utilization"""
+        with self._cond:
+            uptime = max(time.monotonic() - self._started_at, 1e-9)
+            busy_time = self._busy_time + sum(time.monotonic() - job.started_at
+                                              for job in self._running_by_user.values())
+            waits = list(self._wait_times)
+            return {
+                "queue_depth": self._depth,
+                "workers": self.workers,
+                "busy_workers": self._busy,
+                "utilization": busy_time / (self.workers * uptime),
+                "avg_wait_seconds": (sum(waits) / len(waits)) if waits else 0.0,
+                "max_wait_seconds": max(waits) if waits else 0.0,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "replaced": self.replaced,
+                "rejected": self.rejected,
+            }
+
+search_scheduler = SearchScheduler()
+
+class TokenBucket:
+    """Classic token bucket: ``rate`` tokens per second, up to ``capacity``"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        """Seconds until one token is available"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def try_take(self, now):
+        """Takes a token if one is available; returns whether it did"""
+        self._refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def available(self, now):
+        """Tokens in the bucket, fractions included"""
+        self._refill(now)
+        return self.tokens
+
+    def add(self, now, tokens):
+        """Credits ``tokens`` on top of the steady rate, up to ``capacity``"""
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens + tokens)
+
+class OutboundSender:
+    """Central, rate-limited queue for outgoing Telegram API calls.
+
+    Calls are queued per chat and released by one dispatcher thread when both
+    the global bucket and the chat's bucket have a token, then run on a small
+    worker pool. Messages to one chat keep their order. A 429 response puts
+    the chat on hold for ``retry_after`` seconds and the call is retried.
+    ``submit`` never blocks; it returns a Future for the call's result.
+    """
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, global_burst=TELEGRAM_GLOBAL_BURST,
+                 chat_rate=TELEGRAM_CHAT_RATE, chat_burst=TELEGRAM_CHAT_BURST,
+                 workers=TELEGRAM_SEND_WORKERS, max_retries=TELEGRAM_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_burst)
+        self._queues = OrderedDict()     # chat_id -> deque of pending calls, in round-robin order
+        self._buckets = {}               # chat_id -> TokenBucket
+        self._held_until = {}            # chat_id -> monotonic time after a 429
+        self._in_flight = set()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="telegram-send")
+        self._dispatcher = None
+        self._pruned_at = time.monotonic()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.skipped = 0
+
+    def submit(self, chat_id, func, *args, cancelled=None, **kwargs):
+        """Queue ``func(*args, **kwargs)`` for ``chat_id``; skipped if ``cancelled`` is set first"""
+        future = Future()
+        with self._cond:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name="telegram-dispatcher", daemon=True)
+                self._dispatcher.start()
+            self._queues.setdefault(chat_id, deque()).append([func, args, kwargs, future, cancelled, 0])
+            self._cond.notify()
+        return future
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.submit(chat_id, bot.send_message, chat_id, text, **kwargs)
+
+    def _dispatch(self):
+        with self._cond:
+            while True:
+                wait = None
+                now = time.monotonic()
+                for chat_id in list(self._queues):
+                    if chat_id in self._in_flight:
+                        continue
+                    # Drop calls of replaced searches first, so a live call behind them is judged in this pass
+                    pending = self._queues[chat_id]
+                    while pending and pending[0][4] is not None and pending[0][4].is_set():
+                        self.skipped += 1
+                        pending.popleft()[3].cancel()
+                    if not pending:
+                        del self._queues[chat_id]
+                        continue
+                    delay = max(self._held_until.get(chat_id, 0) - now, self._bucket(chat_id, now).delay(now))
+                    if delay > 0:
+                        wait = delay if wait is None else min(wait, delay)
+                        continue
+                    global_delay = self._global.delay(now)
+                    if global_delay > 0:
+                        wait = global_delay if wait is None else min(wait, global_delay)
+                        break
+
+                    call = pending.popleft()
+                    if not pending:
+                        del self._queues[chat_id]
+                    else:
+                        self._queues.move_to_end(chat_id)
+
+                    self._global.take(now)
+                    self._buckets[chat_id].take(now)
+                    self._in_flight.add(chat_id)
+                    self._executor.submit(self._run, chat_id, call)
+
+                if now - self._pruned_at > 60:
+                    self._prune_buckets(now)
+                self._cond.wait(timeout=wait)
+
+    def _prune_buckets(self, now):
+        """Forget idle chats whose bucket has refilled, which is the same as a fresh bucket"""
+        self._pruned_at = now
+        for chat_id in list(self._buckets):
+            if chat_id in self._queues or chat_id in self._in_flight or chat_id in self._held_until:
+                continue
+            if self._buckets[chat_id].delay(now) == 0 and self._buckets[chat_id].tokens >= self.chat_burst:
+                del self._buckets[chat_id]
+
+    def _bucket(self, chat_id, now):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    def _run(self, chat_id, call):
+        func, args, kwargs, future = call[:4]
+        retry_after = None
+        try:
+            result = func(*args, **kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429 and call[5] < self.max_retries:
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+            else:
+                self.failed += 1
+                logger.error(f"Telegram call {getattr(func, '__name__', func)} to {chat_id} failed: {e}")
+                future.set_exception(e)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Telegram call {getattr(func, '__name__', func)} to {chat_id} failed: {e}")
+            future.set_exception(e)
+        else:
+            self.sent += 1
+            future.set_result(result)
+
+        with self._cond:
+            self._in_flight.discard(chat_id)
+            if retry_after is not None:
+                self.retried += 1
+                call[5] += 1
+                logger.warning(f"Telegram flood limit for chat {chat_id}, retrying in {retry_after}s")
+                self._held_until[chat_id] = time.monotonic() + retry_after
+                self._queues.setdefault(chat_id, deque()).appendleft(call)
+            elif self._held_until.get(chat_id, 0) <= time.monotonic():
+                self._held_until.pop(chat_id, None)
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": sum(len(calls) for calls in self._queues.values()),
+                "chats_waiting": len(self._queues),
+                "in_flight": len(self._in_flight),
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried": self.retried,
+                "skipped": self.skipped,
+            }
+
+outbox = OutboundSender()
+
+class SavedSearch:
+    """A user's saved search and the listing tokens already reported for it"""
+
+    __slots__ = ('watch_id', 'user_id', 'chat_id', 'query', 'city', 'min_price', 'max_price',
+                 'seen', 'runs', 'next_run', 'created_at')
+
+    def __init__(self, watch_id, user_id, chat_id, query, city, min_price=None, max_price=None,
+                 seen=(), runs=0, next_run=0.0, created_at=None):
+        self.watch_id = watch_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.query = query
+        self.city = city
+        self.min_price = min_price
+        self.max_price = max_price
+        self.seen = OrderedDict((token, None) for token in seen)  # oldest first
+        self.runs = runs
+        self.next_run = next_run  # wall clock, so it survives restarts
+        self.created_at = time.time() if created_at is None else created_at
+
+    @property
+    def key(self):
+        return SearchCache.make_key(self.query, self.city, self.min_price, self.max_price)
+
+    def remember(self, tokens, limit):
+        """Mark tokens as seen, keeping only the ``limit`` most recently listed ones"""
+        # Results come newest first, so insert them oldest first
+        for token in reversed(tokens):
+            self.seen[token] = None
+            self.seen.move_to_end(token)
+        while len(self.seen) > limit:
+            self.seen.popitem(last=False)
+
+    def to_dict(self):
+        return {
+            "watch_id": self.watch_id,
+            "user_id": self.user_id,
+            "chat_id": self.chat_id,
+            "query": self.query,
+            "city": self.city,
+            "min_price": self.min_price,
+            "max_price": self.max_price,
+            "seen": list(self.seen),
+            "runs": self.runs,
+            "next_run": time.time() if self.next_run is None else self.next_run,  # None while running
+            "created_at": self.created_at,
+        }
+
+class WatchScheduler:
+    """Re-runs saved searches on an interval and sends only listings not seen before.
+
+    Each run is spread by up to WATCH_JITTER of the interval. Watches of the
+    same search (query, city and price range) falling due within
+    WATCH_SHARE_WINDOW of each other are served by one fetch, which also goes
+    through the result cache. The first run only records what is already
+    listed. Watches and their seen tokens are saved to ``path`` as JSON.
+    """
+
+    def __init__(self, path=WATCH_DB_PATH, interval=WATCH_INTERVAL, jitter=WATCH_JITTER,
+                 workers=WATCH_WORKERS):
+        self.path = path
+        self.interval = interval
+        self.jitter = jitter
+        self._cond = threading.Condition()
+        self._save_lock = threading.Lock()
+        self._watches = {}               # watch_id -> SavedSearch
+        self._by_key = {}                # search key -> set of watch_ids
+        self._heap = []                  # (next_run, watch_id); stale entries are skipped
+        self._running_keys = set()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="watch")
+        self._thread = None
+        self._next_id = 1
+        self.runs = 0
+        self.fetches = 0
+        self.shared_runs = 0
+        self.alerts = 0
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                saved = json.load(f)
+        except Exception as e:
+            logger.error(f"Could not load saved searches from {self.path}: {e}")
+            return
+        now = time.time()
+        for data in saved.get("watches", []):
+            watch = SavedSearch(**data)
+            if watch.next_run < now:
+                # Spread runs that fell due while the bot was down
+                watch.next_run = now + random.uniform(0, self.interval * self.jitter)
+            self._add(watch)
+        self._next_id = max(self._watches, default=0) + 1
+        logger.info(f"Loaded {len(self._watches)} saved searches")
+
+    def _save(self):
+        if not self.path:
+            return
+        with self._cond:
+            snapshot = {"watches": [watch.to_dict() for watch in self._watches.values()]}
+        with self._save_lock:
+            temp_path = f"{self.path}.tmp"
+            try:
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    json.dump(snapshot, f, ensure_ascii=False)
+                os.replace(temp_path, self.path)
+            except Exception as e:
+                logger.error(f"Could not save searches to {self.path}: {e}")
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="watch-scheduler", daemon=True)
+                self._thread.start()
+
+    def _add(self, watch):
+        self._watches[watch.watch_id] = watch
+        self._by_key.setdefault(watch.key, set()).add(watch.watch_id)
+        heapq.heappush(self._heap, (watch.next_run, watch.watch_id))
+
+    def _next_delay(self):
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def add(self, user_id, chat_id, query, city, min_price=None, max_price=None):
+        """Save a search; returns the watch, or None if the user has WATCH_MAX_PER_USER already"""
+        with self._cond:
+            mine = [watch for watch in self._watches.values() if watch.user_id == user_id]
+            key = SearchCache.make_key(query, city, min_price, max_price)
+            for watch in mine:
+                if watch.key == key:
+                    return watch
+            if len(mine) >= WATCH_MAX_PER_USER:
+                return None
+            # The first run only records current listings, so it can happen soon
+            watch = SavedSearch(self._next_id, user_id, chat_id, query, city, min_price, max_price,
+                                next_run=time.time() + random.uniform(1, 30))
+            self._next_id += 1
+            self._add(watch)
+            self._cond.notify()
+        self.start()
+        self._save()
+        return watch
+
+    def remove(self, user_id, watch_id):
+        with self._cond:
+            watch = self._watches.get(watch_id)
+            if watch is None or watch.user_id != user_id:
+                return False
+            del self._watches[watch_id]
+            ids = self._by_key.get(watch.key)
+            if ids is not None:
+                ids.discard(watch_id)
+                if not ids:
+                    del self._by_key[watch.key]
+        self._save()
+        return True
+
+    def list(self, user_id):
+        with self._cond:
+            return sorted((watch for watch in self._watches.values() if watch.user_id == user_id),
+                          key=lambda watch: watch.watch_id)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap:
+                        next_run, watch_id = self._heap[0]
+                        watch = self._watches.get(watch_id)
+                        if watch is not None and watch.next_run == next_run:
+                            break
+                        heapq.heappop(self._heap)
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(timeout=(self._heap[0][0] - now) if self._heap else None)
+
+                _, watch_id = heapq.heappop(self._heap)
+                key = self._watches[watch_id].key
+                if key in self._running_keys:
+                    # A fetch for this search is under way; the cache will serve this one shortly
+                    self._schedule(self._watches[watch_id], 5)
+                    continue
+                group = [self._watches[other] for other in self._by_key.get(key, ())
+                         if self._watches[other].next_run <= now + WATCH_SHARE_WINDOW]
+                for watch in group:
+                    watch.next_run = None
+                self._running_keys.add(key)
+            self._executor.submit(self._run_group, key, group)
+
+    def _schedule(self, watch, delay):
+        watch.next_run = time.time() + delay
+        heapq.heappush(self._heap, (watch.next_run, watch.watch_id))
+        self._cond.notify()
+
+    def _run_group(self, key, group):
+        first = group[0]
+        try:
+            products = scrape_divar_products(first.query, WATCH_FETCH_ITEMS, first.city,
+                                             first.min_price, first.max_price)
+            tokens = [token for token in (listing_token(product.get('url')) for product in products) if token]
+            with self._cond:
+                self.fetches += 1
+                self.shared_runs += len(group) - 1
+
+            for watch in group:
+                with self._cond:
+                    if watch.watch_id not in self._watches:
+                        continue
+                    fresh = [product for product, token in zip(products, tokens) if token not in watch.seen] \
+                        if watch.runs else []
+                    watch.remember(tokens, WATCH_SEEN_LIMIT)
+                    if products:
+                        watch.runs += 1
+                    self.runs += 1
+                if fresh:
+                    self._alert(watch, fresh[:WATCH_MAX_ALERTS])
+        except Exception as e:
+            logger.error(f"Saved search {key} failed: {e}")
+        finally:
+            with self._cond:
+                self._running_keys.discard(key)
+                for watch in group:
+                    if watch.watch_id in self._watches:
+                        self._schedule(watch, self._next_delay())
+            self._save()
+
+    def _alert(self, watch, products):
+        with self._cond:
+            self.alerts += len(products)
+        checks = [image_checker.submit(product['image_url']) if product.get('image_url') else None
+                  for product in products]
+        outbox.send_message(watch.chat_id, f"🔔 {len(products)} آگهی جدید برای «{watch.query}» در "
+                                           f"{city_label(watch.city)}")
+        for idx, (product, check) in enumerate(zip(products, checks), 1):
+            verdict = None
+            if check is not None:
+                try:
+                    verdict = check.result()
+                except Exception as e:
+                    logger.error(f"Error checking image for saved search {watch.watch_id}: {e}")
+            outbox.submit(watch.chat_id, send_product_card, watch.chat_id, idx, product, verdict)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "watches": len(self._watches),
+                "searches": len(self._by_key),
+                "runs": self.runs,
+                "fetches": self.fetches,
+                "shared_runs": self.shared_runs,
+                "alerts": self.alerts,
+            }
+
+watch_scheduler = WatchScheduler()
+
+class CircuitOpenError(Exception):
+    """Raised instead of fetching while the circuit breaker is open"""
+
+class FetchCancelled(Exception):
+    """Raised instead of fetching a page the search no longer needs"""
+
+class CircuitBreaker:
+    """Fails Divar fetches fast while the site keeps failing.
+
+    After ``failure_threshold`` failed tries in a row the breaker opens and
+    ``before_request`` raises ``CircuitOpenError`` for ``open_seconds``, or
+    for as long as a failure asked to ``hold`` it. Then one trial request is
+    let through (half-open): its success closes the breaker, its failure
+    opens it again.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, open_seconds=BREAKER_OPEN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self._failures = 0
+        self._open_until = 0.0
+        self._trial_started = None
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.rejected = 0
+
+    def before_request(self):
+        """Raise ``CircuitOpenError`` unless a request may go out now"""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == "open":
+                if now < self._open_until:
+                    self.rejected += 1
+                    raise CircuitOpenError(f"Divar is failing; not retrying for {self._open_until - now:.0f}s")
+                self.state = "half_open"
+                self._trial_started = None
+            if self.state == "half_open":
+                # A trial that never reported back does not block the breaker forever
+                if self._trial_started is not None and now - self._trial_started < self.open_seconds:
+                    self.rejected += 1
+                    raise CircuitOpenError("Divar is failing; waiting for a trial request")
+                self._trial_started = now
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self.state != "closed":
+                logger.info("Divar is answering again; circuit breaker closed")
+                self.state = "closed"
+                self._trial_started = None
+
+    def record_failure(self, hold=None):
+        """Count a failed try; ``hold`` opens the breaker for that many seconds at once"""
+        now = time.monotonic()
+        with self._lock:
+            self._failures += 1
+            if self.state == "half_open" or self._failures >= self.failure_threshold or hold:
+                seconds = max(self.open_seconds if self.state != "open" else 0, hold or 0)
+                if self.state != "open":
+                    self.opened += 1
+                    logger.warning(f"Circuit breaker open after {self._failures} failed Divar requests; "
+                                   f"failing fast for {seconds:.0f}s")
+                self.state = "open"
+                self._open_until = max(self._open_until, now + seconds)
+                self._trial_started = None
+
+    def is_open(self):
+        with self._lock:
+            return self.state == "open" and time.monotonic() < self._open_until
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "open": int(self.state == "open"),
+                "half_open": int(self.state == "half_open"),
+                "consecutive_failures": self._failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+class RetryBudget:
+    """Caps retries across all searches so a failing Divar is not hit with extra load.
+
+    Every first attempt earns ``ratio`` of a retry, and ``min_rate`` more
+    retries per second trickle in, up to ``capacity`` saved. A retry is only
+    made while there is a whole one to spend.
+    """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, min_rate=RETRY_BUDGET_MIN_RATE, capacity=RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self._bucket = TokenBucket(min_rate, capacity)
+        self._lock = threading.Lock()
+        self.granted = 0
+        self.denied = 0
+
+    def record_attempt(self):
+        with self._lock:
+            self._bucket.add(time.monotonic(), self.ratio)
+
+    def try_retry(self):
+        with self._lock:
+            if not self._bucket.try_take(time.monotonic()):
+                self.denied += 1
+                return False
+            self.granted += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {"retry_tokens": self._bucket.available(time.monotonic()), "retries_granted": self.granted,
+                    "retries_denied": self.denied}
+
+divar_breaker = CircuitBreaker()
+retry_budget = RetryBudget()
+
+def parse_retry_after(value):
+    """Seconds asked for by a Retry-After header (delay-seconds or HTTP date), or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def fetch_retry_delay(attempt, started, reason, retry_after=None):
+    """Record a failed try at a Divar page; seconds to wait before the next one, or None to give up.
+
+    The pause is capped exponential backoff with jitter, or the server's
+    Retry-After. There is no retry after FETCH_MAX_ATTEMPTS tries, past
+    FETCH_DEADLINE, while the breaker is open, or when the shared retry
+    budget is spent. A Retry-After longer than FETCH_BACKOFF_MAX holds the
+    breaker open that long instead.
+    """
+    hold = retry_after if retry_after is not None and retry_after > FETCH_BACKOFF_MAX else None
+    divar_breaker.record_failure(hold)
+    if retry_after is not None:
+        delay = None if hold else retry_after
+    else:
+        ceiling = min(FETCH_BACKOFF_MAX, FETCH_BACKOFF_BASE * 2 ** attempt)
+        delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+    if (delay is None or attempt + 1 >= FETCH_MAX_ATTEMPTS or time.perf_counter() - started + delay > FETCH_DEADLINE
+            or divar_breaker.is_open() or not retry_budget.try_retry()):
+        metrics.inc("fetch_failures_total", reason=reason)
+        return None
+    metrics.inc("fetch_retries_total", reason=reason)
+    return delay
+
+def _is_listing_tag(name, attrs):
+    """True for tags the extractors start from: listing links and card containers"""
+    if name == 'a':
+        return bool(LISTING_HREF_RE.search(attrs.get('href') or ''))
+    if name in ('article', 'div'):
+        css_class = attrs.get('class') or ''
+        if isinstance(css_class, (list, tuple)):
+            css_class = ' '.join(css_class)
+        return bool(CARD_CLASS_RE.search(css_class))
+    return False
+
+class ListingStrainer(SoupStrainer):
+    """Parse-time filter that only builds listing card subtrees.
+
+    Top-level tags are kept when they are ``<a href="/v/...">`` links or
+    ``article``/``div`` containers with a post/item/card class; everything
+    inside a kept tag is built as usual, so the extractors see the same
+    subtrees as with a full parse.
+    """
+
+    def __init__(self):
+        super().__init__()
+
+    # BeautifulSoup >= 4.13
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return _is_listing_tag(name, attrs or {})
+
+    def allow_string_creation(self, string):
+        return False
+
+    # BeautifulSoup < 4.13
+    def search_tag(self, markup_name=None, markup_attrs={}):
+        return _is_listing_tag(markup_name, markup_attrs or {})
+
+def _lxml_available():
+    try:
+        import lxml  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def resolve_parser_backend(backend=None):
+    """Map a configured backend name to a BeautifulSoup tree builder"""
+    backend = backend or PARSER_BACKEND
+    if backend == "fast":
+        return "lxml" if _lxml_available() else "html.parser"
+    if backend == "lxml" and not _lxml_available():
+        logger.warning("lxml is not installed, falling back to html.parser")
+        return "html.parser"
+    if backend not in ("html.parser", "lxml"):
+        raise ValueError(f"Unknown parser backend: {backend}")
+    return backend
+
+def parse_listing_page(content, backend=None, selective=None):
+    """Parse a Divar search page with the configured backend"""
+    backend = backend or PARSER_BACKEND
+    builder = resolve_parser_backend(backend)
+    if selective is None:
+        selective = PARSER_SELECTIVE or backend == "fast"
+    if selective:
+        return BeautifulSoup(content, builder, parse_only=ListingStrainer())
+    return BeautifulSoup(content, builder)
+
 def scrape_divar_products(query: str, max_items: int, city: str = "tehran", min_price: int = None, max_price: int = None):
     """Improved scraper for Divar products with clean data extraction"""
+    return list(iter_divar_products(query, max_items, city, min_price, max_price))
+
+def iter_divar_products(query: str, max_items: int, city: str = "tehran", min_price: int = None, max_price: int = None,
+                        trace=None, source=DEFAULT_SEARCH_SOURCE, cancelled=None):
+    """Yield validated products one by one as soon as each is extracted.
+
+    Cached results are replayed directly. With the ``index`` source, fresh
+    listings from the local ``listing_index`` answer next when there are
+    enough of them. If the same search is already being fetched, its
+    results are awaited and replayed instead (see ``SingleFlight``); the
+    search leading such a fetch reads all its pages before yielding, so the
+    others need not wait for its messages. A fetch
+    that runs to completion is stored in the cache. When fetching fails
+    before any product, an expired cache entry is replayed if one is still
+    kept, and otherwise the error is raised. Page timings go to ``trace`` when given; a
+    profiled search always fetches for itself. A ``city`` naming several
+    cities is handed to ``iter_multi_city_products``, with the search's
+    ``cancelled`` event.
+    """
+    cities = split_cities(city)
+    if len(cities) > 1:
+        yield from iter_multi_city_products(query, max_items, cities, min_price, max_price, trace, source, cancelled)
+        return
+
+    cache_key = SearchCache.make_key(query, city, min_price, max_price)
+    profiling = trace is not None and trace.profile is not None
+    cached = None if profiling else search_cache.get(cache_key, max_items)
+    if cached is not None:
+        logger.info(f"Cache hit for search {cache_key}")
+        yield from cached
+        return
+
+    indexed = listing_index.search(query, city, max_items, min_price, max_price) \
+        if source == "index" and not profiling else None
+    if indexed is not None:
+        logger.info(f"Answered search {cache_key} from the listing index")
+        metrics.inc("searches_from_index_total")
+        yield from indexed
+        return
+
+    flight, leader = (None, False) if profiling else search_flights.join(cache_key, max_items)
+    rejoined = False
+    while flight is not None and not leader:
+        try:
+            shared = search_flights.result(flight)
+        except Exception as e:
+            logger.error(f"Error scraping Divar: {e}")
+            yield from stale_results(cache_key, max_items, e)
+            return
+        if shared is not None:
+            logger.info(f"Joined in-progress search {cache_key}")
+            for product in shared[:max_items]:
+                yield dict(product)
+            return
+        if rejoined or not flight.done():
+            break
+        # The leader stopped early: the first waiter back takes over, the rest wait on it
+        rejoined = True
+        flight, leader = search_flights.join(cache_key, max_items)
+
+    results = []
+    completed = False
+    error = None
     try:
-        # Build URL with filters
-        base_url = f"https://divar.ir/s/{city}"
-        params = {"q": query}
-        
-        if min_price is not None or max_price is not None:
-            price_filter = ""
-            if min_price is not None:
-                price_filter += f"MIN-{min_price}"
-            if max_price is not None:
-                if price_filter:
-                    price_filter += f"_MAX-{max_price}"
-                else:
-                    price_filter += f"MAX-{max_price}"
+        if leader:
+            # Fetched in full before anything is yielded, so waiting searches get the
+            # products as soon as the pages are parsed, not after this search's messages
+            results = list(iter_fetched_products(query, max_items, city, min_price, max_price, trace))
+        else:
+            for product in iter_fetched_products(query, max_items, city, min_price, max_price, trace):
+                results.append(product)
+                yield dict(product)
+        completed = True
+    except Exception as e:
+        error = e
+        logger.error(f"Error scraping Divar: {e}")
+    finally:
+        if leader:
+            search_flights.finish(cache_key, flight, results if completed else None, error)
+
+    if error is not None:
+        if not results:
+            yield from stale_results(cache_key, max_items, error)
+        return
+    search_cache.put(cache_key, max_items, results)
+    if leader:
+        for product in results:
+            yield dict(product)
+
+def stale_results(cache_key, max_items, error):
+    """Expired cached products to show when a search failed; re-raises ``error`` when there are none"""
+    stale = search_cache.get_stale(cache_key, max_items)
+    if stale is None:
+        raise error
+    logger.warning(f"Serving stale results for search {cache_key} after: {error}")
+    metrics.inc("stale_results_served_total")
+    return stale
+
+city_executor = ThreadPoolExecutor(max_workers=MULTI_CITY_WORKERS, thread_name_prefix="city-fetch")
+
+def merge_city_results(results, max_items, order=None):
+    """Per-city product lists as one list: cities taken in turn (or newest first), each ad once, ``max_items`` at most"""
+    merged = [product for row in itertools.zip_longest(*results) for product in row if product is not None]
+    if (order or MULTI_CITY_MERGE) == "newest":
+        merged = sort_products(merged, "newest")
+    seen_tokens = set()
+    duplicates = near_duplicate_index()
+    results = []
+    near_duplicates = 0
+    for product in merged:
+        if len(results) >= max_items:
+            break
+        if not is_new_listing(product, seen_tokens):
+            continue
+        if duplicates is not None and duplicates.is_duplicate(product):
+            near_duplicates += 1
+            continue
+        results.append(product)
+    metrics.inc("results_filtered_total", near_duplicates, reason="near_duplicate")
+    return results
+
+def iter_multi_city_products(query, max_items, cities, min_price=None, max_price=None, trace=None,
+                             source=DEFAULT_SEARCH_SOURCE, cancelled=None):
+    """Search several cities at once and yield their merged results.
+
+    Up to MULTI_CITY_CONCURRENCY cities of one search are fetched at the
+    same time on ``city_executor``, whose MULTI_CITY_WORKERS threads are
+    shared by all searches, so a search takes about as long as its slowest
+    city. Each city goes through ``iter_divar_products`` and so has its own
+    cache entry and in-progress coalescing. Once ``cancelled`` is set no
+    further city is started and ``FetchCancelled`` is raised; cities still
+    queued on the executor when the search stops are dropped from it.
+    """
+    def fetch_city(city):
+        # Checked again here, as the city may have waited for a free executor thread
+        if cancelled is not None and cancelled.is_set():
+            raise FetchCancelled(city)
+        return list(iter_divar_products(query, max_items, city, min_price, max_price, trace, source))
+
+    results = {}
+    errors = []
+    waiting = deque(cities)
+    running = {}
+    try:
+        while waiting or running:
+            if cancelled is not None and cancelled.is_set():
+                raise FetchCancelled(query)
+            while waiting and len(running) < MULTI_CITY_CONCURRENCY:
+                city = waiting.popleft()
+                running[city_executor.submit(fetch_city, city)] = city
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                city = running.pop(future)
+                try:
+                    results[city] = future.result()
+                except Exception as e:
+                    logger.error(f"Error searching '{query}' in {city}: {e}")
+                    errors.append(e)
+                    results[city] = []
+    finally:
+        for future in running:
+            future.cancel()
+    if len(errors) == len(cities):
+        raise errors[0]
+    logger.info(f"Search '{query}' in {len(cities)} cities: " + ", ".join(
+        f"{city} {len(results[city])}" for city in cities))
+    yield from merge_city_results([results[city] for city in cities], max_items)
+
+def build_search_url(query: str, city: str = "tehran", min_price: int = None, max_price: int = None, page: int = 1):
+    """Divar search URL with the query, optional price filter and page number"""
+    base_url = f"{DIVAR_BASE_URL}/s/{city}"
+    params = {"q": query}
+    
+    if min_price is not None or max_price is not None:
+        price_filter = ""
+        if min_price is not None:
+            price_filter += f"MIN-{min_price}"
+        if max_price is not None:
             if price_filter:
-                params["price"] = price_filter
-
-        # Create URL with parameters
-        url = base_url + "?" + "&".join([f"{k}={quote_plus(str(v))}" for k, v in params.items()])
-        
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
-            'Accept-Language': 'fa,en-US;q=0.9,en;q=0.8',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-Site': 'none',
-            'Cache-Control': 'max-age=0'
-        }
-        
-        response = requests.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.content, "html.parser")
-        
-        # Try multiple approaches to find products
-        results = []
+                price_filter += f"_MAX-{max_price}"
+            else:
+                price_filter += f"MAX-{max_price}"
+        if price_filter:
+            params["price"] = price_filter
+    
+    if page > 1:
+        params["page"] = page
+
+    # Create URL with parameters
+    return base_url + "?" + "&".join([f"{k}={quote_plus(str(v))}" for k, v in params.items()])
+
+def split_cities(city):
+    """City codes of a search's ``city``, which holds several comma-separated codes in a multi-city search"""
+    return [code for code in str(city or "tehran").split(",") if code]
+
+def join_cities(codes):
+    """One ``city`` value for several city codes, in CITIES_DATA order so equal selections share cache entries"""
+    codes = set(codes)
+    ordered = [code for code in CITIES_DATA if code in codes]
+    return ",".join(ordered + sorted(codes.difference(ordered)))
+
+def city_label(city):
+    return "، ".join(CITIES_DATA.get(code, code) for code in split_cities(city))
+
+def listing_token(url):
+    """Divar's listing ID, the last path segment of a ``/v/<slug>/<token>`` URL"""
+    if not url:
+        return None
+    segments = [segment for segment in urlsplit(url).path.split('/') if segment]
+    if 'v' not in segments or segments[-1] == 'v':
+        return None
+    return segments[-1]
+
+page_executor = ThreadPoolExecutor(max_workers=DIVAR_PAGE_FANOUT * SEARCH_WORKERS, thread_name_prefix="page-fetch")
+page_timings = deque(maxlen=500)  # recent per-page fetch/parse/extract timings
+
+def read_listing_page(content):
+    """The listings embedded in a downloaded page if it has any, else its parsed tree"""
+    listings = extract_structured_listings(content) if STRUCTURED_DATA else None
+    return listings if listings is not None else parse_listing_page(content)
+
+def fetch_listing_page(url, cancelled=None):
+    """Download and read one search result page; returns (page, fetch_seconds, parse_seconds).
+
+    ``page`` is what ``read_listing_page`` returns; pass it to ``iter_page_products``.
+    """
+    started = time.perf_counter()
+    content = fetch_divar_page(url, cancelled)
+    fetched = time.perf_counter()
+    
+    page = read_listing_page(content)
+    return page, fetched - started, time.perf_counter() - fetched
+
+def fetch_divar_page(url, cancelled=None):
+    """GET one Divar page, retrying failures as ``fetch_retry_delay`` allows; returns the body.
+
+    Raises ``CircuitOpenError`` without a request while the breaker is
+    open, the HTTPError of a 4xx answer (not retried, and not held against
+    Divar's health) and otherwise the last failure. Once the
+    ``cancelled`` event is set the page is abandoned: there is no further
+    try, and a failure is raised without counting against the breaker,
+    the retry budget or the metrics.
+    """
+    started = time.perf_counter()
+    retry_budget.record_attempt()
+    for attempt in itertools.count():
+        if cancelled is not None and cancelled.is_set():
+            raise FetchCancelled(url)
+        divar_breaker.before_request()
+        retry_after = None
+        try:
+            response = http_client.get(url, headers=DIVAR_HEADERS, timeout=(FETCH_CONNECT_TIMEOUT, FETCH_TIMEOUT))
+        except requests.Timeout as e:
+            error, reason = e, "timeout"
+        except requests.RequestException as e:
+            error, reason = e, "error"
+        else:
+            if response.status_code != 429 and response.status_code < 500:
+                divar_breaker.record_success()
+                response.raise_for_status()
+                return response.content
+            error = requests.HTTPError(f"{response.status_code} {response.reason} for url: {url}", response=response)
+            reason = "throttled" if response.status_code == 429 else "server_error"
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
         
+        if cancelled is not None and cancelled.is_set():
+            raise error
+        delay = fetch_retry_delay(attempt, started, reason, retry_after)
+        if delay is None:
+            raise error
+        logger.warning(f"Fetching {url} failed ({error}); retry {attempt + 1} in {delay:.1f}s")
+        if cancelled is None:
+            time.sleep(delay)
+        elif cancelled.wait(delay):
+            raise error
+
+def parse_and_extract(content, max_items, seen_tokens, price_range=None, profile=None, duplicates=None):
+    """Parse one downloaded page and extract its products in one go.
+
+    Returns (products, parse_seconds, extract_seconds). Used by the asyncio
+    path, which runs it on a worker thread to keep the event loop free.
+    """
+    started = time.perf_counter()
+    page = read_listing_page(content)
+    parsed = time.perf_counter()
+    products = list(iter_page_products(page, max_items, seen_tokens, price_range, duplicates))
+    extract_seconds = time.perf_counter() - parsed
+    if profile is not None:
+        profile.checkpoint()
+    return products, parsed - started, extract_seconds
+
+def record_page_timing(timing, trace=None):
+    """Keep one page's timings and add its stages to the latency histograms"""
+    page_timings.append(timing)
+    observe = trace.observe if trace is not None else metrics.observe
+    observe("fetch", timing["fetch_ms"] / 1000)
+    observe("parse", timing["parse_ms"] / 1000)
+    observe("extract", timing["extract_ms"] / 1000)
+
+def log_page_timings(query, city, timings, trace=None):
+    search = f"#{trace.search_id} " if trace is not None else ""
+    logger.info(f"Search {search}'{query}' in {city}: " + ", ".join(
+        f"page {t['page']} fetch {t['fetch_ms']:.0f}ms parse {t['parse_ms']:.0f}ms "
+        f"extract {t['extract_ms']:.0f}ms ({t['products']} products)" for t in timings))
+
+def iter_fetched_products(query: str, max_items: int, city: str = "tehran", min_price: int = None, max_price: int = None,
+                          trace=None):
+    """Download and parse Divar result pages until ``max_items`` products are found.
+
+    Page 1 is fetched alone; if it falls short, up to DIVAR_PAGE_FANOUT
+    further pages are fetched at once while earlier ones are extracted in
+    order, but no more than the missing products should take at the best
+    page's yield (see ``pages_wanted``). Listings repeated across pages are dropped by token, reposts of
+    the same ad by ``NearDuplicateIndex``, and paging stops at
+    DIVAR_MAX_PAGES or at the first page that adds nothing new. Bypasses
+    the result cache; every product found is queued on ``listing_index``.
+    """
+    seen_tokens = set()
+    duplicates = near_duplicate_index()
+    price_range = (min_price, max_price) if min_price is not None or max_price is not None else None
+    found = 0
+    per_page = 0
+    timings = []
+    in_flight = deque()
+    next_page = 2
+    profile = trace.profile if trace is not None else None
+    fetch = profile.wrap(fetch_listing_page) if profile is not None else fetch_listing_page
+    # Set when this generator stops, so fetches already running give up instead of retrying
+    abandoned = threading.Event()
+    
+    def submit(page):
+        url = build_search_url(query, city, min_price, max_price, page)
+        in_flight.append((page, page_executor.submit(fetch, url, abandoned)))
+    
+    submit(1)
+    try:
+        while in_flight:
+            page, future = in_flight.popleft()
+            try:
+                page_data, fetch_seconds, parse_seconds = future.result()
+            except Exception as e:
+                if page == 1:
+                    raise
+                logger.error(f"Error fetching page {page} for '{query}': {e}")
+                break
+            
+            extract_started = time.perf_counter()
+            seen_at = time.time()
+            page_found = 0
+            for product in iter_page_products(page_data, max_items - found, seen_tokens, price_range, duplicates):
+                page_found += 1
+                listing_index.add(product, city, seen_at)
+                yield product
+            found += page_found
+            if profile is not None:
+                profile.checkpoint()
+            
+            timing = {
+                "page": page,
+                "fetch_ms": fetch_seconds * 1000,
+                "parse_ms": parse_seconds * 1000,
+                "extract_ms": (time.perf_counter() - extract_started) * 1000,
+                "products": page_found,
+            }
+            timings.append(timing)
+            record_page_timing(timing, trace)
+            
+            if found >= max_items or not page_found:
+                break
+            
+            per_page = max(per_page, page_found)
+            while len(in_flight) < pages_wanted(max_items - found, per_page) and next_page <= DIVAR_MAX_PAGES:
+                submit(next_page)
+                next_page += 1
+    finally:
+        abandoned.set()
+        for _, future in in_flight:
+            future.cancel()
+        if timings:
+            log_page_timings(query, city, timings, trace)
+
+def pages_wanted(missing, per_page):
+    """Further pages worth having in flight for ``missing`` products at ``per_page`` products a page"""
+    return min(DIVAR_PAGE_FANOUT, -(-missing // per_page))
+
+def extract_products(soup, max_items):
+    """Extract up to ``max_items`` valid products from a parsed search page"""
+    return list(iter_products(soup, max_items))
+
+def is_new_listing(product, seen_tokens):
+    """False if the product's token is already in ``seen_tokens``; otherwise records it"""
+    if seen_tokens is None:
+        return True
+    token = listing_token(product.get('url'))
+    if token is None:
+        return True
+    if token in seen_tokens:
+        return False
+    seen_tokens.add(token)
+    return True
+
+def price_in_range(product, price_range):
+    """False only when the product has a known price outside ``price_range`` = (min_price, max_price)"""
+    value = product.get('price_value')
+    if value is None or price_range is None:
+        return True
+    min_price, max_price = price_range
+    return (min_price is None or value >= min_price) and (max_price is None or value <= max_price)
+
+def iter_page_products(page, max_items, seen_tokens=None, price_range=None, duplicates=None):
+    """Products of a page from ``fetch_listing_page``: its embedded listings or its parsed tree"""
+    if isinstance(page, list):
+        return iter_structured_products(page, max_items, seen_tokens, price_range, duplicates)
+    return iter_products(page, max_items, seen_tokens, price_range, duplicates)
+
+def iter_products(soup, max_items, seen_tokens=None, price_range=None, duplicates=None):
+    """Yield up to ``max_items`` valid products from a parsed search page.
+
+    When ``seen_tokens`` is given, listings already in it are skipped and
+    the tokens of yielded listings are added to it. With ``price_range``,
+    listings whose parsed price falls outside it are dropped too, in case
+    Divar's own price filter let them through, and with ``duplicates`` (a
+    ``NearDuplicateIndex``) so are reposts of a listing already yielded.
+    Found, filtered and repeated listings are counted in ``metrics`` per
+    extraction method.
+    """
+    found = 0
+    filtered = 0
+    repeated = 0
+    near_duplicates = 0
+    out_of_range = 0
+    method = "links"
+    
+    def is_new(product):
+        nonlocal repeated, near_duplicates
+        if not is_new_listing(product, seen_tokens):
+            repeated += 1
+            return False
+        if duplicates is not None and duplicates.is_duplicate(product):
+            near_duplicates += 1
+            return False
+        return True
+    
+    try:
         # Method 1: Look for product links with specific patterns
-        product_links = soup.find_all('a', href=re.compile(r'/v/[^/]+'))
+        product_links = soup.find_all('a', href=LISTING_HREF_RE)
         
-        for link in product_links[:max_items * 2]:  # Get more to filter later
+        for link in product_links:
             try:
                 product = extract_product_from_link(link)
-                if product and is_valid_product(product):
-                    results.append(product)
-                    if len(results) >= max_items:
-                        break
             except Exception as e:
                 logger.error(f"Error extracting product from link: {e}")
                 continue
+            if not product:
+                continue
+            if not is_valid_product(product):
+                filtered += 1
+            elif not price_in_range(product, price_range):
+                out_of_range += 1
+            elif is_new(product):
+                found += 1
+                yield product
+                if found >= max_items:
+                    return
         
         # Method 2: If no results, try alternative selectors
-        if not results:
+        if not found:
             logger.info("Trying alternative extraction method...")
-            containers = soup.find_all(['article', 'div'], attrs={'class': re.compile(r'post|item|card')})
+            method = "containers"
+            containers = soup.find_all(['article', 'div'], attrs={'class': CARD_CLASS_RE})
             
-            for container in containers[:max_items * 2]:
+            for container in containers:
                 try:
                     product = extract_product_from_container(container)
-                    if product and is_valid_product(product):
-                        results.append(product)
-                        if len(results) >= max_items:
-                            break
-                except Exception as e:
+                except Exception:
                     continue
-        
-        return results[:max_items]
-    
-    except Exception as e:
-        logger.error(f"Error scraping Divar: {e}")
-        return []
+                if not product:
+                    continue
+                if not is_valid_product(product):
+                    filtered += 1
+                elif not price_in_range(product, price_range):
+                    out_of_range += 1
+                elif is_new(product):
+                    found += 1
+                    yield product
+                    if found >= max_items:
+                        return
+    finally:
+        metrics.inc("extracted_pages_total", method=method)
+        metrics.inc("results_found_total", found, method=method)
+        metrics.inc("results_filtered_total", filtered, reason="invalid")
+        metrics.inc("results_filtered_total", repeated, reason="repeated")
+        metrics.inc("results_filtered_total", near_duplicates, reason="near_duplicate")
+        metrics.inc("results_filtered_total", out_of_range, reason="price")
+
+# Precompiled patterns and keyword matchers used by the extractors
+WHITESPACE_RE = re.compile(r'\s+')
+SRCSET_URL_RE = re.compile(r'(https?://[^\s,]+)')
+IMAGE_URL_HINT_RE = re.compile(r'\.jpg|\.jpeg|\.png|\.gif|\.bmp|\.webp|cdn|img|image|static|media')
+SUSPICIOUS_URL_RE = re.compile(r'javascript:|data:|blob:|file:')
+
+SERVICE_AD_KEYWORDS = (
+    'تعمیرکار', 'تعمیرات', 'نصب', 'سرویس', 'خدمات',
+    'تعمیر', 'نگهداری', 'راه اندازی', 'پشتیبانی'
+)
+SERVICE_AD_RE = re.compile('|'.join(map(re.escape, SERVICE_AD_KEYWORDS)))
+
+TITLE_EXCLUDE_RE = re.compile('تومان|ساعت|دقیقه')
+LINK_TIME_RE = re.compile('ساعت|دقیقه|روز|هفته|ماه')
+LINK_CONDITION_RE = re.compile('نو|کارکرده|سالم|معاوضه')
+CONTAINER_META_RE = re.compile('در |ساعت|دقیقه|نو|کارکرده')
+
+TITLE_CANDIDATE_TAGS = frozenset(('h1', 'h2', 'h3', 'h4', 'span', 'div'))
+SECONDARY_HEADING_TAGS = frozenset(('h1', 'h3', 'h4'))
+NO_META_TEXT = "اطلاعات کامل در لینک موجود است"
+
+# Price and listing age parsing; one str.translate maps Persian/Arabic digits and drops thousands separators.
+# "." and "٫" are thousands separators in groups of three digits ("1.500.000") and a decimal point before 1-2 digits
+PRICE_TRANSLATION = str.maketrans({
+    **{digit: str(value) for value, digit in enumerate("۰۱۲۳۴۵۶۷۸۹")},
+    **{digit: str(value) for value, digit in enumerate("٠١٢٣٤٥٦٧٨٩")},
+    "٬": None, ",": None, "٫": ".",
+})
+PRICE_NUMBER_RE = re.compile(r'(\d{1,3}(?:\.\d{3})+(?!\d)|\d+(?:\.\d{1,2}(?!\d))?)\s*(هزار|میلیون|میلیارد)?')
+PRICE_MULTIPLIERS = {None: 1, "هزار": 1000, "میلیون": 1000000, "میلیارد": 1000000000}
+FREE_PRICE_RE = re.compile('رایگان|مجانی')
+# A unit is a whole word ("ماه" but not "ماهشهر") after a number, or followed by "پیش" ("هفته پیش")
+AGE_RE = re.compile(r'(?:(\d+)\s*|(?<![^\W\d_]))(دقیقه|ساعت|روز|هفته|ماه)(?![^\W\d_])(?(1)|\s*پیش)')
+AGE_UNIT_MINUTES = {"دقیقه": 1, "ساعت": 60, "روز": 24 * 60, "هفته": 7 * 24 * 60, "ماه": 30 * 24 * 60}
+AGE_PHRASE_MINUTES = (("لحظاتی", 0), ("دقایقی", 5), ("ربع ساعت", 15), ("نیم ساعت", 30),
+                      ("پریروز", 2 * 24 * 60), ("دیروز", 24 * 60))
+
+class CardScan:
+    """Everything the extractors need from one listing card, gathered in a single walk"""
+
+    __slots__ = ('h2', 'heading', 'img', 'listing_link', 'title_candidates', 'strings')
+
+    def __init__(self, element, want_title_candidates=False):
+        self.h2 = None
+        self.heading = None
+        self.img = None
+        self.listing_link = None
+        self.title_candidates = [] if want_title_candidates else None
+        self.strings = []
+
+        for node in element.descendants:
+            if isinstance(node, NavigableString):
+                self.strings.append(node)
+                continue
+            name = node.name
+            if name == 'h2':
+                if self.h2 is None:
+                    self.h2 = node
+            elif name in SECONDARY_HEADING_TAGS:
+                if self.heading is None:
+                    self.heading = node
+            elif name == 'img':
+                if self.img is None:
+                    self.img = node
+            elif name == 'a':
+                if self.listing_link is None and '/v/' in (node.get('href') or ''):
+                    self.listing_link = node
+            if want_title_candidates and name in TITLE_CANDIDATE_TAGS:
+                self.title_candidates.append(node)
+
+def _absolute_listing_url(href):
+    return f"https://divar.ir{href}" if href.startswith('/') else href
+
+def _first_price(strings, max_length=None):
+    for price_elem in strings:
+        if 'تومان' not in price_elem:
+            continue
+        price_text = price_elem.strip()
+        if max_length is None or len(price_text) < max_length:
+            return WHITESPACE_RE.sub(' ', price_text)
+    return "قیمت نامشخص"
+
+def parse_price(text):
+    """Price in toman from text like "۱۵٬۰۰۰٬۰۰۰ تومان" or "۲٫۵ میلیارد تومان".
+
+    Free items are 0; "توافقی" and other prices without a number are None.
+    """
+    if not text:
+        return None
+    match = PRICE_NUMBER_RE.search(text.translate(PRICE_TRANSLATION))
+    if match is None:
+        return 0 if FREE_PRICE_RE.search(text) else None
+    number = match.group(1)
+    if '.' not in number:
+        value = int(number)
+    elif len(number) - number.rindex('.') == 4:
+        value = int(number.replace('.', ''))
+    else:
+        value = float(number)
+    value = int(value * PRICE_MULTIPLIERS[match.group(2)])
+    return value // 10 if 'ریال' in text else value
+
+def parse_age_minutes(meta):
+    """Minutes since a listing was posted, from meta text like "۲ ساعت پیش در ونک", or None"""
+    if not meta:
+        return None
+    for phrase, minutes in AGE_PHRASE_MINUTES:
+        if phrase in meta:
+            return minutes
+    match = AGE_RE.search(meta.translate(PRICE_TRANSLATION))
+    if match is None:
+        return None
+    return int(match.group(1) or 1) * AGE_UNIT_MINUTES[match.group(2)]
+
+def _absolute_image_url(url):
+    if url.startswith('//'):
+        return 'https:' + url
+    if url.startswith('/'):
+        return 'https://divar.ir' + url
+    return url
 
 def extract_product_from_container(container):
     """Alternative method to extract product info from any container"""
     product = {}
     
     try:
+        scan = CardScan(container, want_title_candidates=True)
+
         # Find any link inside container
-        link = container.find('a', href=re.compile(r'/v/'))
-        if link:
-            href = link.get('href')
-            product['url'] = f"https://divar.ir{href}" if href.startswith('/') else href
+        if scan.listing_link is not None:
+            product['url'] = _absolute_listing_url(scan.listing_link.get('href'))
         
         # Extract title from multiple possible elements
-        title_candidates = container.find_all(['h1', 'h2', 'h3', 'h4', 'span', 'div'])
         title = None
-        
-        for candidate in title_candidates:
+        for candidate in scan.title_candidates:
             text = candidate.get_text(strip=True)
-            if text and 5 <= len(text) <= 200 and not any(x in text.lower() for x in ['تومان', 'ساعت', 'دقیقه']):
+            if text and 5 <= len(text) <= 200 and not TITLE_EXCLUDE_RE.search(text.lower()):
                 title = text
                 break
         
         if not title:
             return None
         
-        product['title'] = re.sub(r'\s+', ' ', title)
-        
-        # Extract price
-        price_elements = container.find_all(string=re.compile(r'تومان'))
-        price = "قیمت نامشخص"
-        
-        for price_elem in price_elements:
-            if price_elem and isinstance(price_elem, str):
-                price_text = price_elem.strip()
-                if 'تومان' in price_text and len(price_text) < 100:
-                    price = re.sub(r'\s+', ' ', price_text)
-                    break
-        
-        product['price'] = price
+        product['title'] = WHITESPACE_RE.sub(' ', title)
+        product['price'] = _first_price(scan.strings, max_length=100)
+        product['price_value'] = parse_price(product['price'])
         
         # Extract image with better validation
-        img_element = container.find('img')
-        if img_element:
-            img_candidates = [
+        img_element = scan.img
+        if img_element is not None:
+            img_candidates = (
                 img_element.get('src'),
                 img_element.get('data-src'),
                 img_element.get('data-lazy-src'),
                 img_element.get('srcset'),
                 img_element.get('data-srcset')
-            ]
+            )
             
             for candidate in img_candidates:
                 if candidate and is_valid_image_url(candidate):
                     # Clean srcset if needed
                     if 'srcset' in str(candidate):
                         # Extract first URL from srcset
-                        urls = re.findall(r'(https?://[^\s,]+)', candidate)
+                        urls = SRCSET_URL_RE.findall(candidate)
                         if urls:
                             candidate = urls[0]
                     
-                    if candidate.startswith('//'):
-                        candidate = 'https:' + candidate
-                    elif candidate.startswith('/'):
-                        candidate = 'https://divar.ir' + candidate
-                    
-                    cleaned_url = clean_image_url(candidate)
+                    cleaned_url = clean_image_url(_absolute_image_url(candidate))
                     if cleaned_url:
                         product['image_url'] = cleaned_url
                         break
         
         # Extract meta information
         meta_info = []
-        all_texts = container.find_all(string=True)
-        
-        for text in all_texts:
+        for text in scan.strings:
             text = text.strip()
-            if text and 3 <= len(text) <= 30:
-                if any(indicator in text for indicator in ['در ', 'ساعت', 'دقیقه', 'نو', 'کارکرده']):
-                    if text not in meta_info:
-                        meta_info.append(text)
-                        if len(meta_info) >= 3:
-                            break
+            if 3 <= len(text) <= 30 and CONTAINER_META_RE.search(text) and text not in meta_info:
+                meta_info.append(text)
+                if len(meta_info) >= 3:
+                    break
         
-        product['meta'] = " | ".join(meta_info) if meta_info else "اطلاعات کامل در لینک موجود است"
+        product['meta'] = " | ".join(meta_info) if meta_info else NO_META_TEXT
         
         return product
         
@@ -237,77 +3058,48 @@ def extract_product_from_link(link_element):
         # Extract URL
         href = link_element.get('href')
         if href:
-            product['url'] = f"https://divar.ir{href}" if href.startswith('/') else href
+            product['url'] = _absolute_listing_url(href)
         
-        # Find the container that holds all product info
-        container = link_element
+        scan = CardScan(link_element)
         
         # Extract title - look for h2 or the main title element
-        title_element = container.find('h2')
-        if not title_element:
-            title_element = container.find(['h1', 'h3', 'h4'])
-        if not title_element:
+        title_element = scan.h2 or scan.heading
+        if title_element is None:
             # Look for title in nested divs
-            title_element = container.find('div', string=True)
+            title_element = link_element.find('div', string=True)
         
-        if title_element:
-            title = title_element.get_text(strip=True)
-            # Clean title from extra characters
-            title = re.sub(r'\s+', ' ', title)
-            product['title'] = title
-        else:
+        if not title_element:
             return None
         
-        # Extract price - look for elements containing "تومان"
-        price_elements = container.find_all(string=re.compile(r'تومان'))
-        price = "قیمت نامشخص"
-        
-        for price_elem in price_elements:
-            price_text = price_elem.strip()
-            if price_text and 'تومان' in price_text:
-                # Clean and format price
-                price = re.sub(r'\s+', ' ', price_text)
-                break
-        
-        product['price'] = price
+        product['title'] = WHITESPACE_RE.sub(' ', title_element.get_text(strip=True))
+        product['price'] = _first_price(scan.strings)
+        product['price_value'] = parse_price(product['price'])
         
         # Extract image
-        img_element = container.find('img')
-        if img_element:
+        img_element = scan.img
+        if img_element is not None:
             img_src = img_element.get('src') or img_element.get('data-src') or img_element.get('data-lazy-src')
             if img_src and is_valid_image_url(img_src):
                 # Make sure URL is complete and clean
-                if img_src.startswith('//'):
-                    img_src = 'https:' + img_src
-                elif img_src.startswith('/'):
-                    img_src = 'https://divar.ir' + img_src
-                
-                # Clean URL from invalid characters
-                img_src = clean_image_url(img_src)
+                img_src = clean_image_url(_absolute_image_url(img_src))
                 if img_src:
                     product['image_url'] = img_src
         
-        # Extract metadata (location, time, etc.)
+        # Extract metadata (location, time, condition), keeping the first three unique entries
         meta_info = []
-        
-        # Look for location and time info
-        text_elements = container.find_all(string=True)
-        for text in text_elements:
+        for text in scan.strings:
             text = text.strip()
-            if text and len(text) > 2:
-                # Check if it's location info (contains "در")
-                if 'در ' in text and len(text) < 50:
-                    meta_info.append(text)
-                # Check if it's time info (contains time indicators)
-                elif any(word in text for word in ['ساعت', 'دقیقه', 'روز', 'هفته', 'ماه']) and len(text) < 30:
-                    meta_info.append(text)
-                # Check if it's condition info
-                elif any(word in text for word in ['نو', 'کارکرده', 'سالم', 'معاوضه']) and len(text) < 20:
-                    meta_info.append(text)
-        
-        # Remove duplicates and join
-        meta_info = list(dict.fromkeys(meta_info))  # Remove duplicates while preserving order
-        product['meta'] = " | ".join(meta_info[:3]) if meta_info else "اطلاعات کامل در لینک موجود است"
+            length = len(text)
+            if length <= 2 or text in meta_info:
+                continue
+            if ('در ' in text and length < 50) \
+                    or (length < 30 and LINK_TIME_RE.search(text)) \
+                    or (length < 20 and LINK_CONDITION_RE.search(text)):
+                meta_info.append(text)
+                if len(meta_info) >= 3:
+                    break
+        
+        product['meta'] = " | ".join(meta_info) if meta_info else NO_META_TEXT
         
         return product
         
@@ -320,20 +3112,8 @@ def is_valid_image_url(url):
     if not url:
         return False
     
-    # Check for valid image extensions
-    valid_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
-    url_lower = url.lower()
-    
-    # Check if URL contains valid image indicators
-    if any(ext in url_lower for ext in valid_extensions):
-        return True
-    
-    # Check for common image hosting patterns
-    image_patterns = ['cdn', 'img', 'image', 'static', 'media']
-    if any(pattern in url_lower for pattern in image_patterns):
-        return True
-    
-    return False
+    # Valid image extensions or common image hosting patterns
+    return IMAGE_URL_HINT_RE.search(url.lower()) is not None
 
 def clean_image_url(url):
     """Clean and validate image URL for Telegram"""
@@ -341,24 +3121,20 @@ def clean_image_url(url):
         return None
     
     try:
-        # Remove invalid characters that Telegram doesn't accept
-        import urllib.parse
-        
         # Parse URL to check if it's valid
-        parsed = urllib.parse.urlparse(url)
+        parsed = urlparse(url)
         if not parsed.netloc:
             return None
         
         # Reconstruct clean URL
-        clean_url = urllib.parse.urlunparse(parsed)
+        clean_url = urlunparse(parsed)
         
         # Additional validation
         if len(clean_url) > 2048:  # Telegram URL limit
             return None
         
         # Check for suspicious patterns
-        suspicious = ['javascript:', 'data:', 'blob:', 'file:']
-        if any(pattern in clean_url.lower() for pattern in suspicious):
+        if SUSPICIOUS_URL_RE.search(clean_url.lower()):
             return None
         
         return clean_url
@@ -368,31 +3144,298 @@ def clean_image_url(url):
 
 def is_valid_product(product):
     """Check if extracted product data is valid"""
-    if not product.get('title'):
+    title = product.get('title')
+    if not title:
         return False
     
-    title = product['title'].lower()
-    
     # Filter out service ads
-    invalid_keywords = [
-        'تعمیرکار', 'تعمیرات', 'نصب', 'سرویس', 'خدمات', 
-        'تعمیر', 'نگهداری', 'راه اندازی', 'پشتیبانی'
-    ]
-    
-    for keyword in invalid_keywords:
-        if keyword in title:
-            return False
+    if SERVICE_AD_RE.search(title.lower()):
+        return False
     
     # Check if title is too short or too long
-    if len(product['title']) < 5 or len(product['title']) > 200:
+    if len(title) < 5 or len(title) > 200:
         return False
     
     return True
 
+NON_WORD_RE = re.compile(r'[^\w\s]')
+LETTER_DIGIT_RE = re.compile(r'(?<=\d)(?=[^\W\d_])|(?<=[^\W\d_])(?=\d)')
+MODEL_TOKEN_RE = re.compile(r'[a-z]*\d+[a-z]*')
+
+def listing_title_words(product):
+    """Words of a listing's title with letter variants, digits and punctuation normalized"""
+    return NON_WORD_RE.sub(" ", normalize_search_text(product.get('title'))).split()
+
+def listing_model_key(product):
+    """Numbers and model codes in a listing's title (``206``, ``a54``, ``5g``); reposts keep them all"""
+    return frozenset(token for word in listing_title_words(product) for token in MODEL_TOKEN_RE.findall(word))
+
+def listing_fingerprint(product, weights=NEAR_DUPLICATE_WEIGHTS):
+    """64-bit SimHash of a listing's normalized title trigrams and image path.
+
+    Trigrams are taken with the spaces removed, so «پرو مکس» and «پرومکس»
+    or «۷ نفره» and «7نفره» fingerprint alike, and filler words such as
+    «تمیز» or «در حد نو» are left out.
+    """
+    words = LETTER_DIGIT_RE.sub(" ", " ".join(listing_title_words(product))).split()
+    compact = "".join(word for word in words if word not in NEAR_DUPLICATE_FILLER_WORDS)
+    features = {f"t:{compact[i:i + 3]}": weights["trigram"] for i in range(len(compact) - 2)}
+    if product.get('image_url'):
+        # The path names the photo; hosts and resize parameters vary between copies
+        features[f"i:{urlsplit(product['image_url']).path}"] = weights["image"]
+
+    # Sum each bit column over all features of one weight at a time, as bit strings
+    by_weight = {}
+    for feature, weight in features.items():
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        by_weight.setdefault(weight, []).append(format(int.from_bytes(digest, "big"), "064b"))
+    totals = [0] * NearDuplicateIndex.BITS
+    for weight, digests in by_weight.items():
+        for bit, column in enumerate(zip(*digests)):
+            totals[bit] += weight * (2 * column.count("1") - len(digests))
+    return int("".join("1" if total > 0 else "0" for total in totals), 2)
+
+class NearDuplicateIndex:
+    """Fingerprints of the listings already in one result set, to spot reposts of the same ad.
+
+    Two listings count as one ad when their ``listing_model_key`` is the
+    same, their prices are within ``NEAR_DUPLICATE_PRICE_RATIO`` of each
+    other and their ``listing_fingerprint`` differ in at most
+    ``max_distance`` bits. Fingerprints are cut into
+    ``max_distance + 1`` bands and filed under each band's value: two
+    fingerprints that close must agree on at least one whole band, so a
+    check compares only the few listings sharing a bucket, never every pair.
+    """
+
+    BITS = 64
+
+    def __init__(self, max_distance=NEAR_DUPLICATE_MAX_DISTANCE):
+        if not 0 <= max_distance < self.BITS:
+            raise ValueError(f"Near-duplicate distance must be between 0 and {self.BITS - 1}: {max_distance}")
+        self.max_distance = max_distance
+        width, wider = divmod(self.BITS, max_distance + 1)
+        self._bands = []                 # (shift, mask) of each band
+        shift = 0
+        for band in range(max_distance + 1):
+            bits = width + (1 if band < wider else 0)
+            self._bands.append((shift, (1 << bits) - 1))
+            shift += bits
+        self._buckets = {}               # (band, value) -> (fingerprint, model key, price) of listings
+        self.suppressed = 0
+
+    def is_duplicate(self, product):
+        """True if ``product`` is a near copy of a listing seen before; otherwise remembers it"""
+        fingerprint = listing_fingerprint(product)
+        model_key = listing_model_key(product)
+        price = product.get('price_value')
+        keys = [(band, fingerprint >> shift & mask) for band, (shift, mask) in enumerate(self._bands)]
+        for key in keys:
+            for other, other_model_key, other_price in self._buckets.get(key, ()):
+                if other_model_key != model_key or bin(fingerprint ^ other).count("1") > self.max_distance:
+                    continue
+                if price and other_price and max(price, other_price) > NEAR_DUPLICATE_PRICE_RATIO * min(price, other_price):
+                    continue
+                self.suppressed += 1
+                return True
+        entry = (fingerprint, model_key, price)
+        for key in keys:
+            self._buckets.setdefault(key, []).append(entry)
+        return False
+
+def near_duplicate_index():
+    """A fresh ``NearDuplicateIndex`` for one result set, or None when the filter is off"""
+    return NearDuplicateIndex() if NEAR_DUPLICATE_FILTER else None
+
+# Listing data embedded in search pages: schema.org JSON-LD and the web app's hydration state
+JSON_LD_RE = re.compile(rb'<script[^>]+type=["\']application/ld\+json["\'][^>]*>(.*?)</script>', re.S | re.I)
+HYDRATION_STATE_RE = re.compile(rb'window\.__PRELOADED_STATE__\s*=\s*|<script[^>]+id=["\']__NEXT_DATA__["\'][^>]*>')
+SCRIPT_END = b'</script>'
+PERSIAN_DIGITS = str.maketrans("0123456789", "۰۱۲۳۴۵۶۷۸۹")
+_json_decoder = json.JSONDecoder()
+
+def _embedded_json(content):
+    """Decoded hydration state objects and JSON-LD blocks of a page"""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    payloads = []
+    # The hydration state first: it has the price and meta lines as shown on the site
+    for match in HYDRATION_STATE_RE.finditer(content):
+        end = content.find(SCRIPT_END, match.end())
+        if end == -1:
+            continue
+        try:
+            # raw_decode stops at the end of the object, before any trailing ";"
+            payloads.append(_json_decoder.raw_decode(content[match.end():end].decode('utf-8', 'replace').strip())[0])
+        except ValueError:
+            continue
+    for match in JSON_LD_RE.finditer(content):
+        try:
+            payloads.append(json.loads(match.group(1)))
+        except ValueError:
+            continue
+    return payloads
+
+def _json_objects(document):
+    """Every object in a decoded JSON document, parents before children, in document order"""
+    stack = [document]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            yield node
+            stack.extend(value for value in reversed(list(node.values())) if isinstance(value, (dict, list)))
+        elif isinstance(node, list):
+            stack.extend(value for value in reversed(node) if isinstance(value, (dict, list)))
+
+def _json_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(float(value))
+        except ValueError:
+            return None
+    return None
+
+def _json_image(value):
+    """First usable image URL of a JSON-LD ``image`` or hydration ``image_url`` value"""
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if isinstance(value, dict):
+        value = value.get('url') or value.get('src') or value.get('contentUrl')
+    if isinstance(value, str) and is_valid_image_url(value):
+        return clean_image_url(_absolute_image_url(value))
+    return None
+
+def _structured_listing(node):
+    """(token, product) from one JSON-LD ``Product`` or hydration-state post object, or None.
+
+    Fields the object lacks are None, including the URL of a post that only has a token.
+    """
+    kind = node.get('@type')
+    token = None
+    if kind == 'Product' or (isinstance(kind, list) and 'Product' in kind):
+        title = node.get('name')
+        url = node.get('url') or node.get('@id')
+        image = node.get('image')
+        offers = node.get('offers')
+        if isinstance(offers, list):
+            offers = offers[0] if offers else None
+        price_text = None
+        price_value = None
+        if isinstance(offers, dict):
+            price_value = _json_number(offers.get('price', offers.get('lowPrice')))
+            if price_value is not None and offers.get('priceCurrency') == 'IRR':
+                price_value //= 10  # prices are shown in toman
+        meta = None
+    else:
+        title = node.get('title')
+        action = node.get('action')
+        payload = action.get('payload') if isinstance(action, dict) else None
+        token = node.get('token') or (payload.get('token') if isinstance(payload, dict) else None)
+        if not isinstance(token, str) or not token:
+            return None
+        url = node.get('url')
+        image = node.get('image_url')
+        price_text = node.get('middle_description_text')
+        price_value = _json_number(node.get('price'))
+        meta = node.get('bottom_description_text')
+
+    if not isinstance(title, str):
+        return None
+    url = _absolute_listing_url(url) if isinstance(url, str) else None
+    url_token = listing_token(url)
+    if url_token is None:
+        url = None  # not a listing page; posts fall back to their token
+    else:
+        token = url_token
+    if not token:
+        return None
+
+    return token, {
+        'url': url,
+        'title': WHITESPACE_RE.sub(' ', title.strip()),
+        'price': WHITESPACE_RE.sub(' ', price_text.strip()) if isinstance(price_text, str) and price_text.strip() else None,
+        'price_value': price_value,
+        'image_url': _json_image(image),
+        'meta': WHITESPACE_RE.sub(' ', meta.strip()) if isinstance(meta, str) and meta.strip() else None,
+    }
+
+def extract_structured_listings(content):
+    """Listings embedded in a search page as JSON, or None when it carries none.
+
+    Reads post objects (a ``title`` plus a listing ``token``) from the
+    hydration state in ``window.__PRELOADED_STATE__`` or ``__NEXT_DATA__``
+    and schema.org ``Product`` entries from JSON-LD blocks, without
+    building an HTML tree; a listing found in both is kept once. Unlike the HTML extractors it keeps the
+    numeric price as ``price_value``. Products are not validated here.
+    """
+    by_token = {}
+    for document in _embedded_json(content):
+        for node in _json_objects(document):
+            found = _structured_listing(node)
+            if found is None:
+                continue
+            token, product = found
+            known = by_token.get(token)
+            if known is None:
+                by_token[token] = product
+                continue
+            for key, value in product.items():
+                if known[key] is None:
+                    known[key] = value
+
+    listings = []
+    for token, product in by_token.items():
+        if product['url'] is None:
+            product['url'] = f"https://divar.ir/v/{token}"
+        if product['price_value'] is None:
+            product['price_value'] = parse_price(product['price'])
+        if product['price'] is None:
+            product['price'] = (f"{product['price_value']:,}".replace(",", "٬").translate(PERSIAN_DIGITS) + " تومان"
+                                if product['price_value'] else "قیمت نامشخص")
+        if product['image_url'] is None:
+            del product['image_url']
+        if product['meta'] is None:
+            product['meta'] = NO_META_TEXT
+        listings.append(product)
+    return listings or None
+
+def iter_structured_products(listings, max_items, seen_tokens=None, price_range=None, duplicates=None):
+    """Yield up to ``max_items`` valid products from ``extract_structured_listings`` output"""
+    found = 0
+    filtered = 0
+    repeated = 0
+    near_duplicates = 0
+    out_of_range = 0
+    try:
+        for product in listings:
+            if not is_valid_product(product):
+                filtered += 1
+            elif not price_in_range(product, price_range):
+                out_of_range += 1
+            elif not is_new_listing(product, seen_tokens):
+                repeated += 1
+            elif duplicates is not None and duplicates.is_duplicate(product):
+                near_duplicates += 1
+            else:
+                found += 1
+                yield product
+                if found >= max_items:
+                    return
+    finally:
+        metrics.inc("extracted_pages_total", method="structured")
+        metrics.inc("results_found_total", found, method="structured")
+        metrics.inc("results_filtered_total", filtered, reason="invalid")
+        metrics.inc("results_filtered_total", repeated, reason="repeated")
+        metrics.inc("results_filtered_total", near_duplicates, reason="near_duplicate")
+        metrics.inc("results_filtered_total", out_of_range, reason="price")
+
 @bot.message_handler(commands=['start'])
 def send_welcome(message):
     user_id = message.from_user.id
-    user_states[user_id] = {}
+    state_store.discard(user_id)
     welcome_text = """🔍 سلام! به ربات جستجوی پیشرفته دیوار خوش آمدید
 
 ✨ امکانات جدید:
@@ -406,19 +3449,98 @@ def send_welcome(message):
     bot.send_message(message.chat.id, welcome_text)
     show_main_menu(message.chat.id)
 
-def show_main_menu(chat_id):
+MAIN_MENU_TEXT = "چه کاری برایتان انجام دهم؟"
+
+def main_menu_keyboard():
     keyboard = telebot.types.InlineKeyboardMarkup(row_width=1)
     keyboard.add(
         telebot.types.InlineKeyboardButton("🛍️ جستوجوی محصول", callback_data="start_search"),
+        telebot.types.InlineKeyboardButton("⚙️ نحوه نمایش نتایج", callback_data="delivery_settings"),
         telebot.types.InlineKeyboardButton("ℹ️ راهنما", callback_data="help")
     )
-    bot.send_message(chat_id, "چه کاری برایتان انجام دهم؟", reply_markup=keyboard)
+    return keyboard
+
+def show_main_menu(chat_id):
+    outbox.send_message(chat_id, MAIN_MENU_TEXT, reply_markup=main_menu_keyboard())
+
+def watch_offer_keyboard():
+    keyboard = telebot.types.InlineKeyboardMarkup(row_width=1)
+    keyboard.add(telebot.types.InlineKeyboardButton("🔔 آگهی‌های جدید این جستجو را خبر بده", callback_data="watch_last"))
+    return keyboard
+
+def get_delivery_mode(user_id):
+    return user_settings.get(user_id, {}).get("delivery_mode", DEFAULT_DELIVERY_MODE)
+
+def get_sort_order(user_id):
+    return user_settings.get(user_id, {}).get("sort_order", DEFAULT_SORT_ORDER)
+
+def get_search_source(user_id):
+    return user_settings.get(user_id, {}).get("search_source", DEFAULT_SEARCH_SOURCE)
+
+def delivery_settings_keyboard(user_id):
+    current = get_delivery_mode(user_id)
+    keyboard = telebot.types.InlineKeyboardMarkup(row_width=1)
+    for mode, label in DELIVERY_MODES.items():
+        prefix = "✅ " if mode == current else ""
+        keyboard.add(telebot.types.InlineKeyboardButton(prefix + label, callback_data=f"delivery_{mode}"))
+    current_order = get_sort_order(user_id)
+    keyboard.row_width = 2
+    keyboard.add(*[
+        telebot.types.InlineKeyboardButton(("✅ " if order == current_order else "") + label,
+                                           callback_data=f"sort_{order}")
+        for order, label in SORT_ORDERS.items()
+    ])
+    current_source = get_search_source(user_id)
+    keyboard.add(*[
+        telebot.types.InlineKeyboardButton(("✅ " if source == current_source else "") + label,
+                                           callback_data=f"source_{source}")
+        for source, label in SEARCH_SOURCES.items()
+    ])
+    return keyboard
+
+@bot.callback_query_handler(func=lambda call: call.data == "delivery_settings")
+def show_delivery_settings(call):
+    bot.send_message(call.message.chat.id, "⚙️ نتایج جستجو چطور ارسال شوند؟\n\n"
+                     "🗂 کارت به کارت: هر آگهی در یک پیام جدا\n"
+                     "🖼 آلبومی: تصاویر در آلبوم‌های ۱۰تایی و بقیه در یک پیام\n"
+                     "📑 ورق‌زدنی: همه نتایج در یک پیام با دکمه‌های صفحه بعد و قبل و نمایش عکس\n\n"
+                     "↕️ ترتیب نتایج: ترتیب دیوار، بر اساس قیمت یا جدیدترین آگهی‌ها\n\n"
+                     "⚡ آگهی‌های ذخیره‌شده: اگر آگهی‌های کافی در چند دقیقه اخیر دیده شده باشند، "
+                     "نتایج بدون مراجعه به دیوار و فوری ارسال می‌شوند",
+                     reply_markup=delivery_settings_keyboard(call.from_user.id))
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("sort_") and call.data[len("sort_"):] in SORT_ORDERS)
+def handle_sort_order(call):
+    user_id = call.from_user.id
+    order = call.data[len("sort_"):]
+    user_settings.update(user_id, sort_order=order)
+    
+    bot.edit_message_text(f"✅ ترتیب نتایج: {SORT_ORDERS[order]}", call.message.chat.id,
+                          call.message.message_id, reply_markup=delivery_settings_keyboard(user_id))
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("source_") and call.data[len("source_"):] in SEARCH_SOURCES)
+def handle_search_source(call):
+    user_id = call.from_user.id
+    source = call.data[len("source_"):]
+    user_settings.update(user_id, search_source=source)
+    
+    bot.edit_message_text(f"✅ منبع نتایج: {SEARCH_SOURCES[source]}", call.message.chat.id,
+                          call.message.message_id, reply_markup=delivery_settings_keyboard(user_id))
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("delivery_") and call.data[len("delivery_"):] in DELIVERY_MODES)
+def handle_delivery_mode(call):
+    user_id = call.from_user.id
+    mode = call.data[len("delivery_"):]
+    user_settings.update(user_id, delivery_mode=mode)
+    
+    bot.edit_message_text(f"✅ نحوه نمایش نتایج: {DELIVERY_MODES[mode]}", call.message.chat.id,
+                          call.message.message_id, reply_markup=delivery_settings_keyboard(user_id))
 
 @bot.callback_query_handler(func=lambda call: call.data == "start_search")
 def start_search(call):
     chat_id = call.message.chat.id
     user_id = call.from_user.id
-    user_states[user_id] = {"step": "waiting_product_name"}
+    state_store.start(user_id, "waiting_product_name")
     
     bot.send_message(chat_id, "📝 نام محصول مورد نظر خود را وارد کنید:\n\n💡 مثال: لپ تاپ ایسوس، گوشی سامسونگ، ماشین لباسشویی ال جی")
 
@@ -439,15 +3561,97 @@ def show_help(call):
 • لینک مستقیم به آگهی
 • فیلتر پیشرفته قیمت
 • پشتیبانی از تمام شهرها
+• اطلاع از آگهی‌های جدید جستجوهای ذخیره‌شده
+
+🎯 نکات مهم:
+• از کلمات کلیدی دقیق استفاده کنید
+• برای نتایج بهتر نام برند را اضافه کنید
+• محدوده قیمت واقعی وارد کنید"""
+    
+    bot.send_message(call.message.chat.id, help_text)
+
+def save_last_search(chat_id, user_id):
+    search = last_searches.get(user_id)
+    if search is None:
+        bot.send_message(chat_id, "❌ ابتدا یک جستجو انجام دهید، سپس آن را ذخیره کنید.")
+        return
+    
+    product_name, city, min_price, max_price = search
+    watch = watch_scheduler.add(user_id, chat_id, product_name, city, min_price, max_price)
+    if watch is None:
+        bot.send_message(chat_id, f"❌ حداکثر {WATCH_MAX_PER_USER} جستجوی ذخیره‌شده مجاز است. "
+                                  "با /watches یکی را حذف کنید.")
+        return
+    
+    bot.send_message(chat_id, f"✅ جستجوی «{product_name}» در {city_label(city)} ذخیره شد.\n\n"
+                              f"🔔 هر حدود {WATCH_INTERVAL // 60} دقیقه آگهی‌های جدید برایتان ارسال می‌شود.\n"
+                              "📋 مدیریت: /watches")
+
+@bot.message_handler(commands=['watch'])
+def watch_command(message):
+    save_last_search(message.chat.id, message.from_user.id)
+
+@bot.callback_query_handler(func=lambda call: call.data == "watch_last")
+def watch_last_search(call):
+    save_last_search(call.message.chat.id, call.from_user.id)
+
+@bot.message_handler(commands=['watches'])
+def list_watches(message):
+    watches = watch_scheduler.list(message.from_user.id)
+    if not watches:
+        bot.send_message(message.chat.id, "📭 هیچ جستجوی ذخیره‌شده‌ای ندارید.\n\n"
+                                          "💡 بعد از هر جستجو می‌توانید آن را ذخیره کنید.")
+        return
+    
+    keyboard = telebot.types.InlineKeyboardMarkup(row_width=1)
+    lines = ["🔔 جستجوهای ذخیره‌شده:\n"]
+    for watch in watches:
+        lines.append(f"{watch.watch_id}. {watch.query} - {city_label(watch.city)}")
+        keyboard.add(telebot.types.InlineKeyboardButton(f"❌ حذف {watch.watch_id}. {watch.query}",
+                                                        callback_data=f"unwatch_{watch.watch_id}"))
+    bot.send_message(message.chat.id, "\n".join(lines), reply_markup=keyboard)
+
+@bot.message_handler(commands=['unwatch'])
+def unwatch_command(message):
+    parts = message.text.split()
+    if len(parts) != 2 or not parts[1].isdigit():
+        bot.send_message(message.chat.id, "❌ شماره جستجو را وارد کنید، مثلاً: /unwatch 3")
+        return
+    
+    if watch_scheduler.remove(message.from_user.id, int(parts[1])):
+        bot.send_message(message.chat.id, "🗑 جستجوی ذخیره‌شده حذف شد.")
+    else:
+        bot.send_message(message.chat.id, "❌ جستجوی ذخیره‌شده‌ای با این شماره پیدا نشد.")
 
-🎯 نکات مهم:
-• از کلمات کلیدی دقیق استفاده کنید
-• برای نتایج بهتر نام برند را اضافه کنید
-• محدوده قیمت واقعی وارد کنید"""
+@bot.callback_query_handler(func=lambda call: call.data.startswith("unwatch_"))
+def unwatch_callback(call):
+    watch_id = call.data[len("unwatch_"):]
+    if watch_id.isdigit() and watch_scheduler.remove(call.from_user.id, int(watch_id)):
+        bot.send_message(call.message.chat.id, "🗑 جستجوی ذخیره‌شده حذف شد.")
+    else:
+        bot.send_message(call.message.chat.id, "❌ این جستجو قبلاً حذف شده است.")
+
+@bot.message_handler(commands=['profile'])
+def profile_command(message):
+    """Admin only: /profile [N] profiles the next N searches, /profile off cancels"""
+    if message.from_user.id not in ADMIN_USER_IDS:
+        return
     
-    bot.send_message(call.message.chat.id, help_text)
+    parts = message.text.split()
+    if len(parts) > 1 and parts[1] == "off":
+        search_profiler.arm(0)
+        bot.send_message(message.chat.id, "🔬 پروفایل‌گیری متوقف شد.")
+        return
+    if len(parts) > 1 and not parts[1].isdigit():
+        bot.send_message(message.chat.id, "❌ استفاده: /profile [تعداد] یا /profile off")
+        return
+    
+    count = min(int(parts[1]) if len(parts) > 1 else 1, PROFILE_MAX_SEARCHES)
+    search_profiler.arm(count)
+    bot.send_message(message.chat.id, f"🔬 {count} جستجوی بعدی پروفایل می‌شود.\n"
+                                      f"📁 گزارش‌ها در {os.path.abspath(search_profiler.directory)} ذخیره می‌شوند.")
 
-@bot.message_handler(func=lambda message: user_states.get(message.from_user.id, {}).get("step") == "waiting_product_name")
+@bot.message_handler(func=lambda message: state_store.step(message.from_user.id) == "waiting_product_name")
 def handle_product_name(message):
     user_id = message.from_user.id
     product_name = message.text.strip()
@@ -456,8 +3660,7 @@ def handle_product_name(message):
         bot.send_message(message.chat.id, "❌ نام محصول باید حداقل 2 کاراکتر باشد. لطفاً دوباره وارد کنید:")
         return
     
-    user_states[user_id]["product_name"] = product_name
-    user_states[user_id]["step"] = "waiting_count"
+    state_store.update(user_id, product_name=product_name, step="waiting_count")
     
     keyboard = telebot.types.InlineKeyboardMarkup(row_width=3)
     keyboard.add(
@@ -478,8 +3681,7 @@ def handle_count_selection(call):
     user_id = call.from_user.id
     count = int(call.data.split("_")[1])
     
-    user_states[user_id]["count"] = count
-    user_states[user_id]["step"] = "waiting_city"
+    state_store.update(user_id, count=count, step="waiting_city")
     
     show_city_selection(call.message.chat.id)
 
@@ -502,9 +3704,64 @@ def show_city_selection(chat_id):
         keyboard.add(telebot.types.InlineKeyboardButton(city_name, callback_data=f"city_{city_code}"))
     
     keyboard.add(telebot.types.InlineKeyboardButton("📍 سایر شهرها...", callback_data="more_cities"))
+    keyboard.add(telebot.types.InlineKeyboardButton("🗺️ چند شهر یا یک منطقه", callback_data="multi_cities"))
     
     bot.send_message(chat_id, "🏙️ شهر مورد نظر خود را انتخاب کنید:", reply_markup=keyboard)
 
+def multi_city_keyboard(selected):
+    keyboard = telebot.types.InlineKeyboardMarkup(row_width=2)
+    keyboard.add(*[
+        telebot.types.InlineKeyboardButton(("✅ " if set(codes) <= selected else "") + label,
+                                           callback_data=f"mregion_{region}")
+        for region, (label, codes) in CITY_REGIONS.items()
+    ])
+    keyboard.row_width = 3
+    keyboard.add(*[
+        telebot.types.InlineKeyboardButton(("✅ " if code in selected else "") + name, callback_data=f"mcity_{code}")
+        for code, name in CITIES_DATA.items() if code != "iran"
+    ])
+    keyboard.row_width = 1
+    keyboard.add(telebot.types.InlineKeyboardButton(f"🔍 ادامه با {len(selected)} شهر", callback_data="mcity_done"))
+    return keyboard
+
+@bot.callback_query_handler(func=lambda call: call.data == "multi_cities")
+def show_multi_city_selection(call):
+    state_store.update(call.from_user.id, city="", step="waiting_cities")
+    bot.edit_message_text(f"🗺️ شهرها یا منطقه مورد نظر را انتخاب کنید (حداکثر {MULTI_CITY_MAX} شهر):",
+                          call.message.chat.id, call.message.message_id, reply_markup=multi_city_keyboard(set()))
+
+@bot.callback_query_handler(func=lambda call: (call.data.startswith("mcity_") and call.data[len("mcity_"):] in CITIES_DATA)
+                            or (call.data.startswith("mregion_") and call.data[len("mregion_"):] in CITY_REGIONS))
+def toggle_multi_city(call):
+    user_id = call.from_user.id
+    state = state_store.get(user_id)
+    selected = set(split_cities(state.city)) if state is not None and state.city else set()
+    
+    if call.data.startswith("mregion_"):
+        codes = set(CITY_REGIONS[call.data[len("mregion_"):]][1])
+        selected = selected - codes if codes <= selected else selected | codes
+    else:
+        selected ^= {call.data[len("mcity_"):]}
+    
+    if len(selected) > MULTI_CITY_MAX:
+        bot.answer_callback_query(call.id, f"⚠️ حداکثر {MULTI_CITY_MAX} شهر را می‌توانید انتخاب کنید")
+        return
+    
+    state_store.update(user_id, city=join_cities(selected), step="waiting_cities")
+    bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id,
+                                  reply_markup=multi_city_keyboard(selected))
+
+@bot.callback_query_handler(func=lambda call: call.data == "mcity_done")
+def finish_multi_city_selection(call):
+    user_id = call.from_user.id
+    state = state_store.get(user_id)
+    if state is None or not state.city:
+        bot.answer_callback_query(call.id, "⚠️ دست‌کم یک شهر را انتخاب کنید")
+        return
+    
+    state_store.update(user_id, step="waiting_price_filter")
+    ask_price_filter(call.message.chat.id, state.city)
+
 @bot.callback_query_handler(func=lambda call: call.data == "more_cities")
 def show_more_cities(call):
     keyboard = telebot.types.InlineKeyboardMarkup(row_width=2)
@@ -534,23 +3791,23 @@ def back_to_major_cities(call):
 def handle_city_selection(call):
     user_id = call.from_user.id
     city_code = call.data.split("_")[1]
-    city_name = CITIES_DATA.get(city_code, city_code)
-    
-    user_states[user_id]["city"] = city_code
-    user_states[user_id]["step"] = "waiting_price_filter"
     
+    state_store.update(user_id, city=city_code, step="waiting_price_filter")
+    ask_price_filter(call.message.chat.id, city_code)
+
+def ask_price_filter(chat_id, city):
     keyboard = telebot.types.InlineKeyboardMarkup(row_width=1)
     keyboard.add(
         telebot.types.InlineKeyboardButton("💰 تنظیم محدوده قیمت", callback_data="set_price_filter"),
         telebot.types.InlineKeyboardButton("🚀 جستجو بدون فیلتر قیمت", callback_data="search_no_price_filter")
     )
     
-    bot.send_message(call.message.chat.id, f"✅ شهر انتخاب شده: {city_name}\n\n💡 آیا می‌خواهید محدوده قیمت تنظیم کنید؟", reply_markup=keyboard)
+    bot.send_message(chat_id, f"✅ شهر انتخاب شده: {city_label(city)}\n\n💡 آیا می‌خواهید محدوده قیمت تنظیم کنید؟", reply_markup=keyboard)
 
 @bot.callback_query_handler(func=lambda call: call.data == "set_price_filter")
 def set_price_filter(call):
     user_id = call.from_user.id
-    user_states[user_id]["step"] = "waiting_min_price"
+    state_store.update(user_id, step="waiting_min_price")
     
     keyboard = telebot.types.InlineKeyboardMarkup(row_width=1)
     keyboard.add(telebot.types.InlineKeyboardButton("🚫 بدون حداقل قیمت", callback_data="skip_min_price"))
@@ -560,15 +3817,14 @@ def set_price_filter(call):
 @bot.callback_query_handler(func=lambda call: call.data == "skip_min_price")
 def skip_min_price(call):
     user_id = call.from_user.id
-    user_states[user_id]["min_price"] = None
-    user_states[user_id]["step"] = "waiting_max_price"
+    state_store.update(user_id, min_price=None, step="waiting_max_price")
     
     keyboard = telebot.types.InlineKeyboardMarkup(row_width=1)
     keyboard.add(telebot.types.InlineKeyboardButton("🚫 بدون حداکثر قیمت", callback_data="skip_max_price"))
     
     bot.send_message(call.message.chat.id, "💰 حداکثر قیمت را به تومان وارد کنید:\n\n💡 مثال: 5000000 (پنج میلیون تومان)\n(یا روی دکمه زیر کلیک کنید)", reply_markup=keyboard)
 
-@bot.message_handler(func=lambda message: user_states.get(message.from_user.id, {}).get("step") == "waiting_min_price")
+@bot.message_handler(func=lambda message: state_store.step(message.from_user.id) == "waiting_min_price")
 def handle_min_price(message):
     user_id = message.from_user.id
     
@@ -577,8 +3833,7 @@ def handle_min_price(message):
         if min_price < 0:
             raise ValueError("Negative price")
             
-        user_states[user_id]["min_price"] = min_price
-        user_states[user_id]["step"] = "waiting_max_price"
+        state_store.update(user_id, min_price=min_price, step="waiting_max_price")
         
         keyboard = telebot.types.InlineKeyboardMarkup(row_width=1)
         keyboard.add(telebot.types.InlineKeyboardButton("🚫 بدون حداکثر قیمت", callback_data="skip_max_price"))
@@ -590,16 +3845,17 @@ def handle_min_price(message):
 @bot.callback_query_handler(func=lambda call: call.data == "skip_max_price")
 def skip_max_price(call):
     user_id = call.from_user.id
-    user_states[user_id]["max_price"] = None
+    state_store.update(user_id, max_price=None)
     start_scraping(call.message.chat.id, user_id)
 
-@bot.message_handler(func=lambda message: user_states.get(message.from_user.id, {}).get("step") == "waiting_max_price")
+@bot.message_handler(func=lambda message: state_store.step(message.from_user.id) == "waiting_max_price")
 def handle_max_price(message):
     user_id = message.from_user.id
     
     try:
         max_price = int(message.text.strip().replace(',', '').replace('،', ''))
-        min_price = user_states[user_id].get("min_price")
+        state = state_store.get(user_id)
+        min_price = state.min_price if state else None
         
         if max_price < 0:
             raise ValueError("Negative price")
@@ -608,7 +3864,7 @@ def handle_max_price(message):
             bot.send_message(message.chat.id, f"❌ حداکثر قیمت باید بیشتر از حداقل قیمت ({min_price:,} تومان) باشد:")
             return
             
-        user_states[user_id]["max_price"] = max_price
+        state_store.update(user_id, max_price=max_price)
         start_scraping(message.chat.id, user_id)
     except ValueError:
         bot.send_message(message.chat.id, "❌ لطفاً یک عدد معتبر وارد کنید (فقط اعداد):")
@@ -616,21 +3872,28 @@ def handle_max_price(message):
 @bot.callback_query_handler(func=lambda call: call.data == "search_no_price_filter")
 def search_no_price_filter(call):
     user_id = call.from_user.id
-    user_states[user_id]["min_price"] = None
-    user_states[user_id]["max_price"] = None
+    state_store.update(user_id, min_price=None, max_price=None)
     start_scraping(call.message.chat.id, user_id)
 
 def start_scraping(chat_id, user_id):
-    user_data = user_states.get(user_id, {})
+    state = state_store.get(user_id)
+    
+    # The conversation expired, or the bot restarted without persistent state
+    if state is None or not state.product_name or not state.count or not state.city:
+        state_store.discard(user_id)
+        bot.send_message(chat_id, "⌛️ زمان این جستجو به پایان رسیده است. لطفاً دوباره شروع کنید.")
+        show_main_menu(chat_id)
+        return
     
-    product_name = user_data.get("product_name")
-    count = user_data.get("count")
-    city = user_data.get("city")
-    min_price = user_data.get("min_price")
-    max_price = user_data.get("max_price")
+    product_name = state.product_name
+    count = state.count
+    city = state.city
+    min_price = state.min_price
+    max_price = state.max_price
+    last_searches.put(user_id, (product_name, city, min_price, max_price))
     
     # Show search summary
-    city_name = CITIES_DATA.get(city, city)
+    city_name = city_label(city)
     summary = f"🔍 در حال جستجو...\n\n📦 محصول: {product_name}\n📊 تعداد: {count}\n🏙️ شهر: {city_name}"
     
     if min_price or max_price:
@@ -649,93 +3912,1233 @@ def start_scraping(chat_id, user_id):
     
     bot.send_message(chat_id, summary)
     
-    # Start scraping in background
-    threading.Thread(target=send_products, args=(product_name, count, chat_id, city, min_price, max_price)).start()
+    # Queue the search; smaller result counts get served first
+    if EXECUTION_MODE == "asyncio":
+        runner, search = async_runtime, async_send_products
+    else:
+        runner, search = search_scheduler, send_products
+    try:
+        position = runner.submit(user_id, chat_id, count, search,
+                                 product_name, count, chat_id, city, min_price, max_price,
+                                 delivery_mode=get_delivery_mode(user_id), sort_order=get_sort_order(user_id),
+                                 source=get_search_source(user_id))
+        if position:
+            bot.send_message(chat_id, f"🕒 جستجوی شما در صف قرار گرفت (نوبت {position})")
+    except queue.Full:
+        bot.send_message(chat_id, "⚠️ ربات در حال حاضر شلوغ است. لطفاً چند لحظه دیگر دوباره تلاش کنید.")
+        show_main_menu(chat_id)
     
     # Reset user state
-    user_states[user_id] = {}
+    state_store.discard(user_id)
+
+def format_product_message(idx, product):
+    """Caption/text for one product card"""
+    message = f"""📦 محصول {idx}:
+
+🏷️ {product.get('title', 'بدون عنوان')}
+
+💰 {product.get('price', 'قیمت نامشخص')}
+
+📍 {product.get('meta', 'اطلاعات کامل در لینک موجود است')}"""
+    
+    if product.get('url'):
+        message += f"\n\n🔗 مشاهده آگهی: {product['url']}"
+    
+    return message
+
+def send_product_card(chat_id, idx, product, image_verdict=None):
+    """Send one product, as a photo when its image check passed"""
+    message = format_product_message(idx, product)
+    
+    # Send with image if available
+    if product.get('image_url') and image_verdict == "ok":
+        try:
+            return bot.send_photo(chat_id, product['image_url'], caption=message[:1024], parse_mode=None)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                raise
+            logger.error(f"Error sending image for product {idx}: {e}")
+        except Exception as e:
+            logger.error(f"Error sending image for product {idx}: {e}")
+    
+    return bot.send_message(chat_id, message)
+
+def chunk_messages(messages, limit=TELEGRAM_MESSAGE_LIMIT, separator="\n\n➖➖➖➖➖\n\n"):
+    """Join messages into as few texts as possible, each within ``limit``"""
+    chunks = []
+    current = ""
+    for message in messages:
+        message = message[:limit]
+        if current and len(current) + len(separator) + len(message) > limit:
+            chunks.append(current)
+            current = ""
+        current = f"{current}{separator}{message}" if current else message
+    if current:
+        chunks.append(current)
+    return chunks
+
+def send_product_texts(chat_id, items, delivered=None):
+    """Send text-only products combined into as few messages as possible.
+
+    ``delivered`` is a one-item list counting the messages already sent; when
+    the outbox retries the call after a 429, those are skipped, not repeated.
+    """
+    if delivered is None:
+        delivered = [0]
+    result = None
+    for text in chunk_messages([format_product_message(idx, product) for idx, product in items])[delivered[0]:]:
+        result = bot.send_message(chat_id, text)
+        delivered[0] += 1
+    return result
+
+def send_product_album(chat_id, items, delivered=None):
+    """Send up to ALBUM_SIZE image products as one media group, keeping per-item captions.
 
-def send_products(product_name, count, chat_id, city, min_price=None, max_price=None):
+    If the group fails, the products go out as text; ``delivered`` is passed on
+    to ``send_product_texts``, and once part of that text is out a retry
+    continues it instead of trying the group again.
+    """
+    if delivered is None:
+        delivered = [0]
+    if delivered[0]:
+        return send_product_texts(chat_id, items, delivered)
+    if len(items) == 1:
+        idx, product = items[0]
+        return send_product_card(chat_id, idx, product, "ok")
+    
+    media = [
+        telebot.types.InputMediaPhoto(product['image_url'], caption=format_product_message(idx, product)[:1024])
+        for idx, product in items
+    ]
     try:
-        products = scrape_divar_products(product_name, count, city, min_price, max_price)
-        
-        if not products:
-            bot.send_message(chat_id, """❌ متأسفانه هیچ محصولی پیدا نشد
+        return bot.send_media_group(chat_id, media)
+    except telebot.apihelper.ApiTelegramException as e:
+        if e.error_code == 429:
+            raise
+        logger.error(f"Error sending album of {len(items)} products: {e}")
+    except Exception as e:
+        logger.error(f"Error sending album of {len(items)} products: {e}")
+    
+    # One bad photo fails the whole group; fall back to a combined text message
+    return send_product_texts(chat_id, items, delivered)
+
+NO_PREVIEW = telebot.types.LinkPreviewOptions(is_disabled=True)
+
+def format_result_page(result_set, page):
+    """Text of one browser page: a header and a compact entry per listing"""
+    first = page * BROWSER_PAGE_SIZE
+    items = result_set.products[first:first + BROWSER_PAGE_SIZE]
+    lines = [f"📑 «{result_set.query}» در {city_label(result_set.city)}",
+             f"نتایج {first + 1} تا {first + len(items)} از {len(result_set.products)}"]
+    for idx, product in enumerate(items, first + 1):
+        title = product.get('title', 'بدون عنوان')
+        entry = f"{idx}. {title[:80]}\n💰 {product.get('price', 'قیمت نامشخص')}"
+        if product.get('url'):
+            entry += f"\n🔗 {product['url']}"
+        lines.append(entry)
+    return "\n\n".join(lines)[:TELEGRAM_MESSAGE_LIMIT]
+
+def result_page_keyboard(result_id, result_set, page):
+    keyboard = telebot.types.InlineKeyboardMarkup(row_width=BROWSER_PAGE_SIZE)
+    first = page * BROWSER_PAGE_SIZE
+    items = result_set.products[first:first + BROWSER_PAGE_SIZE]
+    keyboard.add(*[
+        telebot.types.InlineKeyboardButton(("🖼 " if product.get('image_url') else "📄 ") + str(idx),
+                                           callback_data=f"rs_{result_id}_i_{idx - 1}")
+        for idx, product in enumerate(items, first + 1)
+    ])
+    navigation = []
+    if page > 0:
+        navigation.append(telebot.types.InlineKeyboardButton("◀️ قبلی", callback_data=f"rs_{result_id}_p_{page - 1}"))
+    if page + 1 < result_set.pages():
+        navigation.append(telebot.types.InlineKeyboardButton("بعدی ▶️", callback_data=f"rs_{result_id}_p_{page + 1}"))
+    if navigation:
+        keyboard.row(*navigation)
+    return keyboard
+
+def result_item_view(result_id, result_set, index):
+    """Text, keyboard and link preview of one listing: its full card with the photo shown above it"""
+    product = result_set.products[index]
+    keyboard = telebot.types.InlineKeyboardMarkup()
+    navigation = []
+    if index > 0:
+        navigation.append(telebot.types.InlineKeyboardButton("◀️", callback_data=f"rs_{result_id}_i_{index - 1}"))
+    navigation.append(telebot.types.InlineKeyboardButton(
+        "🔙 فهرست", callback_data=f"rs_{result_id}_p_{index // BROWSER_PAGE_SIZE}"))
+    if index + 1 < len(result_set.products):
+        navigation.append(telebot.types.InlineKeyboardButton("▶️", callback_data=f"rs_{result_id}_i_{index + 1}"))
+    keyboard.row(*navigation)
+    preview = NO_PREVIEW
+    if product.get('image_url'):
+        preview = telebot.types.LinkPreviewOptions(url=product['image_url'], prefer_large_media=True,
+                                                   show_above_text=True)
+    return format_product_message(index + 1, product), keyboard, preview
+
+def send_result_browser(chat_id, result_id):
+    """Send the first page of a kept result set as one message"""
+    result_set = result_sets.get(result_id, chat_id)
+    if result_set is None:
+        return None
+    return bot.send_message(chat_id, format_result_page(result_set, 0),
+                            reply_markup=result_page_keyboard(result_id, result_set, 0), link_preview_options=NO_PREVIEW)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("rs_"))
+def browse_results(call):
+    """Turn a result browser message to another page, or to one listing with its photo.
+
+    Every press is answered, so the button never keeps spinning; a press on
+    an expired, foreign or malformed result set gets the expiry notice.
+    """
+    try:
+        _, result_id, action, value = call.data.split("_")
+        value = int(value)
+    except ValueError:
+        result_set = None
+    else:
+        result_set = result_sets.get(result_id, call.message.chat.id)
+    
+    view = None
+    if result_set is not None:
+        if action == "i" and 0 <= value < len(result_set.products):
+            view = result_item_view(result_id, result_set, value)
+        elif action == "p" and 0 <= value < result_set.pages():
+            view = (format_result_page(result_set, value), result_page_keyboard(result_id, result_set, value),
+                    NO_PREVIEW)
+    if view is None:
+        bot.answer_callback_query(call.id, RESULTS_EXPIRED_TEXT, show_alert=True)
+        return
+    text, keyboard, preview = view
+    
+    bot.answer_callback_query(call.id)
+    try:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=keyboard,
+                              link_preview_options=preview)
+    except telebot.apihelper.ApiTelegramException as e:
+        # A double tap asks for the page already shown
+        if "message is not modified" not in str(e):
+            logger.error(f"Error showing result set {result_id}: {e}")
+
+FOUND_TEXT = "✅ محصولات پیدا شد! در حال ارسال..."
+
+RESULTS_EXPIRED_TEXT = "⌛️ این نتایج منقضی شده‌اند؛ لطفاً دوباره جستجو کنید"
+
+NO_RESULTS_TEXT = """❌ متأسفانه هیچ محصولی پیدا نشد
 
 💡 پیشنهادات:
 • کلمات جستجو را ساده‌تر کنید
 • نام برند را حذف کنید
 • محدوده قیمت را بررسی کنید
 • شهر دیگری را امتحان کنید
-• از کلمات مترادف استفاده کنید""")
+• از کلمات مترادف استفاده کنید"""
+
+SEARCH_ERROR_TEXT = "❌ خطایی در دریافت اطلاعات رخ داد. لطفاً دوباره تلاش کنید."
+
+DIVAR_UNAVAILABLE_TEXT = "⚠️ دیوار در حال حاضر پاسخ نمی‌دهد. لطفاً چند دقیقه دیگر دوباره جستجو کنید."
+
+def search_error_text(error):
+    return DIVAR_UNAVAILABLE_TEXT if isinstance(error, CircuitOpenError) else SEARCH_ERROR_TEXT
+
+def completion_text(sent, product_name, city):
+    return f"""✨ جستجو کامل شد!
+
+📊 نتایج: {sent} محصول
+🎯 محصول: {product_name}
+🏙️ شهر: {city_label(city)}
+
+💡 برای جستجوی جدید از منوی زیر استفاده کنید:"""
+
+def sort_products(products, sort_order):
+    """Products in ``sort_order``; listings without a price or age go last, ties keep Divar's order"""
+    products = list(products)
+    if sort_order == "price_asc":
+        products.sort(key=lambda p: (p.get('price_value') is None, p.get('price_value') or 0))
+    elif sort_order == "price_desc":
+        products.sort(key=lambda p: (p.get('price_value') is None, -(p.get('price_value') or 0)))
+    elif sort_order == "newest":
+        def age(product):
+            minutes = parse_age_minutes(product.get('meta'))
+            return (minutes is None, minutes or 0)
+        products.sort(key=age)
+    return products
+
+def send_products(product_name, count, chat_id, city, min_price=None, max_price=None, cancelled=None,
+                  delivery_mode=DEFAULT_DELIVERY_MODE, sort_order=DEFAULT_SORT_ORDER, source=DEFAULT_SEARCH_SOURCE):
+    """Scrape a search and queue its result messages on the outbound sender.
+
+    Nothing here waits for Telegram: cards are handed to ``outbox`` in order
+    and paced there, so the search worker is free as soon as the last card
+    is queued. In ``album`` mode image products go out in media groups of up
+    to ALBUM_SIZE and text-only products in one combined message; in
+    ``browser`` mode all results are kept in ``result_sets`` and sent as one
+    message that pages through them. Any ``sort_order`` other than Divar's
+    own collects all results first.
+    Stage timings are recorded on a ``SearchTrace``.
+    """
+    trace = SearchTrace(product_name, city)
+    trace.profile = search_profiler.claim(trace)
+    outcome = "error"
+    sent = 0
+    first_submitted = False
+    album = []
+    text_only = []
+    
+    def first_listing_delivered(future):
+        if not future.cancelled():
+            logger.info(f"Search #{trace.search_id} '{product_name}' in {city}: first listing delivered after "
+                        f"{time.perf_counter() - trace.started:.2f}s")
+    
+    def submit(func, *args):
+        nonlocal first_submitted
+        future = outbox.submit(chat_id, trace.timed("telegram_send", func), chat_id, *args, cancelled=cancelled)
+        if not first_submitted:
+            first_submitted = True
+            future.add_done_callback(first_listing_delivered)
+    
+    def flush_album():
+        if album:
+            submit(send_product_album, list(album), [0])
+            album.clear()
+    
+    def deliver(product, image_check):
+        nonlocal sent
+        sent += 1
+        
+        if sent == 1:
+            outbox.send_message(chat_id, FOUND_TEXT)
+        
+        verdict = None
+        if image_check:
+            try:
+                with trace.span("image_wait"):
+                    verdict = image_check.result()
+            except Exception as e:
+                logger.error(f"Error checking image for product {sent}: {e}")
+        
+        if delivery_mode != "album":
+            submit(send_product_card, sent, product, verdict)
+        elif product.get('image_url') and verdict == "ok":
+            album.append((sent, product))
+            if len(album) >= ALBUM_SIZE:
+                flush_album()
+        else:
+            text_only.append((sent, product))
+    
+    def superseded():
+        nonlocal outcome
+        if cancelled is not None and cancelled.is_set():
+            outcome = "replaced"
+            return True
+        return False
+    
+    stream = None
+    try:
+        # Products are delivered while the page is still being extracted; image
+        # checks for the next few products run in the background meanwhile
+        pending = deque()
+        stream = products = iter_divar_products(product_name, count, city, min_price, max_price, trace=trace, source=source,
+                                                cancelled=cancelled)
+        if sort_order != "relevance":
+            products = sort_products(products, sort_order)
+        if delivery_mode == "browser":
+            products = list(products)
+            if superseded():
+                return
+            if products:
+                sent = len(products)
+                submit(send_result_browser, result_sets.put(chat_id, product_name, city, products))
+            products = ()
+        for product in products:
+            if superseded():
+                return
+            image_check = image_checker.submit(product['image_url']) if product.get('image_url') else None
+            pending.append((product, image_check))
+            if len(pending) > IMAGE_CHECK_LOOKAHEAD:
+                deliver(*pending.popleft())
+        
+        while pending:
+            if superseded():
+                return
+            deliver(*pending.popleft())
+        
+        flush_album()
+        if text_only:
+            submit(send_product_texts, list(text_only), [0])
+        
+        if not sent:
+            outcome = "no_results"
+            outbox.send_message(chat_id, NO_RESULTS_TEXT)
             show_main_menu(chat_id)
             return
         
-        bot.send_message(chat_id, f"✅ {len(products)} محصول پیدا شد! در حال ارسال...")
+        # Show completion message and main menu
+        outcome = "results"
+        outbox.send_message(chat_id, completion_text(sent, product_name, city), reply_markup=watch_offer_keyboard())
+        show_main_menu(chat_id)
         
-        for idx, product in enumerate(products, start=1):
+    except Exception as e:
+        if superseded():
+            return
+        logger.error(f"Error in send_products: {e}")
+        outbox.send_message(chat_id, search_error_text(e))
+        show_main_menu(chat_id)
+    
+    finally:
+        # A search that returns early (replaced or failed) stops its page fetches now, not when collected
+        if stream is not None:
+            stream.close()
+        trace.finish(outcome, f"{sent} listings queued")
+        if trace.profile is not None:
+            search_profiler.finish(trace.profile)
+
+class AsyncTelegramSender:
+    """Rate-limited Telegram Bot API calls for the asyncio execution mode.
+
+    Uses the same global and per-chat token buckets as ``OutboundSender``,
+    but waiting for a token is an ``asyncio.sleep`` rather than a thread.
+    Calls to one chat run one at a time and keep their order; a 429 holds
+    the chat for ``retry_after`` seconds before the call is retried.
+    Only used from the event loop thread, so it needs no locking.
+    """
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, global_burst=TELEGRAM_GLOBAL_BURST,
+                 chat_rate=TELEGRAM_CHAT_RATE, chat_burst=TELEGRAM_CHAT_BURST,
+                 max_retries=TELEGRAM_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}                 # chat_id -> [asyncio.Lock, TokenBucket, held_until]
+        self._pruned_at = time.monotonic()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def _chat(self, chat_id):
+        now = time.monotonic()
+        if now - self._pruned_at > 60:
+            self._pruned_at = now
+            for other in list(self._chats):
+                lock, bucket, held_until = self._chats[other]
+                if not lock.locked() and held_until <= now and bucket.delay(now) == 0 \
+                        and bucket.tokens >= self.chat_burst:
+                    del self._chats[other]
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = [asyncio.Lock(), TokenBucket(self.chat_rate, self.chat_burst, now), 0.0]
+        return chat
+
+    async def _wait_turn(self, chat):
+        while True:
+            now = time.monotonic()
+            delay = max(chat[2] - now, chat[1].delay(now), self._global.delay(now))
+            if delay <= 0:
+                self._global.take(now)
+                chat[1].take(now)
+                return
+            await asyncio.sleep(delay)
+
+    async def call(self, session, method, chat_id, **params):
+        """POST ``method`` to the Bot API for ``chat_id`` and return its result"""
+        url = telebot.apihelper.API_URL.format(BOT_TOKEN, method)
+        chat = self._chat(chat_id)
+        async with chat[0]:
+            attempt = 0
+            while True:
+                await self._wait_turn(chat)
+                try:
+                    async with session.post(url, json={"chat_id": chat_id, **params},
+                                            timeout=aiohttp.ClientTimeout(total=30)) as response:
+                        result_json = await response.json(content_type=None)
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Telegram call {method} to {chat_id} failed: {e}")
+                    raise
+                if result_json.get('ok'):
+                    self.sent += 1
+                    return result_json['result']
+                if result_json.get('error_code') == 429 and attempt < self.max_retries:
+                    retry_after = result_json.get('parameters', {}).get('retry_after', 1)
+                    attempt += 1
+                    self.retried += 1
+                    logger.warning(f"Telegram flood limit for chat {chat_id}, retrying in {retry_after}s")
+                    chat[2] = time.monotonic() + retry_after
+                    continue
+                self.failed += 1
+                error = telebot.apihelper.ApiTelegramException(method, response, result_json)
+                logger.error(f"Telegram call {method} to {chat_id} failed: {error}")
+                raise error
+
+    def stats(self):
+        return {
+            "chats": len(self._chats),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+        }
+
+class AsyncSearchRuntime:
+    """Runs searches as coroutines on one event loop thread (EXECUTION_MODE = "asyncio").
+
+    Page downloads, image checks and Telegram calls are aiohttp requests on
+    the loop; only parsing and extraction run on a small thread pool. The
+    result cache and image verdict cache are shared with the threaded path.
+    ``submit`` has the same signature and replace/queue semantics as
+    ``SearchScheduler.submit``, but searches start immediately instead of
+    waiting for a free worker, up to ASYNC_MAX_SEARCHES at once.
+    """
+
+    def __init__(self, parse_workers=ASYNC_PARSE_WORKERS, max_searches=ASYNC_MAX_SEARCHES,
+                 replace_policy=SEARCH_REPLACE_POLICY, host_concurrency=HTTP_HOST_CONCURRENCY):
+        if replace_policy not in ("replace", "queue"):
+            raise ValueError(f"Unknown replace policy: {replace_policy}")
+        self.max_searches = max_searches
+        self.host_concurrency = host_concurrency
+        self.replace_policy = replace_policy
+        self.parse_executor = ThreadPoolExecutor(max_workers=parse_workers, thread_name_prefix="async-parse")
+        self.telegram = AsyncTelegramSender()
+        self.loop = None
+        self.session = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._running_by_user = {}       # user_id -> [concurrent Future, cancelled Event]
+        self._image_checks = {}          # url -> asyncio.Task, touched only on the loop
+        self._active = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.replaced = 0
+        self.rejected = 0
+
+    def _ensure_loop(self):
+        if self.loop is None:
+            if aiohttp is None:
+                raise RuntimeError("EXECUTION_MODE 'asyncio' requires aiohttp (pip install aiohttp)")
+            self.loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self.loop.run_forever, name="asyncio-loop", daemon=True)
+            self._thread.start()
+
+    def run(self, coro):
+        """Schedule ``coro`` on the loop from any thread; returns a concurrent Future"""
+        with self._lock:
+            self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def submit(self, user_id, chat_id, priority, func, *args, **kwargs):
+        """Start ``func(*args, cancelled=..., **kwargs)`` as a coroutine for ``user_id``.
+
+        Returns 1 if it waits behind the user's previous search, otherwise 0.
+        Raises ``queue.Full`` when ASYNC_MAX_SEARCHES searches are running.
+        """
+        with self._lock:
+            self._ensure_loop()
+            previous = self._running_by_user.get(user_id)
+            if previous is not None and self.replace_policy == "replace":
+                # The replaced search frees its slot now rather than once its cancellation has run
+                previous[1].set()
+                previous[0].cancel()
+                self._active -= 1
+                self.replaced += 1
+                previous = None
+
+            if self._active >= self.max_searches:
+                self.rejected += 1
+                raise queue.Full("search limit reached")
+
+            entry = [None, threading.Event()]
+            wait_for = previous[0] if previous is not None else None
+            self._active += 1
+            self.submitted += 1
+            self._running_by_user[user_id] = entry
+            entry[0] = asyncio.run_coroutine_threadsafe(
+                self._run(user_id, entry, wait_for, func, args, dict(kwargs, cancelled=entry[1])), self.loop)
+            return 1 if wait_for is not None else 0
+
+    async def _run(self, user_id, entry, wait_for, func, args, kwargs):
+        try:
+            if wait_for is not None:
+                await asyncio.wait([asyncio.wrap_future(wait_for)])
+            await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Search for user {user_id} failed: {e}")
+        finally:
+            with self._lock:
+                if not entry[1].is_set():
+                    self._active -= 1
+                self.completed += 1
+                if self._running_by_user.get(user_id) is entry:
+                    del self._running_by_user[user_id]
+
+    async def _session(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.host_concurrency, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def call(self, method, chat_id, **params):
+        return await self.telegram.call(await self._session(), method, chat_id, **params)
+
+    def close(self, timeout=5):
+        """Close the HTTP session; the loop thread itself is a daemon"""
+        if self.loop is not None and self.session is not None:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result(timeout)
+            self.session = None
+
+    async def fetch_page(self, url, cancelled=None):
+        """Download one search result page with the retries of ``fetch_divar_page``; returns (content, fetch_seconds)"""
+        session = await self._session()
+        started = time.perf_counter()
+        timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT + FETCH_CONNECT_TIMEOUT, sock_connect=FETCH_CONNECT_TIMEOUT)
+        retry_budget.record_attempt()
+        for attempt in itertools.count():
+            if cancelled is not None and cancelled.is_set():
+                raise FetchCancelled(url)
+            divar_breaker.before_request()
+            retry_after = None
             try:
-                # Create clean message
-                message = f"""📦 محصول {idx}:
+                async with session.get(url, headers=DIVAR_HEADERS, timeout=timeout) as response:
+                    content = await response.read()
+            except asyncio.TimeoutError as e:
+                error, reason = e, "timeout"
+            except aiohttp.ClientError as e:
+                error, reason = e, "error"
+            else:
+                if response.status != 429 and response.status < 500:
+                    divar_breaker.record_success()
+                    response.raise_for_status()
+                    return content, time.perf_counter() - started
+                error = aiohttp.ClientResponseError(response.request_info, response.history, status=response.status,
+                                                    message=response.reason or "", headers=response.headers)
+                reason = "throttled" if response.status == 429 else "server_error"
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
 
-🏷️ {product.get('title', 'بدون عنوان')}
+            if cancelled is not None and cancelled.is_set():
+                raise error
+            delay = fetch_retry_delay(attempt, started, reason, retry_after)
+            if delay is None:
+                raise error
+            logger.warning(f"Fetching {url} failed ({error!r}); retry {attempt + 1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
 
-💰 {product.get('price', 'قیمت نامشخص')}
+    async def check_image(self, url):
+        """Image verdict for ``url``; concurrent checks of one URL share a request"""
+        verdict = image_checker.cached(url)
+        if verdict is not None:
+            return verdict
+        task = self._image_checks.get(url)
+        if task is None:
+            task = self._image_checks[url] = asyncio.ensure_future(self._check_image(url))
+            task.add_done_callback(lambda _: self._image_checks.pop(url, None))
+        # A replaced search must not cancel a check other searches wait on
+        return await asyncio.shield(task)
 
-📍 {product.get('meta', 'اطلاعات کامل در لینک موجود است')}"""
-                
-                if product.get('url'):
-                    message += f"\n\n🔗 مشاهده آگهی: {product['url']}"
-                
-                # Send with image if available
-                if product.get('image_url'):
-                    try:
-                        # Validate image URL before sending
-                        img_url = product['image_url']
-                        
-                        # Test if image is accessible
-                        img_response = requests.head(img_url, timeout=5)
-                        if img_response.status_code == 200:
-                            content_type = img_response.headers.get('content-type', '').lower()
-                            if 'image' in content_type:
-                                bot.send_photo(chat_id, img_url, caption=message[:1024], parse_mode=None)
-                            else:
-                                bot.send_message(chat_id, message)
-                        else:
-                            bot.send_message(chat_id, message)
-                    
-                    except Exception as e:
-                        logger.error(f"Error sending image for product {idx}: {e}")
-                        bot.send_message(chat_id, message)
-                else:
-                    bot.send_message(chat_id, message)
-                
-                # Small delay to avoid flooding
-                time.sleep(1)
-                
+    async def _check_image(self, url):
+        session = await self._session()
+        started = time.perf_counter()
+        try:
+            async with session.head(url, timeout=aiohttp.ClientTimeout(total=IMAGE_CHECK_TIMEOUT)) as response:
+                verdict = image_checker.verdict_for(response.status, response.headers.get('content-type', ''))
+        except asyncio.TimeoutError:
+            verdict = "timeout"
+        except Exception as e:
+            logger.error(f"Error checking image {url}: {e}")
+            verdict = "error"
+        metrics.observe("image_check", time.perf_counter() - started)
+        image_checker.record(url, verdict)
+        return verdict
+
+    async def iter_divar_products(self, query, max_items, city="tehran", min_price=None, max_price=None, trace=None,
+                                  source=DEFAULT_SEARCH_SOURCE):
+        """Async counterpart of ``iter_divar_products``, sharing its cache, listing index and in-progress searches"""
+        cities = split_cities(city)
+        if len(cities) > 1:
+            async for product in self._iter_multi_city_products(query, max_items, cities, min_price, max_price,
+                                                                trace, source):
+                yield product
+            return
+
+        cache_key = SearchCache.make_key(query, city, min_price, max_price)
+        profiling = trace is not None and trace.profile is not None
+        cached = None if profiling else search_cache.get(cache_key, max_items)
+        if cached is not None:
+            logger.info(f"Cache hit for search {cache_key}")
+            for product in cached:
+                yield product
+            return
+
+        indexed = None
+        if source == "index" and not profiling:
+            indexed = await asyncio.get_running_loop().run_in_executor(
+                self.parse_executor, listing_index.search, query, city, max_items, min_price, max_price)
+        if indexed is not None:
+            logger.info(f"Answered search {cache_key} from the listing index")
+            metrics.inc("searches_from_index_total")
+            for product in indexed:
+                yield product
+            return
+
+        flight, leader = (None, False) if profiling else search_flights.join(cache_key, max_items)
+        rejoined = False
+        while flight is not None and not leader:
+            try:
+                shared = await search_flights.result_async(flight)
             except Exception as e:
-                logger.error(f"Error sending product {idx}: {e}")
-                continue
-        
-        # Show completion message and main menu
-        completion_msg = f"""✨ جستجو کامل شد!
+                logger.error(f"Error scraping Divar: {e}")
+                for product in stale_results(cache_key, max_items, e):
+                    yield product
+                return
+            if shared is not None:
+                logger.info(f"Joined in-progress search {cache_key}")
+                for product in shared[:max_items]:
+                    yield dict(product)
+                return
+            if rejoined or not flight.done():
+                break
+            rejoined = True
+            flight, leader = search_flights.join(cache_key, max_items)
 
-📊 نتایج: {len(products)} محصول
-🎯 محصول: {product_name}
-🏙️ شهر: {CITIES_DATA.get(city, city)}
+        results = []
+        completed = False
+        error = None
+        try:
+            if leader:
+                results = [product async for product in
+                           self._iter_fetched_products(query, max_items, city, min_price, max_price, trace)]
+            else:
+                async for product in self._iter_fetched_products(query, max_items, city, min_price, max_price,
+                                                                 trace):
+                    results.append(product)
+                    yield dict(product)
+            completed = True
+        except Exception as e:
+            error = e
+            logger.error(f"Error scraping Divar: {e}")
+        finally:
+            if leader:
+                search_flights.finish(cache_key, flight, results if completed else None, error)
 
-💡 برای جستجوی جدید از منوی زیر استفاده کنید:"""
+        if error is not None:
+            if not results:
+                for product in stale_results(cache_key, max_items, error):
+                    yield product
+            return
+        search_cache.put(cache_key, max_items, results)
+        if leader:
+            for product in results:
+                yield dict(product)
+
+    async def _iter_multi_city_products(self, query, max_items, cities, min_price, max_price, trace=None,
+                                        source=DEFAULT_SEARCH_SOURCE):
+        """Async counterpart of ``iter_multi_city_products``; the connector's per-host limit is the shared cap"""
+        limit = asyncio.Semaphore(MULTI_CITY_CONCURRENCY)
+
+        async def fetch_city(city):
+            async with limit:
+                return [product async for product in
+                        self.iter_divar_products(query, max_items, city, min_price, max_price, trace, source)]
+
+        results = await asyncio.gather(*(fetch_city(city) for city in cities), return_exceptions=True)
+        for city, result in zip(cities, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Error searching '{query}' in {city}: {result}")
+        if all(isinstance(result, BaseException) for result in results):
+            raise results[0]
+        logger.info(f"Search '{query}' in {len(cities)} cities: " + ", ".join(
+            f"{city} {len(result) if isinstance(result, list) else 0}" for city, result in zip(cities, results)))
+        for product in merge_city_results([result if isinstance(result, list) else [] for result in results],
+                                          max_items):
+            yield product
+
+    async def _iter_fetched_products(self, query, max_items, city, min_price, max_price, trace=None):
+        """Async counterpart of ``iter_fetched_products``: same paging and stop rules"""
+        seen_tokens = set()
+        duplicates = near_duplicate_index()
+        price_range = (min_price, max_price) if min_price is not None or max_price is not None else None
+        found = 0
+        per_page = 0
+        timings = []
+        in_flight = deque()
+        next_page = 2
+        profile = trace.profile if trace is not None else None
+        parse = profile.wrap(parse_and_extract) if profile is not None else parse_and_extract
+        abandoned = threading.Event()
+
+        def submit(page):
+            url = build_search_url(query, city, min_price, max_price, page)
+            in_flight.append((page, asyncio.ensure_future(self.fetch_page(url, abandoned))))
+
+        submit(1)
+        try:
+            while in_flight:
+                page, task = in_flight.popleft()
+                try:
+                    content, fetch_seconds = await task
+                except Exception as e:
+                    if page == 1:
+                        raise
+                    logger.error(f"Error fetching page {page} for '{query}': {e}")
+                    break
+
+                products, parse_seconds, extract_seconds = await asyncio.get_running_loop().run_in_executor(
+                    self.parse_executor, parse, content, max_items - found, seen_tokens, price_range, profile,
+                    duplicates)
+                seen_at = time.time()
+                for product in products:
+                    listing_index.add(product, city, seen_at)
+                    yield product
+                found += len(products)
+
+                timing = {
+                    "page": page,
+                    "fetch_ms": fetch_seconds * 1000,
+                    "parse_ms": parse_seconds * 1000,
+                    "extract_ms": extract_seconds * 1000,
+                    "products": len(products),
+                }
+                timings.append(timing)
+                record_page_timing(timing, trace)
+
+                if found >= max_items or not products:
+                    break
+
+                per_page = max(per_page, len(products))
+                while len(in_flight) < pages_wanted(max_items - found, per_page) and next_page <= DIVAR_MAX_PAGES:
+                    submit(next_page)
+                    next_page += 1
+        finally:
+            abandoned.set()
+            for _, task in in_flight:
+                task.cancel()
+            if timings:
+                log_page_timings(query, city, timings, trace)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": self._active,
+                "image_checks_in_flight": len(self._image_checks),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "replaced": self.replaced,
+                "rejected": self.rejected,
+                **{f"telegram_{key}": value for key, value in self.telegram.stats().items()},
+            }
+
+async_runtime = AsyncSearchRuntime()
+
+async def async_show_main_menu(chat_id):
+    await async_runtime.call("sendMessage", chat_id, text=MAIN_MENU_TEXT,
+                             reply_markup=main_menu_keyboard().to_dict())
+
+async def async_send_product_card(chat_id, idx, product, image_verdict=None):
+    """Coroutine version of ``send_product_card``"""
+    message = format_product_message(idx, product)
+    
+    if product.get('image_url') and image_verdict == "ok":
+        try:
+            return await async_runtime.call("sendPhoto", chat_id, photo=product['image_url'], caption=message[:1024])
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                raise
+            logger.error(f"Error sending image for product {idx}: {e}")
+        except Exception as e:
+            logger.error(f"Error sending image for product {idx}: {e}")
+    
+    return await async_runtime.call("sendMessage", chat_id, text=message)
+
+async def async_send_product_texts(chat_id, items):
+    """Coroutine version of ``send_product_texts``"""
+    result = None
+    for text in chunk_messages([format_product_message(idx, product) for idx, product in items]):
+        result = await async_runtime.call("sendMessage", chat_id, text=text)
+    return result
+
+async def async_send_product_album(chat_id, items):
+    """Coroutine version of ``send_product_album``"""
+    if len(items) == 1:
+        idx, product = items[0]
+        return await async_send_product_card(chat_id, idx, product, "ok")
+    
+    media = [
+        {"type": "photo", "media": product['image_url'], "caption": format_product_message(idx, product)[:1024]}
+        for idx, product in items
+    ]
+    try:
+        return await async_runtime.call("sendMediaGroup", chat_id, media=media)
+    except telebot.apihelper.ApiTelegramException as e:
+        if e.error_code == 429:
+            raise
+        logger.error(f"Error sending album of {len(items)} products: {e}")
+    except Exception as e:
+        logger.error(f"Error sending album of {len(items)} products: {e}")
+    
+    return await async_send_product_texts(chat_id, items)
+
+async def async_send_result_browser(chat_id, result_id):
+    """Coroutine version of ``send_result_browser``"""
+    result_set = result_sets.get(result_id, chat_id)
+    if result_set is None:
+        return None
+    return await async_runtime.call("sendMessage", chat_id, text=format_result_page(result_set, 0),
+                                    reply_markup=result_page_keyboard(result_id, result_set, 0).to_dict(),
+                                    link_preview_options=NO_PREVIEW.to_dict())
+
+async def async_iter(items):
+    for item in items:
+        yield item
+
+async def async_send_products(product_name, count, chat_id, city, min_price=None, max_price=None, cancelled=None,
+                              delivery_mode=DEFAULT_DELIVERY_MODE, sort_order=DEFAULT_SORT_ORDER,
+                              source=DEFAULT_SEARCH_SOURCE):
+    """Coroutine version of ``send_products`` for EXECUTION_MODE = "asyncio".
+
+    Cards are sent in order as products stream in, while image checks for
+    the next IMAGE_CHECK_LOOKAHEAD products and further result pages are
+    fetched by tasks on the same loop.
+    """
+    trace = SearchTrace(product_name, city)
+    # The loop thread runs every search, so only the parse workers are CPU-profiled
+    trace.profile = search_profiler.claim(trace, this_thread=False)
+    outcome = "error"
+    sent = 0
+    album = []
+    text_only = []
+    pending = deque()
+    
+    first_delivered = False
+    
+    def log_first_delivery():
+        nonlocal first_delivered
+        if not first_delivered:
+            first_delivered = True
+            logger.info(f"Search #{trace.search_id} '{product_name}' in {city}: first listing delivered after "
+                        f"{time.perf_counter() - trace.started:.2f}s")
+    
+    async def flush_album():
+        if album:
+            items = list(album)
+            album.clear()
+            with trace.span("telegram_send"):
+                await async_send_product_album(chat_id, items)
+            log_first_delivery()
+    
+    async def deliver(product, image_check):
+        nonlocal sent
+        sent += 1
         
-        bot.send_message(chat_id, completion_msg)
-        show_main_menu(chat_id)
+        if sent == 1:
+            await async_runtime.call("sendMessage", chat_id, text=FOUND_TEXT)
+        
+        verdict = None
+        if image_check:
+            try:
+                with trace.span("image_wait"):
+                    verdict = await image_check
+            except Exception as e:
+                logger.error(f"Error checking image for product {sent}: {e}")
+        
+        if delivery_mode != "album":
+            with trace.span("telegram_send"):
+                await async_send_product_card(chat_id, sent, product, verdict)
+            log_first_delivery()
+        elif product.get('image_url') and verdict == "ok":
+            album.append((sent, product))
+            if len(album) >= ALBUM_SIZE:
+                await flush_album()
+        else:
+            text_only.append((sent, product))
+    
+    def superseded():
+        nonlocal outcome
+        if cancelled is not None and cancelled.is_set():
+            outcome = "replaced"
+            return True
+        return False
+    
+    stream = None
+    try:
+        stream = products = async_runtime.iter_divar_products(product_name, count, city, min_price, max_price, trace=trace,
+                                                     source=source)
+        if sort_order != "relevance":
+            products = async_iter(sort_products([product async for product in products], sort_order))
+        if delivery_mode == "browser":
+            results = [product async for product in products]
+            if superseded():
+                return
+            if results:
+                sent = len(results)
+                with trace.span("telegram_send"):
+                    await async_send_result_browser(chat_id, result_sets.put(chat_id, product_name, city, results))
+                log_first_delivery()
+            products = async_iter(())
+        async for product in products:
+            if superseded():
+                return
+            image_check = (asyncio.ensure_future(async_runtime.check_image(product['image_url']))
+                           if product.get('image_url') else None)
+            pending.append((product, image_check))
+            if len(pending) > IMAGE_CHECK_LOOKAHEAD:
+                await deliver(*pending.popleft())
+        
+        while pending:
+            if superseded():
+                return
+            await deliver(*pending.popleft())
+        
+        await flush_album()
+        if text_only:
+            with trace.span("telegram_send"):
+                await async_send_product_texts(chat_id, list(text_only))
+            log_first_delivery()
+        
+        if not sent:
+            outcome = "no_results"
+            await async_runtime.call("sendMessage", chat_id, text=NO_RESULTS_TEXT)
+            await async_show_main_menu(chat_id)
+            return
+        
+        outcome = "results"
+        await async_runtime.call("sendMessage", chat_id, text=completion_text(sent, product_name, city),
+                                 reply_markup=watch_offer_keyboard().to_dict())
+        await async_show_main_menu(chat_id)
         
     except Exception as e:
-        logger.error(f"Error in send_products: {e}")
-        bot.send_message(chat_id, "❌ خطایی در دریافت اطلاعات رخ داد. لطفاً دوباره تلاش کنید.")
-        show_main_menu(chat_id)
+        logger.error(f"Error in async_send_products: {e}")
+        await async_runtime.call("sendMessage", chat_id, text=search_error_text(e))
+        await async_show_main_menu(chat_id)
+    
+    finally:
+        for _, image_check in pending:
+            if image_check:
+                image_check.cancel()
+        if stream is not None:
+            await stream.aclose()
+        trace.finish(outcome, f"{sent} listings sent")
+        if trace.profile is not None:
+            await asyncio.get_running_loop().run_in_executor(None, search_profiler.finish, trace.profile)
+
+class UpdateDispatcher:
+    """Runs incoming updates through the bot handlers on a bounded pool of workers."""
+
+    def __init__(self, workers, queue_size):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="update")
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+        self.failed = 0
+        self.in_flight = 0
+
+    def submit(self, update):
+        """Queue one update; returns False when the queue is full."""
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            self.accepted += 1
+            self.in_flight += 1
+        self.executor.submit(self._run, update)
+        return True
+
+    def _run(self, update):
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            with self.lock:
+                self.failed += 1
+            logger.error(f"Error handling update {update.update_id}: {e}")
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "in_flight": self.in_flight,
+            }
+
+update_dispatcher = UpdateDispatcher(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # connections Telegram may open before they are accepted
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accepts Telegram webhook POSTs and acknowledges them before the handlers run."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if urlsplit(self.path).path != WEBHOOK_PATH:
+            return self._reply(404)
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+                self.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+            return self._reply(403)
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            return self._reply(400)
+        if length <= 0 or length > WEBHOOK_MAX_BODY:
+            return self._reply(413 if length > 0 else 400)
+        try:
+            update = telebot.types.Update.de_json(json.loads(self.rfile.read(length)))
+        except Exception as e:
+            logger.error(f"Invalid webhook payload: {e}")
+            return self._reply(400)
+        # 503 makes Telegram redeliver the update later instead of it being dropped
+        self._reply(200 if update_dispatcher.submit(update) else 503)
+
+    def do_GET(self):
+        self._reply(200 if urlsplit(self.path).path == "/healthz" else 404)
+
+    def _reply(self, status):
+        body = b"ok" if status == 200 else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        if status >= 400:
+            # The request body may be unread, so the connection cannot be reused
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def run_webhook():
+    """Serve Telegram updates over HTTP until the process is stopped."""
+    # The dispatcher already runs every update on its own worker
+    bot.threaded = False
+    server = WebhookServer((WEBHOOK_LISTEN_HOST, WEBHOOK_LISTEN_PORT), WebhookHandler)
+    if WEBHOOK_SSL_CERT and WEBHOOK_SSL_KEY:
+        import ssl
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(WEBHOOK_SSL_CERT, WEBHOOK_SSL_KEY)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None,
+                        max_connections=min(100, UPDATE_WORKERS * 5))
+    logger.info(f"🚀 Divar Bot is listening for webhooks on {WEBHOOK_LISTEN_HOST}:{WEBHOOK_LISTEN_PORT}{WEBHOOK_PATH}")
+    print("🚀 Bot is running and ready to search Divar!")
+    server.serve_forever()
+
+def metric_sources():
+    """Current ``stats()`` of every component, by metric name prefix"""
+    return {
+        "cache": search_cache.stats(),
+        "single_flight": search_flights.stats(),
+        "image": image_checker.stats(),
+        "scheduler": search_scheduler.stats(),
+        "outbox": outbox.stats(),
+        "state": state_store.stats(),
+        "watch": watch_scheduler.stats(),
+        "async": async_runtime.stats(),
+        "updates": update_dispatcher.stats(),
+        "profiler": search_profiler.stats(),
+        "listing_index": listing_index.stats(),
+        "result_sets": result_sets.stats(),
+        "user_settings": user_settings.stats(),
+        "last_searches": last_searches.stats(),
+        "fetch": {**divar_breaker.stats(), **retry_budget.stats()},
+    }
+
+def _metric_labels(labels):
+    if not labels:
+        return ""
+    # JSON string escaping matches the exposition format's for label values
+    return "{" + ",".join(f"{name}={json.dumps(str(value), ensure_ascii=False)}" for name, value in labels) + "}"
+
+def render_metrics():
+    """All counters, histograms and component stats in the Prometheus text format"""
+    lines = []
+    
+    counters = {}
+    for (name, labels), value in sorted(metrics.counters().items()):
+        counters.setdefault(name, []).append((labels, value))
+    for name, series in counters.items():
+        lines.append(f"# TYPE divar_{name} counter")
+        lines.extend(f"divar_{name}{_metric_labels(labels)} {value}" for labels, value in series)
+    
+    pages = {method: metrics.counter("extracted_pages_total", method=method)
+             for method in ("structured", "links", "containers")}
+    total_pages = sum(pages.values())
+    lines.append("# HELP divar_extraction_fallback_ratio Share of pages that needed the container fallback")
+    lines.append("# TYPE divar_extraction_fallback_ratio gauge")
+    lines.append(f"divar_extraction_fallback_ratio {pages['containers'] / total_pages if total_pages else 0.0}")
+    
+    histograms = metrics.histograms()
+    if histograms:
+        lines.append("# TYPE divar_stage_seconds histogram")
+        for stage, (cumulative, total, count, _) in histograms.items():
+            for bound, value in zip(metrics.buckets + ("+Inf",), cumulative):
+                lines.append(f'divar_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {value}')
+            lines.append(f'divar_stage_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'divar_stage_seconds_count{{stage="{stage}"}} {count}')
+        lines.append("# HELP divar_stage_seconds_quantile Latency quantiles over recent spans")
+        lines.append("# TYPE divar_stage_seconds_quantile gauge")
+        for stage, (_, _, _, quantiles) in histograms.items():
+            for q, seconds in quantiles.items():
+                lines.append(f'divar_stage_seconds_quantile{{stage="{stage}",quantile="{q}"}} {seconds}')
+    
+    for prefix, stats in metric_sources().items():
+        for key, value in stats.items():
+            if isinstance(value, (int, float)):
+                lines.append(f"# TYPE divar_{prefix}_{key} gauge")
+                lines.append(f"divar_{prefix}_{key} {float(value)}")
+    
+    for key in ("requests", "new_connections", "reused_connections"):
+        lines.append(f"# TYPE divar_http_{key} gauge")
+        lines.extend(f'divar_http_{key}{{host="{host}"}} {entry[key]}' for host, entry in http_client.stats().items())
+    
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves ``render_metrics`` at /metrics for Prometheus to scrape"""
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/metrics":
+            self.send_error(404)
+            return
+        try:
+            body = render_metrics().encode()
+        except Exception as e:
+            logger.error(f"Error rendering metrics: {e}")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server():
+    """Serve /metrics on METRICS_HOST:METRICS_PORT in the background; returns the server"""
+    server = WebhookServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Metrics available at http://{METRICS_HOST}:{server.server_address[1]}/metrics")
+    return server
 
 # Error handler for bot polling
 def main():
+    watch_scheduler.start()
+    if METRICS_PORT:
+        start_metrics_server()
+    if BOT_MODE == "webhook":
+        run_webhook()
+        return
     while True:
         try:
             logger.info("🚀 Divar Bot is starting...")
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# bot reads its configuration at import time: a dummy token, and no listing index file in the working tree
+os.environ.setdefault("DIVAR_BOT_TOKEN", "123456:TEST")
+os.environ["DIVAR_LISTING_INDEX"] = ""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,137 @@
+import threading
+import time
+
+import pytest
+import requests
+
+import bot
+
+
+def test_breaker_opens_after_threshold_and_fails_fast():
+    breaker = bot.CircuitBreaker(failure_threshold=3, open_seconds=60)
+    for _ in range(2):
+        breaker.before_request()
+        breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.is_open()
+    with pytest.raises(bot.CircuitOpenError):
+        breaker.before_request()
+    assert breaker.stats()["opened"] == 1
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_breaker_success_resets_failures():
+    breaker = bot.CircuitBreaker(failure_threshold=2, open_seconds=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_breaker_half_open_trial():
+    breaker = bot.CircuitBreaker(failure_threshold=1, open_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.before_request()
+    assert breaker.state == "half_open"
+    # Only one trial request at a time
+    with pytest.raises(bot.CircuitOpenError):
+        breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    time.sleep(0.06)
+    breaker.before_request()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.before_request()
+
+
+def test_breaker_hold_opens_at_once():
+    breaker = bot.CircuitBreaker(failure_threshold=5, open_seconds=1)
+    breaker.record_failure(hold=120)
+    assert breaker.is_open()
+    assert breaker._open_until - time.monotonic() > 100
+
+
+def test_retry_budget_spends_only_whole_retries():
+    budget = bot.RetryBudget(ratio=0.5, min_rate=1e-9, capacity=2)
+    assert budget.try_retry() and budget.try_retry()
+    assert not budget.try_retry()
+    budget.record_attempt()
+    assert not budget.try_retry()
+    budget.record_attempt()
+    assert budget.try_retry()
+    assert budget.stats()["retries_granted"] == 3 and budget.stats()["retries_denied"] == 2
+
+
+@pytest.mark.parametrize("value, expected", [("3", 3.0), ("0", 0.0), ("", None), (None, None), ("soon", None),
+                                             ("Wed, 21 Oct 2015 07:28:00 GMT", 0.0)])
+def test_parse_retry_after(value, expected):
+    assert bot.parse_retry_after(value) == expected
+
+
+class FailingResponse:
+    status_code = 503
+    reason = "Service Unavailable"
+    headers = {}
+
+
+@pytest.fixture
+def fresh_fetch_state(monkeypatch):
+    monkeypatch.setattr(bot, "divar_breaker", bot.CircuitBreaker())
+    monkeypatch.setattr(bot, "retry_budget", bot.RetryBudget())
+    monkeypatch.setattr(bot, "FETCH_BACKOFF_BASE", 0.01)
+
+
+def test_fetch_retries_server_errors(monkeypatch, fresh_fetch_state):
+    calls = []
+    monkeypatch.setattr(bot.http_client, "get", lambda url, **kwargs: calls.append(url) or FailingResponse())
+    with pytest.raises(requests.HTTPError):
+        bot.fetch_divar_page("http://divar.test/s/tehran")
+    assert len(calls) == bot.FETCH_MAX_ATTEMPTS
+    assert bot.divar_breaker.stats()["consecutive_failures"] == bot.FETCH_MAX_ATTEMPTS
+
+
+def test_abandoned_fetch_stops_without_charging_breaker(monkeypatch, fresh_fetch_state):
+    cancelled = threading.Event()
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+        cancelled.set()  # the search gave up while this request was in flight
+        return FailingResponse()
+
+    monkeypatch.setattr(bot.http_client, "get", get)
+    with pytest.raises(requests.HTTPError):
+        bot.fetch_divar_page("http://divar.test/s/tehran", cancelled)
+    assert len(calls) == 1
+    assert bot.divar_breaker.stats()["consecutive_failures"] == 0
+    with pytest.raises(bot.FetchCancelled):
+        bot.fetch_divar_page("http://divar.test/s/tehran", cancelled)
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize("missing, per_page, expected", [(1, 24, 1), (24, 24, 1), (25, 24, 2), (500, 24, 3),
+                                                         (10, 1, 3)])
+def test_pages_wanted(monkeypatch, missing, per_page, expected):
+    monkeypatch.setattr(bot, "DIVAR_PAGE_FANOUT", 3)
+    assert bot.pages_wanted(missing, per_page) == expected
+
+
+def test_cancelled_multi_city_search_starts_no_more_cities(monkeypatch):
+    monkeypatch.setattr(bot, "MULTI_CITY_CONCURRENCY", 1)
+    cancelled = threading.Event()
+    started = []
+
+    def fetch_city(query, max_items, city, *args):
+        started.append(city)
+        cancelled.set()
+        yield {"title": query, "url": f"https://divar.ir/v/{city}"}
+
+    monkeypatch.setattr(bot, "iter_divar_products", fetch_city)
+    with pytest.raises(bot.FetchCancelled):
+        list(bot.iter_multi_city_products("میز", 5, ["tehran", "karaj", "qom"], cancelled=cancelled))
+    assert started == ["tehran"]
@@ -0,0 +1,84 @@
+import pytest
+
+import bot
+
+
+def product(token, title, price_value=None):
+    return {"title": title, "price": "قیمت نامشخص", "price_value": price_value, "meta": "",
+            "url": f"https://divar.ir/v/{token}/{token}"}
+
+
+@pytest.fixture
+def index(tmp_path):
+    # The background writer never wakes up on its own; tests write with ``write``
+    index = bot.ListingIndex(path=str(tmp_path / "listings.sqlite3"), flush_interval=3600)
+    yield index
+    if index._db is not None:
+        index._db.close()
+
+
+def write(index, *entries):
+    """Queue (product, city) pairs and write them straight away"""
+    for item, city in entries:
+        index.add(item, city)
+    with index._cond:
+        rows = list(index._pending)
+        index._pending.clear()
+    index._write(rows)
+
+
+def test_search_matches_every_word(index):
+    write(index, (product("a1", "گوشی آیفون ۱۳"), "tehran"), (product("a2", "گوشی سامسونگ"), "tehran"),
+          (product("a3", "آیفون ۱۱"), "tehran"))
+    found = index.search("گوشی آیفون", "tehran", 1)
+    assert [item["url"] for item in found] == ["https://divar.ir/v/a1/a1"]
+    assert index.search("گوشی", "tehran", 3) is None  # only two match
+
+
+def test_search_filters_city_and_price(index):
+    write(index, (product("b1", "دوچرخه", 5000000), "tehran"), (product("b2", "دوچرخه", 9000000), "tehran"),
+          (product("b3", "دوچرخه", 5000000), "mashhad"))
+    found = index.search("دوچرخه", "tehran", 1, max_price=6000000)
+    assert [item["url"] for item in found] == ["https://divar.ir/v/b1/b1"]
+    assert index.search("دوچرخه", "tehran", 2, max_price=6000000) is None
+    assert len(index.search("دوچرخه", "iran", 3)) == 3
+
+
+def test_upsert_refreshes_details_and_keeps_specific_city(index):
+    write(index, (product("c1", "میز تحریر", 100), "tehran"))
+    first_seen = index._db.execute("SELECT first_seen FROM listings").fetchone()[0]
+    write(index, (product("c1", "میز تحریر چوبی", 200), "iran"))
+
+    rows = index._db.execute("SELECT city, title, price_value, first_seen FROM listings").fetchall()
+    assert rows == [("tehran", "میز تحریر چوبی", 200, first_seen)]
+    assert index.search("چوبی", "tehran", 1) is not None
+
+    write(index, (product("c1", "میز تحریر چوبی", 200), "mashhad"))
+    assert index._db.execute("SELECT city FROM listings").fetchone()[0] == "mashhad"
+
+
+def test_disabled_index_stores_nothing():
+    index = bot.ListingIndex(path="")
+    index.add(product("d1", "کتاب"), "tehran")
+    assert index.queued == 0
+    assert index.search("کتاب", "tehran", 1) is None
+
+
+@pytest.mark.parametrize("title, query", [
+    ("آیفون ۱۳ پرو", "ایفون 13"),
+    ("كتاب عربي", "کتاب عربی"),
+    ("کتاب عربی", "كتاب عربي"),
+    ("پائیز", "پاییز"),
+    ("مبل راحتی‌دار", "راحتی دار"),
+    ("مُبلـمان", "مبلمان"),
+])
+def test_search_folds_letter_variants(index, title, query):
+    write(index, (product("e1", title), "tehran"))
+    assert index.search(query, "tehran", 1) is not None
+
+
+def test_search_folds_letter_variants_without_fts(index):
+    index._connect()
+    index.fts = False
+    write(index, (product("f1", "آیفون ١٣"), "tehran"))
+    assert index.search("ایفون ۱۳", "tehran", 1) is not None
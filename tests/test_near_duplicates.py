@@ -0,0 +1,70 @@
+import pytest
+
+import bot
+
+
+def product(title, price_value=None, photo=None):
+    item = {"title": title, "price_value": price_value}
+    if photo:
+        item["image_url"] = f"https://s100.divarcdn.com/static/photo/post/{photo}.jpg"
+    return item
+
+
+REPOSTS = [
+    (product("آیفون ۱۳ پرو مکس ۲۵۶", 52000000), product("آیفون 13 پرومکس 256", 52000000)),
+    (product("آیفون ۱۳ پرو مکس ۲۵۶", 52000000, "a1"), product("آیفون 13 پرو مکس 256 گیگ", 51500000, "b2")),
+    (product("یخچال ساید بای ساید سامسونگ", 38000000, "x1"),
+     product("یخچال ساید بای ساید سامسونگ تمیز", 38000000, "x9")),
+    (product("مبل راحتی ۷ نفره", 12000000), product("مبل راحتی ۷نفره", 12000000)),
+    (product("پژو ۲۰۶ تیپ ۲ مدل ۹۸", 650000000, "p1"), product("پژو 206 تیپ2 مدل 98", 650000000, "p7")),
+    (product("لپتاپ ایسوس گیمینگ", 45000000), product("لپ‌تاپ ایسوس گیمینگ!!", 45000000)),
+    (product("Galaxy A54 5G", 17000000, "g1"), product("galaxy a54 5g", 17000000, "g2")),
+    (product("کولر گازی ال جی ۱۸۰۰۰", 25000000), product("کولر گازی ال‌جی 18000", 24500000)),
+    (product("دوچرخه کوهستان ترک سایز ۲۷", 18000000, "d1"),
+     product("دوچرخه کوهستان ترک سایز 27 در حد نو", 18000000, "d2")),
+    (product("ماشین لباسشویی بوش ۸ کیلو", 20000000), product("ماشین لباسشویی بوش 8 کیلویی", 20000000)),
+    (product("کنسول پلی استیشن ۵ اسلیم", 30000000, "c1"), product("کنسول پلی‌استیشن 5 اسلیم", 30000000, "c3")),
+    (product("فرش ماشینی ۱۲ متری ۷۰۰ شانه", 9000000), product("فرش ماشینی 12متری 700شانه", 9000000)),
+]
+
+DISTINCT = [
+    (product("پژو 206 تیپ 2", 650000000), product("پژو 206 تیپ 5", 650000000)),
+    (product("Galaxy A54", 17000000), product("Galaxy A34", 17000000)),
+    (product("آیفون ۱۳ پرو مکس ۲۵۶", 52000000), product("آیفون ۱۴ پرو مکس ۲۵۶", 52000000)),
+    (product("آیفون ۱۳ پرو", 45000000), product("آیفون ۱۳ پرو مکس", 45000000)),
+    (product("یخچال ساید بای ساید سامسونگ", 38000000), product("یخچال ساید بای ساید ال جی", 38000000)),
+    (product("لپ تاپ ایسوس گیمینگ", 45000000), product("لپ تاپ لنوو گیمینگ", 45000000)),
+    (product("دوچرخه کوهستان", 18000000), product("دوچرخه کوهستان", 5000000)),
+    (product("میز تحریر چوبی", 1500000), product("میز ناهارخوری چوبی", 1500000)),
+    (product("میز تحریر چوبی", 1500000, "m1"), product("صندلی چوبی", 1500000, "m1")),
+    (product("گوشی سامسونگ S23 اولترا", 40000000), product("گوشی سامسونگ S23 پلاس", 40000000)),
+    (product("ماشین لباسشویی بوش ۸ کیلو", 20000000), product("ماشین ظرفشویی بوش", 20000000)),
+    (product("کتاب زبان انگلیسی", 200000), product("کتاب زبان آلمانی", 200000)),
+    (product("اجاره آپارتمان ۸۰ متری", 10000000), product("اجاره آپارتمان ۱۲۰ متری", 10000000)),
+]
+
+
+@pytest.mark.parametrize("first, second", REPOSTS, ids=[pair[1]["title"] for pair in REPOSTS])
+def test_repost_is_suppressed(first, second):
+    index = bot.NearDuplicateIndex()
+    assert not index.is_duplicate(first)
+    assert index.is_duplicate(second)
+    assert index.suppressed == 1
+
+
+@pytest.mark.parametrize("first, second", DISTINCT, ids=[pair[1]["title"] for pair in DISTINCT])
+def test_different_listings_are_kept(first, second):
+    index = bot.NearDuplicateIndex()
+    assert not index.is_duplicate(first)
+    assert not index.is_duplicate(second)
+
+
+def test_model_key_ignores_spacing_and_digit_script():
+    assert bot.listing_model_key(product("پژو ۲۰۶ تیپ۲")) == bot.listing_model_key(product("پژو 206 تیپ 2"))
+    assert bot.listing_model_key(product("Galaxy A54")) != bot.listing_model_key(product("Galaxy A34"))
+
+
+def test_shared_photo_alone_is_not_a_repost():
+    first, second = product("میز تحریر چوبی", photo="m1"), product("صندلی چوبی", photo="m1")
+    distance = bin(bot.listing_fingerprint(first) ^ bot.listing_fingerprint(second)).count("1")
+    assert distance > bot.NEAR_DUPLICATE_MAX_DISTANCE
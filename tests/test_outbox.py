@@ -0,0 +1,79 @@
+import threading
+
+import telebot
+
+import bot
+
+
+def flood_error(retry_after=0):
+    return telebot.apihelper.ApiTelegramException(
+        "sendMessage", None, {"error_code": 429, "description": "Too Many Requests",
+                              "parameters": {"retry_after": retry_after}})
+
+
+def products(count):
+    # Long enough that the combined text needs several messages
+    return [(idx, {"title": f"آگهی {idx}", "price": "۱۰۰ تومان", "meta": "x" * 1500,
+                   "url": f"https://divar.ir/v/item/t{idx}"}) for idx in range(1, count + 1)]
+
+
+def test_flood_limit_retry_resends_only_undelivered_chunks(monkeypatch):
+    sent = []
+    failures = [flood_error()]
+
+    def send_message(chat_id, text, **kwargs):
+        if len(sent) == 1 and failures:
+            raise failures.pop()
+        sent.append(text)
+
+    monkeypatch.setattr(bot.bot, "send_message", send_message)
+    items = products(6)
+    chunks = bot.chunk_messages([bot.format_product_message(idx, product) for idx, product in items])
+    assert len(chunks) > 2
+
+    outbox = bot.OutboundSender(global_rate=1e9, global_burst=1e9, chat_rate=1e9, chat_burst=1e9)
+    outbox.submit(1, bot.send_product_texts, 1, items, [0]).result(5)
+    assert sent == chunks
+    assert outbox.stats()["retried"] == 1
+
+
+def test_album_fallback_retry_continues_text(monkeypatch):
+    sent = []
+    failures = [flood_error()]
+    groups = []
+
+    def send_media_group(chat_id, media):
+        groups.append(media)
+        raise telebot.apihelper.ApiTelegramException(
+            "sendMediaGroup", None, {"error_code": 400, "description": "Bad Request: wrong file"})
+
+    def send_message(chat_id, text, **kwargs):
+        if len(sent) == 1 and failures:
+            raise failures.pop()
+        sent.append(text)
+
+    monkeypatch.setattr(bot.bot, "send_media_group", send_media_group)
+    monkeypatch.setattr(bot.bot, "send_message", send_message)
+    items = [(idx, dict(product, image_url=f"https://img.test/{idx}.jpg")) for idx, product in products(6)]
+    chunks = bot.chunk_messages([bot.format_product_message(idx, product) for idx, product in items])
+
+    outbox = bot.OutboundSender(global_rate=1e9, global_burst=1e9, chat_rate=1e9, chat_burst=1e9)
+    outbox.submit(1, bot.send_product_album, 1, items, [0]).result(5)
+    assert sent == chunks
+    assert len(groups) == 1
+
+
+def test_live_call_behind_cancelled_calls_is_sent():
+    outbox = bot.OutboundSender(global_rate=1e9, global_burst=1e9, chat_rate=1e9, chat_burst=1e9)
+    gate = threading.Event()
+    replaced = threading.Event()
+    # Hold the chat busy so both calls below are queued before the dispatcher looks at them
+    busy = outbox.submit(1, gate.wait, 5)
+    stale = [outbox.submit(1, lambda: "stale", cancelled=replaced) for _ in range(2)]
+    live = outbox.submit(1, lambda: "live")
+    replaced.set()
+    gate.set()
+    busy.result(5)
+    assert live.result(5) == "live"
+    assert all(future.cancelled() for future in stale)
+    assert outbox.stats()["skipped"] == 2
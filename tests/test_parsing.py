@@ -0,0 +1,46 @@
+import pytest
+
+import bot
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("۱۵٬۰۰۰٬۰۰۰ تومان", 15000000),
+    ("15,000,000 تومان", 15000000),
+    ("1.500.000 تومان", 1500000),
+    ("۱٫۵۰۰٫۰۰۰ تومان", 1500000),
+    ("۲۵۰.۰۰۰ تومان", 250000),
+    ("۲٫۵ میلیارد تومان", 2500000000),
+    ("2.75 میلیون تومان", 2750000),
+    ("۳۰۰ هزار تومان", 300000),
+    ("۱۵۰۰۰ ریال", 1500),
+    ("رایگان", 0),
+    ("توافقی", None),
+    ("", None),
+    (None, None),
+])
+def test_parse_price(text, expected):
+    assert bot.parse_price(text) == expected
+
+
+def test_dotted_price_passes_minimum():
+    product = {"price": "1.500.000 تومان"}
+    product["price_value"] = bot.parse_price(product["price"])
+    assert bot.price_in_range(product, (1000000, None))
+
+
+@pytest.mark.parametrize("meta, expected", [
+    ("۲ ساعت پیش در ونک", 120),
+    ("۵ دقیقه پیش", 5),
+    ("۳ روز پیش در ماهدشت", 3 * 24 * 60),
+    ("۲ماه پیش", 2 * 30 * 24 * 60),
+    ("هفته پیش در تهران", 7 * 24 * 60),
+    ("لحظاتی پیش در ماهشهر", 0),
+    ("دیروز", 24 * 60),
+])
+def test_parse_age_minutes(meta, expected):
+    assert bot.parse_age_minutes(meta) == expected
+
+
+@pytest.mark.parametrize("meta", ["در ماهشهر", "کارکرده در ماهدشت", "ساعت کاری ۹ تا ۵", "", None])
+def test_parse_age_minutes_without_age(meta):
+    assert bot.parse_age_minutes(meta) is None
@@ -0,0 +1,46 @@
+import pytest
+import telebot
+
+import bot
+
+
+def press(data, chat_id=7):
+    return telebot.types.CallbackQuery.de_json({
+        "id": "1", "chat_instance": "1", "data": data,
+        "from": {"id": chat_id, "is_bot": False, "first_name": "u"},
+        "message": {"message_id": 5, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "..."},
+    })
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+    monkeypatch.setattr(bot.bot, "answer_callback_query", lambda *args, **kwargs: calls.append(("answer", args, kwargs)))
+    monkeypatch.setattr(bot.bot, "edit_message_text", lambda *args, **kwargs: calls.append(("edit", args, kwargs)))
+    return calls
+
+
+@pytest.fixture
+def result_id(monkeypatch):
+    store = bot.ResultSetStore()
+    monkeypatch.setattr(bot, "result_sets", store)
+    products = [{"title": f"آگهی {n}", "price": "۱۰۰ تومان", "meta": "", "url": f"https://divar.ir/v/a/t{n}"}
+                for n in range(7)]
+    return store.put(7, "آگهی", "tehran", products)
+
+
+def test_page_press_edits_message(calls, result_id):
+    bot.browse_results(press(f"rs_{result_id}_p_1"))
+    assert [kind for kind, _, _ in calls] == ["answer", "edit"]
+
+
+@pytest.mark.parametrize("data", ["rs_{id}_p_9", "rs_{id}_i_-1", "rs_{id}_x_0", "rs_{id}_p_one", "rs_{id}",
+                                  "rs_gone_p_0"])
+def test_bad_or_stale_press_is_answered(calls, result_id, data):
+    bot.browse_results(press(data.format(id=result_id)))
+    assert calls == [("answer", ("1", bot.RESULTS_EXPIRED_TEXT), {"show_alert": True})]
+
+
+def test_other_chat_cannot_browse(calls, result_id):
+    bot.browse_results(press(f"rs_{result_id}_p_0", chat_id=8))
+    assert calls[0][1][1] == bot.RESULTS_EXPIRED_TEXT
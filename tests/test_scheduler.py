@@ -0,0 +1,77 @@
+import threading
+import time
+
+import bot
+
+
+def blocking_job(started, release):
+    def job(name, cancelled=None):
+        started[name].set()
+        release.wait(5)
+    return job
+
+
+def test_replacement_starts_without_waiting_for_cancelled_search():
+    scheduler = bot.SearchScheduler(workers=2, max_queue=10, replace_policy="replace")
+    started = {name: threading.Event() for name in ("first", "second")}
+    release = threading.Event()
+    job = blocking_job(started, release)
+    try:
+        assert scheduler.submit(1, 1, 5, job, "first") == 0
+        assert started["first"].wait(5)
+        # The first search ignores its cancellation for now; the second still gets the free worker
+        assert scheduler.submit(1, 1, 5, job, "second") == 0
+        assert started["second"].wait(5)
+        assert scheduler.stats()["replaced"] == 1
+    finally:
+        release.set()
+
+
+def test_position_counts_only_searches_ahead_of_a_worker():
+    scheduler = bot.SearchScheduler(workers=1, max_queue=10, replace_policy="replace")
+    started = {name: threading.Event() for name in ("a", "b", "c")}
+    release = threading.Event()
+    job = blocking_job(started, release)
+    try:
+        assert scheduler.submit(1, 1, 5, job, "a") == 0
+        assert started["a"].wait(5)
+        assert scheduler.submit(2, 2, 5, job, "b") == 1
+        assert scheduler.submit(3, 3, 5, job, "c") == 2
+        # A smaller search is served first
+        assert scheduler.submit(4, 4, 1, job, "c") == 1
+    finally:
+        release.set()
+
+
+def test_queue_policy_waits_behind_own_search():
+    scheduler = bot.SearchScheduler(workers=2, max_queue=10, replace_policy="queue")
+    started = {name: threading.Event() for name in ("first", "second")}
+    release = threading.Event()
+    job = blocking_job(started, release)
+    assert scheduler.submit(1, 1, 5, job, "first") == 0
+    assert started["first"].wait(5)
+    assert scheduler.submit(1, 1, 5, job, "second") == 1
+    assert not started["second"].wait(0.1)
+    release.set()
+    assert started["second"].wait(5)
+
+
+def test_async_replacement_frees_the_slot_at_once():
+    runtime = bot.AsyncSearchRuntime(parse_workers=1, max_searches=1, replace_policy="replace")
+    started = {name: threading.Event() for name in ("first", "second")}
+
+    async def search(name, cancelled=None):
+        started[name].set()
+        await bot.asyncio.sleep(5)
+
+    assert runtime.submit(1, 1, 5, search, "first") == 0
+    assert started["first"].wait(5)
+    assert runtime.submit(1, 1, 5, search, "second") == 0
+    assert started["second"].wait(5)
+    stats = runtime.stats()
+    assert stats["running"] == 1 and stats["replaced"] == 1
+    runtime._running_by_user[1][0].cancel()
+    deadline = time.monotonic() + 5
+    while runtime.stats()["running"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    runtime.loop.call_soon_threadsafe(runtime.loop.stop)
@@ -0,0 +1,115 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import bot
+
+
+def test_waiter_shares_leader_products():
+    flights = bot.SingleFlight(wait=5)
+    future, leader = flights.join("key", 10)
+    assert leader
+    waiter, waiter_leads = flights.join("key", 5)
+    assert waiter is future and not waiter_leads
+
+    threading.Timer(0.05, flights.finish, ("key", future, [{"title": "a"}])).start()
+    assert flights.result(waiter) == [{"title": "a"}]
+    assert flights.stats()["saved_fetches"] == 1
+    assert flights.stats()["in_progress"] == 0
+
+
+def test_larger_search_fetches_alone():
+    flights = bot.SingleFlight(wait=5)
+    flights.join("key", 5)
+    assert flights.join("key", 10) == (None, False)
+
+
+def test_waiter_gets_leader_error():
+    flights = bot.SingleFlight(wait=5)
+    future, _ = flights.join("key", 10)
+    flights.finish("key", future, error=ValueError("divar down"))
+    with pytest.raises(ValueError, match="divar down"):
+        flights.result(future)
+    assert flights.stats()["shared_errors"] == 1
+
+
+def test_abandoned_leader_returns_none():
+    flights = bot.SingleFlight(wait=5)
+    future, _ = flights.join("key", 10)
+    flights.finish("key", future, None)
+    assert flights.result(future) is None
+    assert flights.stats()["abandoned"] == 1
+
+
+def test_slow_leader_times_out():
+    flights = bot.SingleFlight(wait=0.05)
+    future, _ = flights.join("key", 10)
+    assert flights.result(future) is None
+    assert flights.stats()["timeouts"] == 1
+    # The leader finishing later is still published to the next waiter
+    flights.finish("key", future, [])
+    assert flights.result(future) == []
+
+
+def test_slow_leader_times_out_async():
+    flights = bot.SingleFlight(wait=0.05)
+    future, _ = flights.join("key", 10)
+    assert asyncio.run(flights.result_async(future)) is None
+    assert flights.stats()["timeouts"] == 1
+
+
+def test_waiter_gets_leader_error_async():
+    flights = bot.SingleFlight(wait=5)
+    future, _ = flights.join("key", 10)
+    flights.finish("key", future, error=ValueError("divar down"))
+    with pytest.raises(ValueError):
+        asyncio.run(flights.result_async(future))
+
+
+@pytest.fixture
+def search_state(monkeypatch):
+    """Fresh single-flight and cache state; returns the list of fetches started"""
+    monkeypatch.setattr(bot, "search_flights", bot.SingleFlight(wait=5))
+    monkeypatch.setattr(bot, "search_cache", bot.SearchCache())
+    fetches = []
+
+    def fake_fetch(query, max_items, *args):
+        fetches.append(query)
+        time.sleep(0.2)
+        yield from ({"title": f"{query} {n}", "url": f"https://divar.ir/v/{n}"} for n in range(max_items))
+
+    monkeypatch.setattr(bot, "iter_fetched_products", fake_fetch)
+    return fetches
+
+
+def test_leader_publishes_before_its_consumer_reads(search_state, monkeypatch):
+    flights = []
+    join = bot.search_flights.join
+    monkeypatch.setattr(bot.search_flights, "join", lambda *args: flights.append(join(*args)) or flights[-1])
+
+    stream = bot.iter_divar_products("میز", 3, "tehran")
+    assert next(stream)["title"] == "میز 0"
+    (future, leader), = flights
+    # Published in full while the leader's own consumer has read only one product
+    assert leader and future.done()
+    assert [product["title"] for product in future.result()] == ["میز 0", "میز 1", "میز 2"]
+    stream.close()
+
+
+def test_waiters_of_abandoned_leader_fetch_once(search_state):
+    key = bot.SearchCache.make_key("میز", "tehran")
+    abandoned, _ = bot.search_flights.join(key, 3)
+    results = []
+    waiters = [threading.Thread(target=lambda: results.append(list(bot.iter_divar_products("میز", 3, "tehran"))))
+               for _ in range(4)]
+    for waiter in waiters:
+        waiter.start()
+    time.sleep(0.1)
+    bot.search_flights.finish(key, abandoned, None)
+    for waiter in waiters:
+        waiter.join(5)
+
+    assert search_state == ["میز"]
+    assert len(results) == 4 and all(len(products) == 3 for products in results)
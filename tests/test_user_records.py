@@ -0,0 +1,38 @@
+import time
+
+import bot
+
+
+def test_update_merges_fields_without_touching_earlier_reads():
+    store = bot.UserRecordStore(ttl=60)
+    store.update(1, delivery_mode="album")
+    before = store.get(1)
+    store.update(1, sort_order="price_asc")
+    assert store.get(1) == {"delivery_mode": "album", "sort_order": "price_asc"}
+    assert before == {"delivery_mode": "album"}
+    assert store.get(2, {}) == {}
+
+
+def test_idle_records_expire():
+    store = bot.UserRecordStore(ttl=0.05)
+    store.put(1, ("لپ تاپ", "tehran", None, None))
+    time.sleep(0.03)
+    assert store.get(1) is not None  # a read keeps the record alive
+    time.sleep(0.03)
+    assert store.get(1) is not None
+    time.sleep(0.06)
+    assert store.get(1) is None
+    store.update(1, sort_order="newest")
+    assert store.get(1) == {"sort_order": "newest"}
+    assert store.stats()["expired"] == 1
+
+
+def test_least_recently_used_evicted_over_cap():
+    store = bot.UserRecordStore(ttl=60, max_users=2)
+    store.put(1, "a")
+    store.put(2, "b")
+    store.get(1)
+    store.put(3, "c")
+    assert store.get(2) is None
+    assert store.get(1) == "a" and store.get(3) == "c"
+    assert store.stats() == {"users": 2, "expired": 0, "evicted": 1}